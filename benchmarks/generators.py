@@ -0,0 +1,111 @@
+"""Functions that write large synthetic CSV files for benchmarking the file
+readers: Campbell Scientific TOA5 files, as read by the 'generic' reader, and
+Siemens Insight trend report files, as read by the 'siemens' reader.  Each function
+returns the file specification (the reader parameters) needed to read the file.
+
+The timestamps in the files are local times in the requested timezone, taken at a
+fixed interval in UTC, so files that span a daylight savings change have a gap or
+a repeated hour, just as files from real loggers do.
+"""
+import datetime
+import random
+
+import pytz
+
+
+def local_times(rows, tz, start, interval):
+    """Generator yielding 'rows' naive local datetimes in the timezone named 'tz',
+    starting at the Unix timestamp 'start' and spaced 'interval' seconds apart.
+    """
+    zone = pytz.timezone(tz)
+    utc_start = datetime.datetime.utcfromtimestamp(start).replace(tzinfo=pytz.utc)
+    step = datetime.timedelta(seconds=interval)
+    for i in range(rows):
+        yield (utc_start + i * step).astimezone(zone).replace(tzinfo=None)
+
+
+def value_strings(cols, nan_frac, no_data_frac, rnd, nan_str):
+    """Returns a list of 'cols' value strings for one row.  Each value is 'nan_str'
+    with probability 'nan_frac', "No Data" with probability 'no_data_frac', and
+    otherwise a number.  'rnd' is the random.Random object to use.
+    """
+    vals = []
+    for j in range(cols):
+        r = rnd.random()
+        if r < nan_frac:
+            vals.append(nan_str)
+        elif r < nan_frac + no_data_frac:
+            vals.append('No Data')
+        else:
+            vals.append('%.4g' % (j * 10.0 + rnd.random() * 100.0))
+    return vals
+
+
+def write_toa5(path, rows, cols, nan_frac=0.0, no_data_frac=0.0, tz='UTC',
+               start=1483228800, interval=60, seed=0):
+    """Writes a TOA5 file, the format of a Campbell Scientific data logger, to
+    'path'.  The file has four header rows, a TIMESTAMP and RECORD column, and
+    'cols' value columns.
+
+    Parameters
+    ----------
+    path:  Path of the file to write.
+    rows:  Number of data rows.
+    cols:  Number of value columns, not including TIMESTAMP and RECORD.
+    nan_frac:  Fraction of values that are "NAN".
+    no_data_frac:  Fraction of values that are "No Data".
+    tz:  Olson timezone name of the timestamps written to the file.
+    start:  Unix timestamp of the first row.  Default is 2017-01-01 00:00 UTC.
+    interval:  Seconds between rows.
+    seed:  Seed for the random numbers, so the same file can be made again.
+
+    Returns the file specification needed to read the file with the 'generic' reader.
+    """
+    rnd = random.Random(seed)
+    names = ['Sensor_%03d_Avg' % j for j in range(cols)]
+    with open(path, 'w') as f:
+        f.write('"TOA5","BENCH","CR1000","1234","CR1000.Std.28","CPU:bench.CR1","1","Table1"\n')
+        f.write(','.join('"%s"' % nm for nm in ['TIMESTAMP', 'RECORD'] + names) + '\n')
+        f.write(','.join('"%s"' % u for u in ['TS', 'RN'] + [''] * cols) + '\n')
+        f.write(','.join('"%s"' % p for p in ['', ''] + ['Avg'] * cols) + '\n')
+        for i, dt in enumerate(local_times(rows, tz, start, interval)):
+            vals = value_strings(cols, nan_frac, no_data_frac, rnd, '"NAN"')
+            f.write('"%s",%d,%s\n' % (dt.strftime('%Y-%m-%d %H:%M:%S'), i, ','.join(vals)))
+
+    return {'file_type': 'generic', 'header_rows': 4, 'name_row': 2,
+            'ts_tz': tz, 'exclude_fields': ['RECORD']}
+
+
+def write_siemens(path, rows, cols, nan_frac=0.0, no_data_frac=0.0, tz='UTC',
+                  start=1483228800, interval=300, seed=0, no_data_cols=0, on_off_cols=0):
+    """Writes a Siemens Insight trend report file to 'path'.  See write_toa5() for
+    the other parameters; 'cols' is the number of Points in the report.  Of those
+    Points, the last 'no_data_cols' are always "No Data", as for Points that are
+    offline, and the 'on_off_cols' before them hold "On" or "Off" values.
+
+    Returns the file specification needed to read the file with the 'siemens' reader.
+    """
+    rnd = random.Random(seed)
+    times = list(local_times(rows, tz, start, interval)) if rows else []
+    with open(path, 'w') as f:
+        f.write('"Key            Name:Suffix                                Trend Definitions Used"\n')
+        for j in range(cols):
+            f.write('"Point_%d:","BENCH.AHU%d:SENSOR %d","","15 minutes"\n' % (j + 1, j // 10, j))
+        f.write('"Time Interval:","%d Minutes"\n' % (interval // 60))
+        if times:
+            f.write('"Date Range:","%s - %s"\n' % (times[0].strftime('%m/%d/%Y %H:%M:%S'),
+                                                   times[-1].strftime('%m/%d/%Y %H:%M:%S')))
+        f.write('"Report Timings:","All Hours"\n')
+        f.write('""\n')
+        f.write(','.join('"%s"' % h for h in ['<>Date', 'Time'] +
+                         ['Point_%d' % (j + 1) for j in range(cols)]) + '\n')
+        n_num = max(0, cols - no_data_cols - on_off_cols)
+        n_on_off = cols - n_num - min(cols, no_data_cols)
+        for dt in times:
+            vals = value_strings(n_num, nan_frac, no_data_frac, rnd, 'NaN')
+            vals += [rnd.choice(('On', 'Off')) for j in range(n_on_off)]
+            vals += ['No Data'] * (cols - n_num - n_on_off)
+            f.write('"%d/%d/%d","%s",%s\n' % (dt.month, dt.day, dt.year, dt.strftime('%H:%M:%S'),
+                                            ','.join('"%s"' % v for v in vals)))
+
+    return {'file_type': 'siemens', 'ts_tz': tz}
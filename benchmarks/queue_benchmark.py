@@ -0,0 +1,155 @@
+"""Benchmark of the SqliteReliableQueue used by the BMON poster.  Compares
+item-at-a-time use of the queue with the default rollback journal (how the
+queue was used originally) against the WAL journal mode with the append_many(),
+pop_many() and finished_many() batch methods.  Also measures the latency for a
+thread waiting on an empty queue to receive a newly appended item, and compares
+the disk space and encode / decode time of pickled queue items with the compact
+item format.
+
+Usage, from the root directory of the project:
+
+    python -m benchmarks.queue_benchmark [N_ITEMS]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from consumers.sqlite_queue import SqliteReliableQueue
+
+
+def sample_item(i, n_readings=30, recs=1):
+    """Returns a queue item shaped like those queued by the BMON poster, holding
+    'recs' records of 'n_readings' readings each.
+    """
+    readings = []
+    for r in range(recs):
+        ts = 1500000000 + (i * recs + r) * 60
+        readings += [(ts, 'CR1000_SENSOR_%02d_Avg' % j, 20.0 + j * 0.1) for j in range(n_readings)]
+    return {'storeKey': 'xyz123', 'readings': readings}
+
+
+def bench_single(path, n_items, wal=False):
+    """Appends, pops and finishes 'n_items' items one at a time.  Returns the
+    (append, pop) rates in items per second.
+    """
+    q = SqliteReliableQueue(path, wal=wal)
+    items = [sample_item(i) for i in range(n_items)]
+
+    start = time.perf_counter()
+    for item in items:
+        q.append(item)
+    append_rate = n_items / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(n_items):
+        q_id, item = q.popleft(sleep_wait=False)
+        q.finished(q_id)
+    pop_rate = n_items / (time.perf_counter() - start)
+
+    return append_rate, pop_rate
+
+
+def bench_batch(path, n_items, batch_size=50, wal=True):
+    """Appends, pops and finishes 'n_items' items in batches of 'batch_size'.
+    Returns the (append, pop) rates in items per second.
+    """
+    q = SqliteReliableQueue(path, wal=wal)
+    items = [sample_item(i) for i in range(n_items)]
+
+    start = time.perf_counter()
+    for i in range(0, n_items, batch_size):
+        q.append_many(items[i:i + batch_size])
+    append_rate = n_items / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    popped = 0
+    while popped < n_items:
+        batch = q.pop_many(batch_size, sleep_wait=False)
+        q.finished_many([q_id for q_id, item in batch])
+        popped += len(batch)
+    pop_rate = n_items / (time.perf_counter() - start)
+
+    return append_rate, pop_rate
+
+
+def bench_wakeup(path, tries=5, wal=True):
+    """Returns the average time in seconds for a thread waiting on an empty queue
+    to receive an item appended by another thread.
+    """
+    q = SqliteReliableQueue(path, wal=wal)
+    total = 0.0
+    for i in range(tries):
+        received = []
+
+        def waiter():
+            q.popleft()
+            received.append(time.perf_counter())
+
+        t = threading.Thread(target=waiter)
+        t.start()
+        time.sleep(1.2)     # let the waiter find the queue empty and start waiting
+        appended = time.perf_counter()
+        q.append(sample_item(i))
+        t.join()
+        total += received[0] - appended
+    return total / tries
+
+
+def bench_encoding(path, n_items, compact, recs=10):
+    """Appends 'n_items' items, each holding 'recs' records, to a queue using the
+    pickle format or, if 'compact' is True, the compact format.  Returns a dictionary
+    with the size of the queue file per reading in bytes, and the time to encode and
+    to decode an item in microseconds.
+    """
+    q = SqliteReliableQueue(path, wal=False, compact=compact)
+    items = [sample_item(i, recs=recs) for i in range(n_items)]
+    n_readings = sum(len(item['readings']) for item in items)
+
+    start = time.perf_counter()
+    encoded = [q._encode(item) for item in items]
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for buf in encoded:
+        q._decode(buf)
+    decode_time = time.perf_counter() - start
+
+    q.append_many(items)
+    conn = q._get_conn()
+    conn.execute('VACUUM')
+    return {'disk_bytes_per_reading': os.path.getsize(path) / n_readings,
+            'item_bytes_per_reading': sum(len(buf) for buf in encoded) / n_readings,
+            'encode_us_per_item': encode_time / n_items * 1e6,
+            'decode_us_per_item': decode_time / n_items * 1e6}
+
+
+def run(n_items=2000):
+    """Runs the queue benchmarks with 'n_items' items and returns the results as
+    a dictionary.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        results['single_rollback'] = bench_single(os.path.join(tmp, 'q1.db'), n_items)
+        results['single_wal'] = bench_single(os.path.join(tmp, 'q2.db'), n_items, wal=True)
+        results['batch_wal'] = bench_batch(os.path.join(tmp, 'q3.db'), n_items)
+        results['wakeup_latency'] = bench_wakeup(os.path.join(tmp, 'q4.db'))
+        results['encoding_pickle'] = bench_encoding(os.path.join(tmp, 'q5.db'), n_items, False)
+        results['encoding_compact'] = bench_encoding(os.path.join(tmp, 'q6.db'), n_items, True)
+    return results
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    res = run(n)
+    for name in ('single_rollback', 'single_wal', 'batch_wal'):
+        append_rate, pop_rate = res[name]
+        print('%-16s append: %9.0f items/s   pop+finish: %9.0f items/s' % (name, append_rate, pop_rate))
+    print('wakeup latency: %.4f s' % res['wakeup_latency'])
+    for name in ('encoding_pickle', 'encoding_compact'):
+        enc = res[name]
+        print('%-16s disk: %5.1f bytes/reading   item: %5.1f bytes/reading   '
+              'encode: %6.1f us/item   decode: %6.1f us/item' %
+              (name, enc['disk_bytes_per_reading'], enc['item_bytes_per_reading'],
+               enc['encode_us_per_item'], enc['decode_us_per_item']))
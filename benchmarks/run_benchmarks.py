@@ -0,0 +1,258 @@
+"""Benchmark suite for csv_transfer.  Generates synthetic CSV files and measures:
+
+    * rows per second and peak memory of the file readers at several chunk sizes,
+    * items per second appended to and popped from the SqliteReliableQueue,
+    * readings per second from a CSV file, through the BMONposter, into a local
+      stand-in for the BMON server,
+    * the time taken by each run of the script in 'run_once' mode, as run by cron.
+
+The results are written as JSON so that runs can be compared to find performance
+regressions.
+
+Usage, from the root directory of the project:
+
+    python -m benchmarks.run_benchmarks [options]
+
+Run with '--help' for the options.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import readers.columnar
+import readers.generic
+import readers.siemens
+import readers.split
+from consumers.bmon_poster import BMONposter
+
+from . import generators
+from . import queue_benchmark
+from . import startup_benchmark
+from .stand_in_server import StandInServer
+
+# maps the file type to the reader function, as in csv_transfer.py
+file_type_to_func = {'generic': readers.generic.generic_reader,
+                     'siemens': readers.siemens.siemens_reader,
+                     'columnar': readers.columnar.columnar_reader,
+                     'split': readers.split.split_reader}
+
+
+def read_all(reader_func, path, spec):
+    """Reads the file 'path' with 'reader_func' and returns the number of records.
+    """
+    n = 0
+    for recs, last_ts in reader_func(path, **spec):
+        n += 1 if isinstance(recs, dict) else len(recs)
+    return n
+
+
+def bench_reader(reader_func, path, spec):
+    """Reads the file 'path' with 'reader_func', passing it the parameters in
+    'spec'.  Returns a dictionary with the records read, the records read per second
+    and the peak memory in bytes allocated while reading.  The peak memory is
+    measured in a second read of the file, as tracing memory slows reading.
+    """
+    start = time.perf_counter()
+    n = read_all(reader_func, path, spec)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        read_all(reader_func, path, spec)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {'rows': n, 'seconds': elapsed, 'rows_per_s': n / elapsed if elapsed else None,
+            'peak_mem_bytes': peak}
+
+
+def bench_readers(tmp, args):
+    """Benchmarks each reader at each chunk size, yielding chunks of record
+    dictionaries and compact chunks.  Returns a list of result dictionaries.
+    """
+    files = []
+    path = os.path.join(tmp, 'bench_toa5.dat')
+    spec = generators.write_toa5(path, args.rows, args.cols, args.nan_frac,
+                                 args.no_data_frac, args.tz)
+    files.append(('toa5', path, spec))
+    if 'columnar' in args.readers:
+        files.append(('toa5', path, dict(spec, file_type='columnar')))
+    if 'split' in args.readers:
+        files.append(('toa5', path, dict(spec, file_type='split', split_mb=args.split_mb)))
+    path = os.path.join(tmp, 'bench_siemens.csv')
+    spec = generators.write_siemens(path, args.rows, args.cols, args.nan_frac,
+                                    args.no_data_frac, args.tz,
+                                    no_data_cols=args.siemens_no_data_cols,
+                                    on_off_cols=args.siemens_on_off_cols)
+    files.append(('siemens', path, spec))
+
+    results = []
+    for file_format, path, spec in files:
+        spec = spec.copy()
+        file_type = spec.pop('file_type')
+        if file_type not in args.readers:
+            continue
+        for chunk_size in args.chunk_sizes:
+            for compact in (False, True):
+                res = {'reader': file_type, 'file_format': file_format,
+                       'chunk_size': chunk_size, 'compact': compact,
+                       'file_bytes': os.path.getsize(path)}
+                try:
+                    res.update(bench_reader(file_type_to_func[file_type], path,
+                                            dict(spec, chunk_size=chunk_size, compact=compact)))
+                except Exception as e:
+                    res['error'] = '%s: %s' % (type(e).__name__, e)
+                results.append(res)
+                print_result('reader', res)
+    return results
+
+
+def bench_queue(args):
+    """Runs the queue benchmarks.  Returns a dictionary of results.
+    """
+    res = queue_benchmark.run(args.queue_items)
+    results = {'items': args.queue_items}
+    for name in ('single_rollback', 'single_wal', 'batch_wal'):
+        append_rate, pop_rate = res[name]
+        results[name] = {'append_items_per_s': append_rate, 'pop_items_per_s': pop_rate}
+    results['wakeup_latency_s'] = res['wakeup_latency']
+    results['encoding_pickle'] = res['encoding_pickle']
+    results['encoding_compact'] = res['encoding_compact']
+    print_result('queue', results)
+    return results
+
+
+# BMON poster settings benchmarked end-to-end
+POSTER_CONFIGS = {
+    'default': {},
+    'batched': {'batch_max_readings': 5000, 'queue_wal': True, 'queue_compact': True},
+    'batched_lanes': {'batch_max_readings': 5000, 'queue_wal': True, 'queue_compact': True,
+                      'lanes': 4},
+}
+
+
+def bench_end_to_end(tmp, args, name, poster_params):
+    """Reads a TOA5 file with the generic reader and posts the records through a
+    BMONposter, created with the 'poster_params' parameters, to a local stand-in
+    BMON server.  Returns a dictionary with the readings per second, measured from
+    the start of reading the file until the server has received all of the readings.
+    """
+    path = os.path.join(tmp, 'e2e_%s.dat' % name)
+    spec = generators.write_toa5(path, args.e2e_rows, args.cols, args.nan_frac,
+                                 args.no_data_frac, args.tz)
+    spec.pop('file_type')
+    spec['chunk_size'] = 10
+
+    server = StandInServer(args.post_delay)
+    try:
+        # an absolute path as the poster ID puts the poster's files in 'tmp'
+        poster = BMONposter(os.path.join(tmp, 'poster_%s' % name), server.url, 'bench',
+                            **poster_params)
+        start = time.perf_counter()
+        start_wall = time.time()
+        n_readings = 0
+        for recs, last_ts in readers.generic.generic_reader(path, **spec):
+            n_readings += sum(len(rec) - 1 for rec in recs)
+            poster(recs)
+        queued = time.perf_counter() - start
+        received = server.wait_for(n_readings, args.e2e_timeout)
+        elapsed = (server.last_post_time or time.time()) - start_wall
+        res = {'config': name, 'params': poster_params, 'readings': n_readings,
+               'readings_received': server.readings, 'posts': server.posts,
+               'post_bytes': server.bytes, 'queue_seconds': queued, 'seconds': elapsed,
+               'readings_per_s': server.readings / elapsed if elapsed else None}
+        if not received:
+            res['error'] = 'timed out waiting for all readings'
+    finally:
+        server.close()
+    print_result('end_to_end', res)
+    return res
+
+
+def bench_startup(args):
+    """Runs the startup benchmark.  Returns a dictionary of results.
+    """
+    results = startup_benchmark.run(args.startup_runs)
+    print_result('startup', results)
+    return results
+
+
+def print_result(kind, res):
+    """Prints a one line summary of a result to stderr, so progress can be seen.
+    """
+    print('%s: %s' % (kind, json.dumps(res, sort_keys=True)), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the csv_transfer readers, '
+                                                 'posting queue and BMON poster.')
+    parser.add_argument('--rows', type=int, default=20000, help='rows in reader test files')
+    parser.add_argument('--cols', type=int, default=20, help='value columns in test files')
+    parser.add_argument('--nan-frac', type=float, default=0.05, help='fraction of NAN values')
+    parser.add_argument('--no-data-frac', type=float, default=0.05,
+                        help="fraction of 'No Data' values")
+    parser.add_argument('--tz', default='America/Anchorage', help='timezone of the timestamps')
+    parser.add_argument('--siemens-no-data-cols', type=int, default=2,
+                        help="Siemens Points that are always 'No Data'")
+    parser.add_argument('--siemens-on-off-cols', type=int, default=2,
+                        help='Siemens Points with On/Off values')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--readers', nargs='+', default=['generic', 'siemens', 'columnar'],
+                        help="readers to benchmark; 'split' is also available")
+    parser.add_argument('--split-processes', type=int, default=os.cpu_count(),
+                        help='worker processes of the split reader')
+    parser.add_argument('--split-mb', type=float, default=1.0,
+                        help='size in megabytes of the byte ranges of the split reader')
+    parser.add_argument('--queue-items', type=int, default=2000, help='items for queue benchmarks')
+    parser.add_argument('--e2e-rows', type=int, default=5000, help='rows posted end-to-end')
+    parser.add_argument('--e2e-configs', nargs='+', default=list(POSTER_CONFIGS),
+                        help='BMON poster configurations to benchmark end-to-end')
+    parser.add_argument('--e2e-timeout', type=float, default=600.0,
+                        help='seconds to wait for posts to finish')
+    parser.add_argument('--post-delay', type=float, default=0.0,
+                        help='seconds the stand-in server waits before answering each post')
+    parser.add_argument('--startup-runs', type=int, default=5,
+                        help="runs of the script in 'run_once' mode with nothing new to read")
+    parser.add_argument('--skip', nargs='+', default=[],
+                        choices=['readers', 'queue', 'end_to_end', 'startup'],
+                        help='benchmarks to skip')
+    parser.add_argument('--output', '-o', help='JSON results file; default is stdout')
+    args = parser.parse_args(argv)
+
+    results = {'meta': {'time': time.time(),
+                        'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'cpu_count': os.cpu_count(),
+                        'args': vars(args)}}
+    if 'split' in args.readers and args.split_processes > 1:
+        # started before the BMON poster benchmarks start any threads
+        readers.split.start_workers(args.split_processes)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if 'readers' not in args.skip:
+            results['readers'] = bench_readers(tmp, args)
+        if 'queue' not in args.skip:
+            results['queue'] = bench_queue(args)
+        if 'end_to_end' not in args.skip:
+            results['end_to_end'] = [bench_end_to_end(tmp, args, name, POSTER_CONFIGS[name])
+                                     for name in args.e2e_configs]
+        if 'startup' not in args.skip:
+            results['startup'] = bench_startup(args)
+    readers.split.stop_workers()
+
+    out = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""A local HTTP server that stands in for the BMON reading storage endpoint
+when benchmarking the BMON poster.  It accepts posts of JSON readings, gzip
+compressed or not, and counts the readings received.
+"""
+import gzip
+import http.server
+import json
+import threading
+import time
+
+
+class StandInServer:
+    """Runs a local HTTP server in a background thread.
+
+    Parameters
+    ----------
+    post_delay:  Seconds to wait before responding to each post, to simulate a
+        slow connection or server.
+    """
+
+    def __init__(self, post_delay=0.0):
+        self.post_delay = post_delay
+        self.readings = 0           # number of readings received
+        self.posts = 0              # number of posts received
+        self.bytes = 0              # bytes of post bodies received
+        self.last_post_time = None
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'     # keep connections open
+            disable_nagle_algorithm = True      # don't delay the small responses
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                data = body
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    data = gzip.decompress(body)
+                n = len(json.loads(data.decode('utf-8'))['readings'])
+                if server.post_delay:
+                    time.sleep(server.post_delay)
+                with server._lock:
+                    server.readings += n
+                    server.posts += 1
+                    server.bytes += len(body)
+                    server.last_post_time = time.time()
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'OK')
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d/readingdb/reading/store/' % self._httpd.server_address[1]
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def wait_for(self, n_readings, timeout):
+        """Waits until 'n_readings' readings have been received or 'timeout'
+        seconds pass.  Returns True if the readings were received.
+        """
+        deadline = time.time() + timeout
+        while self.readings < n_readings:
+            if time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self):
+        """Stops the server.
+        """
+        self._httpd.shutdown()
+        self._httpd.server_close()
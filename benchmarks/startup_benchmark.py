@@ -0,0 +1,84 @@
+"""Benchmark of the time taken by one run of csv_transfer.py in 'run_once' mode,
+as when the script is run by cron.  Each run is a new Python process, started
+with a configuration that reads a small TOA5 file and posts its records through
+the BMON poster to a local stand-in for the BMON server.  The first run posts the
+records of the file; the file is unchanged for the later runs, so their time is
+that of starting the script, checking the file and shutting down.
+
+Usage, from the root directory of the project:
+
+    python -m benchmarks.startup_benchmark [RUNS]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from . import generators
+from .stand_in_server import StandInServer
+
+# The full path to the script being measured
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                      'csv_transfer.py')
+
+
+def write_config(tmp, url, rows, wait_before_stop):
+    """Writes a TOA5 file of 'rows' rows and a configuration file in the directory
+    'tmp' that posts its records to 'url'.  'wait_before_stop' is the script's
+    'run_once_wait_before_stop' setting.  Returns the path to the configuration file.
+    """
+    spec = generators.write_toa5(os.path.join(tmp, 'startup.dat'), rows, 10)
+    spec['file_glob'] = os.path.join(tmp, '*.dat')
+    config = {'run_once': True,
+              'run_once_wait_before_stop': wait_before_stop,
+              'logging_level': 'WARNING',
+              'csv_files': [spec],
+              'consumers': [{'type': 'bmon',
+                             # an absolute path puts the poster's files in 'tmp'
+                             'poster_id': os.path.join(tmp, 'poster'),
+                             'bmon_store_url': url,
+                             'bmon_store_key': 'bench'}]}
+    path = os.path.join(tmp, 'startup.yaml')
+    with open(path, 'w') as f:
+        yaml.dump(config, f)
+    return path
+
+
+def time_run(config_path):
+    """Runs the script once with the configuration file 'config_path' and returns
+    the elapsed time in seconds.
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, SCRIPT, config_path], check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def run(runs=5, rows=100, wait_before_stop=15):
+    """Runs the script 'runs' + 1 times, with a TOA5 file of 'rows' rows.  Returns a
+    dictionary with the time in seconds of the first run, which posts the records,
+    and the minimum and median time of the other runs, which find nothing new.
+    """
+    server = StandInServer()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            config_path = write_config(tmp, server.url, rows, wait_before_stop)
+            first = time_run(config_path)
+            times = [time_run(config_path) for i in range(runs)]
+    finally:
+        server.close()
+    return {'runs': runs, 'rows': rows, 'readings_received': server.readings,
+            'first_run_s': first, 'idle_run_min_s': min(times),
+            'idle_run_median_s': statistics.median(times)}
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    res = run(n)
+    print('First run, posting %d rows: %.3f s' % (res['rows'], res['first_run_s']))
+    print('Runs with nothing new: %.3f s minimum, %.3f s median' %
+          (res['idle_run_min_s'], res['idle_run_median_s']))
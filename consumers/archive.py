@@ -0,0 +1,299 @@
+'''Contains the ArchiveWriter class, a consumer that keeps a local archive of all
+records transferred, for analysis and for replaying records after an outage of
+the BMON server.  Records are buffered and written in large batches, either to a
+wide SQLite table with one column per sensor, or to Parquet files partitioned by
+day and sensor.
+'''
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+from readers.chunk import RecordChunk
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# the error logger to use for this module
+logger = logging.getLogger(__name__)
+
+
+class ArchiveWriter:
+    '''Class to accept a list of timestamped records, or a readers.chunk.RecordChunk,
+    and write them to a local archive.  The records are held in memory until
+    'flush_readings' readings are waiting, or the oldest waiting records were received
+    'flush_seconds' ago, and are then written in one batch.
+
+    Parameters
+    ----------
+    archive_dir:  The directory holding the archive.  It is created if needed.
+    format:  'sqlite' (the default) to write the records to a wide table, named
+        'readings', in the SQLite database 'archive.db' in 'archive_dir'.  The table
+        has a 'ts' column holding the Unix timestamp and one column per sensor, added
+        as new sensors appear.  Records from different files with the same timestamp
+        are merged into one row.  'parquet' writes Parquet files, with 'ts' and 'value'
+        columns, to the directory 'archive_dir/date=YYYY-MM-DD/sensor=NAME' of each
+        UTC day and sensor.  Each batch adds a new file to the directory.  The
+        'parquet' format requires the pyarrow package.
+    flush_readings:  The number of waiting readings that causes the records to be
+        written.  The records are written by the thread delivering them, so a
+        consumer that can't keep up slows the reading of files instead of using more
+        memory.  Default is 100,000.
+    flush_seconds:  The maximum time in seconds that records wait before being
+        written.  Default is 60.
+    '''
+
+    # this consumer can be passed RecordChunk objects instead of lists of records
+    accepts_chunks = True
+
+    def __init__(self, archive_dir, format='sqlite', flush_readings=100000, flush_seconds=60):
+
+        os.makedirs(archive_dir, exist_ok=True)
+        if format == 'sqlite':
+            self.writer = SqliteArchive(os.path.join(archive_dir, 'archive.db'))
+        elif format == 'parquet':
+            self.writer = ParquetArchive(archive_dir)
+        else:
+            raise ValueError('The archive format "%s" is not valid.' % format)
+
+        self.flush_readings = flush_readings
+        self.flush_seconds = flush_seconds
+
+        # the chunks of records waiting to be written, the number of readings in
+        # them, and the time the oldest was received.
+        self.chunks = []
+        self.n_readings = 0
+        self.oldest = None
+        self.lock = threading.Lock()
+        # held while writing, so batches are written one at a time and in order
+        self.write_lock = threading.Lock()
+        # the first error writing a batch since the last call to flush()
+        self.error = None
+
+        threading.Thread(target=self._flush_old, daemon=True).start()
+
+    def __call__(self, recs):
+        '''Method called to archive records. 'recs' is a list of dictionaries, each
+        dictionary being one record.  A record has a 'ts' field with a Unix timestamp
+        and a variable number of other floating-point fields containing sensor or
+        measured data.  'recs' can also be a readers.chunk.RecordChunk.
+        '''
+        if isinstance(recs, RecordChunk):
+            n = recs.n_readings()
+        else:
+            n = sum(len(rec) - 1 for rec in recs)
+        if not len(recs):
+            return
+
+        with self.lock:
+            self.chunks.append(recs)
+            self.n_readings += n
+            if self.oldest is None:
+                self.oldest = time.time()
+            full = self.n_readings >= self.flush_readings
+        if full:
+            self._write()
+
+    def flush(self):
+        '''Writes all waiting records to the archive.  Raises the first error writing
+        a batch of records since the last call, so the caller knows that records it
+        delivered were not archived.
+        '''
+        self._write()
+        with self.lock:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def _write(self):
+        '''Writes all waiting records to the archive, logging and saving any error,
+        to be raised by flush().
+        '''
+        with self.write_lock:
+            with self.lock:
+                chunks = self.chunks
+                n = self.n_readings
+                self.chunks = []
+                self.n_readings = 0
+                self.oldest = None
+            if not chunks:
+                return
+            start = time.time()
+            try:
+                self.writer.write(chunks)
+                logger.debug('Archived %d readings in %.3f s' % (n, time.time() - start))
+            except Exception as e:
+                logger.exception('Error writing %d readings to the archive.' % n)
+                with self.lock:
+                    if self.error is None:
+                        self.error = e
+
+    def _flush_old(self):
+        '''Runs in a thread, writing the waiting records once the oldest has waited
+        'flush_seconds'.
+        '''
+        while True:
+            time.sleep(min(1.0, self.flush_seconds))
+            with self.lock:
+                old = self.oldest is not None and time.time() - self.oldest >= self.flush_seconds
+            if old:
+                self._write()
+
+
+def _chunk_rows(recs):
+    '''Generator yielding a (names, rows) tuple for each group of records in 'recs',
+    a RecordChunk or a list of record dictionaries, with the same field names.  Each
+    row is a list holding the timestamp followed by a value, or None if missing, for
+    each name.
+    '''
+    if isinstance(recs, RecordChunk):
+        names = recs.names
+        rows = []
+        for ts, vals, ok in recs._rows():
+            if all(ok):
+                rows.append([float(ts)] + vals)
+            else:
+                rows.append([float(ts)] + [v if good else None for v, good in zip(vals, ok)])
+        yield names, rows
+    else:
+        groups = {}
+        for rec in recs:
+            names = tuple(nm for nm in rec if nm != 'ts')
+            groups.setdefault(names, []).append([rec['ts']] + [rec[nm] for nm in names])
+        for names, rows in groups.items():
+            yield list(names), rows
+
+
+class SqliteArchive:
+    '''Writes batches of records to a wide table in a SQLite database.  See
+    ArchiveWriter for a description of the table.  Sensor names that differ only in
+    case, which SQLite treats as the same column name, are given distinct columns;
+    the 'sensors' table maps each sensor name to its column.  SQLite allows at most
+    2000 columns in a table.
+    '''
+
+    _create_readings = 'CREATE TABLE IF NOT EXISTS readings (ts REAL PRIMARY KEY)'
+    _create_sensors = (
+            'CREATE TABLE IF NOT EXISTS sensors '
+            '('
+            '  name TEXT PRIMARY KEY,'
+            '  col TEXT'
+            ')'
+            )
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        # maps sensor name to the quoted name of its column
+        self.columns = {}
+
+    def _connect(self):
+        # transactions are begun explicitly, so that adding columns is part of them
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute(self._create_readings)
+            self.conn.execute(self._create_sensors)
+        self._load_columns()
+
+    def _load_columns(self):
+        self.columns = dict((name, _quote(col)) for name, col in
+                            self.conn.execute('SELECT name, col FROM sensors'))
+
+    def _add_columns(self, names):
+        '''Adds a column for each sensor in 'names' that doesn't have one.
+        '''
+        used = set(col.lower() for col in self.columns.values())
+        for name in names:
+            if name in self.columns:
+                continue
+            col = name
+            i = 2
+            while _quote(col).lower() in used:
+                col = '%s_%d' % (name, i)
+                i += 1
+            self.conn.execute('ALTER TABLE readings ADD COLUMN %s REAL' % _quote(col))
+            self.conn.execute('INSERT INTO sensors (name, col) VALUES (?, ?)', (name, col))
+            self.columns[name] = _quote(col)
+            used.add(_quote(col).lower())
+
+    def write(self, chunks):
+        '''Writes the list of chunks of records 'chunks' in one transaction.
+        '''
+        if self.conn is None:
+            self._connect()
+        try:
+            self._write(chunks)
+        except:
+            # columns added in the failed transaction were rolled back
+            self._load_columns()
+            raise
+
+    def _write(self, chunks):
+        with self.conn:
+            self.conn.execute('BEGIN')
+            for recs in chunks:
+                for names, rows in _chunk_rows(recs):
+                    self._add_columns(names)
+                    cols = [self.columns[nm] for nm in names]
+                    sql = ('INSERT INTO readings (ts%s) VALUES (?%s) ON CONFLICT(ts) DO UPDATE SET %s' %
+                           (''.join(', %s' % c for c in cols), ', ?' * len(cols),
+                            ', '.join('%s = COALESCE(excluded.%s, %s)' % (c, c, c) for c in cols)))
+                    if not cols:
+                        sql = 'INSERT OR IGNORE INTO readings (ts) VALUES (?)'
+                    self.conn.executemany(sql, rows)
+
+
+def _quote(name):
+    '''Returns 'name' quoted as an SQL identifier.
+    '''
+    return '"%s"' % name.replace('"', '""')
+
+
+class ParquetArchive:
+    '''Writes batches of records to Parquet files partitioned by day and sensor.
+    See ArchiveWriter for a description of the files.
+    '''
+
+    def __init__(self, archive_dir):
+        if pyarrow is None:
+            raise ImportError('The parquet archive format requires the pyarrow package.')
+        self.archive_dir = archive_dir
+        self.batch = 0
+
+    def write(self, chunks):
+        '''Writes the list of chunks of records 'chunks', one file for each day and
+        sensor present.
+        '''
+        # gather the timestamps and values of each day and sensor
+        parts = {}
+        for recs in chunks:
+            for names, rows in _chunk_rows(recs):
+                for row in rows:
+                    ts = row[0]
+                    day = time.strftime('%Y-%m-%d', time.gmtime(ts))
+                    for nm, val in zip(names, row[1:]):
+                        if val is not None:
+                            part = parts.get((day, nm))
+                            if part is None:
+                                part = parts[(day, nm)] = ([], [])
+                            part[0].append(ts)
+                            part[1].append(val)
+
+        # each batch gets a unique file name in the partition directories
+        self.batch += 1
+        file_name = 'part-%d-%d-%d.parquet' % (int(time.time() * 1000), os.getpid(), self.batch)
+        for (day, nm), (ts, vals) in parts.items():
+            part_dir = os.path.join(self.archive_dir, 'date=%s' % day,
+                                    'sensor=%s' % urllib.parse.quote(nm, safe=''))
+            os.makedirs(part_dir, exist_ok=True)
+            table = pyarrow.table({'ts': pyarrow.array(ts, pyarrow.float64()),
+                                   'value': pyarrow.array(vals, pyarrow.float64())})
+            path = os.path.join(part_dir, file_name)
+            pyarrow.parquet.write_table(table, path + '.tmp')
+            os.replace(path + '.tmp', path)
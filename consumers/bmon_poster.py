@@ -1,16 +1,24 @@
 '''Contains the BMONposter class that posts records to a BMON web
 application.  See: https://github.com/alanmitchell/bmon
 '''
+import glob
+import logging
 import os
+import re
+import zlib
+from readers.chunk import RecordChunk
 from . import httpPoster2
 
 # The directory path to this file
 THIS_FOLDER = os.path.dirname(__file__)
 
+# the error logger to use for this module
+logger = logging.getLogger(__name__)
+
 
 class BMONposter:
-    '''Class to accept a list of timestamped records and post them to a BMON
-    web site.  
+    '''Class to accept a list of timestamped records, or a readers.chunk.RecordChunk,
+    and post them to a BMON web site.  
 
     Parameters
     ----------
@@ -21,31 +29,184 @@ class BMONposter:
         https://bmon.analysisnorth.com/readingdb/reading/store/
     bmon_store_key:  The BMON store key, used for authentication with this particular
         BMON site.
+    batch_max_readings:  If greater than 0, sets of records waiting in the posting queue
+        are combined into one post to BMON, up to this number of readings.  This greatly
+        speeds up posting a backlog of readings.  If 0 (the default), each set of records
+        passed to this object is posted separately.  A set of records holding more
+        readings than this is split into several queue items, which are added to the
+        posting queue in one transaction.
+    batch_max_bytes:  The maximum size in bytes of the readings combined into one post.
+    queue_wal:  If True, the SQLite database holding the posting queue uses the
+        write-ahead log journal mode, which increases queue throughput.
+    queue_compact:  If True, readings in the posting queue are stored in a compact
+        binary format, with each sensor name stored once, instead of in pickle format.
+        This makes the queue file several times smaller when a backlog of readings
+        builds up.  Readings already queued in pickle format are still posted.
+    gzip_level:  If 1 - 9, posts are gzip compressed at this level.  See
+        httpPoster2.HttpPoster.
+    lanes:  The number of posting queues, each posting the readings of a group of
+        sensors in order, that can have a post in progress at once.  If the number of
+        lanes is changed while readings are waiting in the queues, the prior number
+        of lanes is used until the waiting readings are posted, so the readings of
+        each sensor are still posted in order.
+    max_queue_mb:  If greater than 0, the maximum size in megabytes of the readings
+        waiting in the posting queue files.  When the queues reach this size, full()
+        returns True, and csv_transfer.py stops reading files until the queues
+        shrink, instead of filling the disk during a long outage of the BMON server.
     '''
 
-    def __init__(self, poster_id, bmon_store_url, bmon_store_key):
+    # this consumer can be passed RecordChunk objects instead of lists of records
+    accepts_chunks = True
+
+    def __init__(self, poster_id, bmon_store_url, bmon_store_key,
+                 batch_max_readings=0, batch_max_bytes=1000000, queue_wal=False,
+                 queue_compact=False, gzip_level=0, lanes=1, max_queue_mb=0):
+
+        def make_poster(q_filename):
+            # create an HTTP poster to post to BMON
+            return httpPoster2.HttpPoster(post_URL=bmon_store_url,
+                                          post_thread_count=1,    # Counter readings must come in order
+                                          post_q_filename=q_filename,
+                                          post_time_file=os.path.join(THIS_FOLDER, '%s.last_post' % poster_id),
+                                          batch_max_readings=batch_max_readings,
+                                          batch_max_bytes=batch_max_bytes,
+                                          post_q_wal=queue_wal,
+                                          post_q_compact=queue_compact,
+                                          gzip_level=gzip_level,
+                                          )
+
+        self.make_poster = make_poster
+        self.poster_id = poster_id
+
+        # The file recording the number of lanes the readings in the queues were
+        # divided into.  Older versions didn't write it, and always created the
+        # queue files of all of their lanes.
+        self.lanes_file = os.path.join(THIS_FOLDER, '%s.lanes' % poster_id)
+        lane_files = glob.glob(lane_q_filename(poster_id, '*'))
+        try:
+            with open(self.lanes_file) as f:
+                queued_lanes = int(f.read())
+        except (OSError, ValueError):
+            queued_lanes = 1 + max([int(m.group(1)) for m in
+                                    (re.search(r'-lane(\d+)\.db$', fn) for fn in lane_files) if m],
+                                   default=0)
+
+        # One poster per lane.  The first lane uses the same queue file as a single
+        # poster does, so readings queued before lanes were added are still posted.
+        self.lanes = queued_lanes
+        self.posters = [make_poster(lane_q_filename(poster_id, i)) for i in range(self.lanes)]
+
+        # Queue files of lanes beyond the prior number of lanes may still hold
+        # readings, if the number of lanes was reduced by an older version.  Post
+        # them, but add no new readings to them.
+        self.retired_posters = []
+        for q_filename in lane_files:
+            m = re.search(r'-lane(\d+)\.db$', q_filename)
+            if m and int(m.group(1)) >= self.lanes:
+                poster = make_poster(q_filename)
+                if len(poster.post_Q):
+                    self.retired_posters.append(poster)
+
+        # A sensor's lane depends on the number of lanes, so readings queued in the
+        # prior lanes must be posted before the number of lanes changes, or the
+        # readings of a sensor could be posted out of order.
+        self.new_lanes = max(1, int(lanes))
+        if self.new_lanes != self.lanes and self.unposted():
+            logger.warning('Posting with %d lanes, instead of %d, until the readings '
+                           'waiting in the posting queues are posted.' % (self.lanes, self.new_lanes))
+        self.change_lanes()
 
-        # create the HTTP poster to post to BMON
-        self.poster = httpPoster2.HttpPoster(post_URL=bmon_store_url,
-                                             post_thread_count=1,    # Counter readings must come in order
-                                             post_q_filename=os.path.join(THIS_FOLDER, '%s.db' % poster_id),
-                                             post_time_file=os.path.join(THIS_FOLDER, '%s.last_post' % poster_id),
-                                             )
         self.bmon_store_key = bmon_store_key
+        self.batch_max_readings = batch_max_readings
+        self.max_queue_bytes = max_queue_mb * 1e6
 
     def __call__(self, recs):
         '''Method called to post records. 'recs' is a list of dictionaries, each
         dictionary being one record.  A record has a 'ts' field with a Unix timestamp
         and a variable number of other floating-point fields containing sensor or
-        measured data.
+        measured data.  'recs' can also be a readers.chunk.RecordChunk.
+        '''
+        if self.lanes != self.new_lanes:
+            self.change_lanes()
+
+        # create a separate post record for each field in each record, putting
+        # each in the lane for its sensor.
+        if isinstance(recs, RecordChunk):
+            readings = recs.readings()
+            if self.lanes == 1:
+                lane_readings = [readings]
+            else:
+                lane_of_name = dict((nm, sensor_lane(nm, self.lanes)) for nm in recs.names)
+                lane_readings = [[] for i in range(self.lanes)]
+                for reading in readings:
+                    lane_readings[lane_of_name[reading[1]]].append(reading)
+        else:
+            lane_readings = [[] for i in range(self.lanes)]
+            lane_of_name = {}
+            for rec in recs:
+                # the records are not altered, as they are shared with other consumers
+                ts = int(rec['ts'])
+                for nm, val in rec.items():
+                    if nm == 'ts':
+                        continue
+                    lane = lane_of_name.get(nm)
+                    if lane is None:
+                        lane = lane_of_name[nm] = sensor_lane(nm, self.lanes)
+                    lane_readings[lane].append((ts, nm, val))
+
+        # add the readings to the Poster objects, including the store key.  Large
+        # sets of readings are split into items no larger than one post.
+        n = self.batch_max_readings
+        for poster, readings in zip(self.posters, lane_readings):
+            if n > 0 and len(readings) > n:
+                poster.add_readings_many([{'storeKey': self.bmon_store_key, 'readings': readings[i:i + n]}
+                                          for i in range(0, len(readings), n)])
+            elif readings or self.lanes == 1:
+                poster.add_readings({'storeKey': self.bmon_store_key, 'readings': readings})
+
+    def change_lanes(self):
+        '''Changes to the configured number of lanes if no readings are waiting in the
+        posting queues.
+        '''
+        if self.unposted():
+            return
+        if self.new_lanes != self.lanes:
+            # the queues of the lanes no longer used are empty
+            self.posters = (self.posters[:self.new_lanes] +
+                            [self.make_poster(lane_q_filename(self.poster_id, i))
+                             for i in range(self.lanes, self.new_lanes)])
+            self.lanes = self.new_lanes
+            logger.info('Posting with %d lanes.' % self.lanes)
+        self.retired_posters = []
+        with open(self.lanes_file, 'w') as f:
+            f.write('%d\n' % self.lanes)
+
+    def full(self):
+        '''Returns True if the readings waiting in the posting queues have reached
+        'max_queue_mb'.
+        '''
+        if not self.max_queue_bytes:
+            return False
+        used = sum(poster.post_Q.used_bytes() for poster in self.posters + self.retired_posters)
+        return used >= self.max_queue_bytes
+
+    def unposted(self):
+        '''Returns the number of items in the posting queues that have not been posted.
         '''
+        return sum(poster.unposted() for poster in self.posters + self.retired_posters)
+
 
-        # create a separate post record for each field in each record
-        readings = []
-        for rec in recs:
-            ts = int(rec.pop('ts'))
-            for nm, val in list(rec.items()):
-                readings.append((ts, nm, val))
+def lane_q_filename(poster_id, lane):
+    '''Returns the name of the queue file for lane number 'lane' of the BMON poster
+    with the ID 'poster_id'.
+    '''
+    if lane == 0:
+        return os.path.join(THIS_FOLDER, '%s.db' % poster_id)
+    return os.path.join(THIS_FOLDER, '%s-lane%s.db' % (poster_id, lane))
 
-        # add the readings to the Poster object, including the store key
-        self.poster.add_readings({'storeKey': self.bmon_store_key, 'readings': readings})
+
+def sensor_lane(sensor_id, lanes):
+    '''Returns the lane number, 0 to lanes - 1, for the sensor 'sensor_id'.  A stable
+    hash is used so a sensor stays in the same lane across runs of the script.
+    '''
+    return zlib.crc32(sensor_id.encode('utf-8')) % lanes
@@ -0,0 +1,125 @@
+'''Contains the Dispatcher class, which runs a consumer in its own thread behind a
+bounded buffer, so a slow consumer does not hold up the reading of files or the
+other consumers, and the ConsumerFull exception, raised when a consumer can't
+accept more records.
+'''
+import collections
+import logging
+import threading
+from readers.chunk import RecordChunk
+
+# the error logger to use for this module
+logger = logging.getLogger(__name__)
+
+
+class ConsumerFull(Exception):
+    '''Raised when a consumer has reached a limit on the records it is holding,
+    such as the size of a posting queue, and can't accept more records until it
+    catches up.
+    '''
+    pass
+
+
+def count_readings(recs):
+    '''Returns the number of readings in 'recs', a list of record dictionaries or a
+    readers.chunk.RecordChunk.
+    '''
+    if isinstance(recs, RecordChunk):
+        return recs.n_readings()
+    return sum(len(rec) - 1 for rec in recs)
+
+
+class Dispatcher:
+    '''Passes records to a consumer from a separate thread.  Calling this object
+    adds the records to a buffer and returns, unless the buffer holds
+    'buffer_readings' readings, in which case the call waits for room.  This limits
+    memory use and slows the reading of files to the rate the consumer can handle.
+
+    Parameters
+    ----------
+    consumer:  The consumer, which is called with each set of records.
+    buffer_readings:  The maximum number of readings in the buffer.  A set of
+        records larger than this is accepted when the buffer is empty.
+    name:  Name of the consumer used in log messages.
+    '''
+
+    def __init__(self, consumer, buffer_readings, name=''):
+        self.consumer = consumer
+        self.accepts_chunks = getattr(consumer, 'accepts_chunks', False)
+        self.buffer_readings = buffer_readings
+        self.name = name
+
+        # the sets of records waiting, each with its number of readings
+        self.buffer = collections.deque()
+        self.n_readings = 0
+        # True while the consumer is processing a set of records
+        self.busy = False
+        # the first error raised by the consumer since the last drain()
+        self.error = None
+        self.cond = threading.Condition()
+
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def __call__(self, recs):
+        n = count_readings(recs)
+        with self.cond:
+            while self.buffer and self.n_readings + n > self.buffer_readings:
+                self.cond.wait()
+            self.buffer.append((recs, n))
+            self.n_readings += n
+            self.cond.notify_all()
+
+    def full(self):
+        '''Returns True if the consumer has reached its own limit; see ConsumerFull.
+        '''
+        return hasattr(self.consumer, 'full') and self.consumer.full()
+
+    def unposted(self):
+        '''Returns the number of items the consumer has not yet posted, if it has an
+        unposted() method, otherwise 0.
+        '''
+        return self.consumer.unposted() if hasattr(self.consumer, 'unposted') else 0
+
+    def drain(self):
+        '''Waits until the consumer has processed all of the records in the buffer.
+        If the consumer raised an error for any of the records passed to it since the
+        last call, that error is raised, as those records were not taken.
+        '''
+        with self.cond:
+            while self.buffer or self.busy:
+                self.cond.wait()
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def flush(self):
+        '''Waits for the buffer to empty and then flushes the consumer, if it has a
+        flush() method.  The consumer is flushed even if drain() raises an error.
+        '''
+        try:
+            self.drain()
+        finally:
+            if hasattr(self.consumer, 'flush'):
+                self.consumer.flush()
+
+    def _run(self):
+        '''Runs in a thread, passing the records in the buffer to the consumer.
+        '''
+        while True:
+            with self.cond:
+                while not self.buffer:
+                    self.cond.wait()
+                recs, n = self.buffer.popleft()
+                self.busy = True
+            error = None
+            try:
+                self.consumer(recs)
+            except Exception as e:
+                logger.exception('Error delivering records to the Consumer %s' % self.name)
+                error = e
+            with self.cond:
+                if self.error is None:
+                    self.error = error
+                self.n_readings -= n
+                self.busy = False
+                self.cond.notify_all()
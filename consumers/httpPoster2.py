@@ -11,13 +11,36 @@ TO DO:
         processing queue.
 """
 
-import time, sys
+import time, sys, collections, gzip, os
 import threading, json, logging
 import requests
+import metrics
 from . import sqlite_queue
 
 requests.packages.urllib3.disable_warnings()
 
+# Number of items popped from the queue at once when merging items into one post.
+POP_GROUP_SIZE = 20
+
+# Runtime metrics, labeled by the name of the poster
+post_latency_metric = metrics.histogram('csv_transfer_post_latency_seconds',
+                                        'Time taken by successful posts.',
+                                        [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15])
+post_bytes_metric = metrics.histogram('csv_transfer_post_bytes',
+                                      'Size of the body of successful posts, as sent.',
+                                      [1e3, 1e4, 1e5, 1e6, 1e7])
+posts_metric = metrics.counter('csv_transfer_posts_total', 'Successful posts.')
+readings_posted_metric = metrics.counter('csv_transfer_readings_posted_total',
+                                         'Readings included in successful posts.')
+post_retries_metric = metrics.counter('csv_transfer_post_retries_total',
+                                      'Posts that failed and will be retried.')
+backoff_metric = metrics.counter('csv_transfer_post_backoff_seconds_total',
+                                 'Time spent waiting to retry failed posts.')
+queue_depth_metric = metrics.gauge('csv_transfer_queue_depth',
+                                   'Items in the posting queue that are not yet posted.')
+queue_age_metric = metrics.gauge('csv_transfer_queue_oldest_age_seconds',
+                                 'Age of the oldest item in the posting queue not yet posted.')
+
 class HttpPoster:
     """A class to post readings to a URL via HTTP.  The readings to be posted
     are delivered to this object via the addReadings() method.
@@ -27,7 +50,13 @@ class HttpPoster:
                        reading_converter=None, 
                        post_q_filename='postQ.sqlite', 
                        post_thread_count=2, 
-                       post_time_file='/var/tmp/last_post_time'):
+                       post_time_file='/var/tmp/last_post_time',
+                       batch_max_readings=0,
+                       batch_max_bytes=1000000,
+                       post_q_wal=False,
+                       post_q_compact=False,
+                       gzip_level=0,
+                       name=None):
         """Parameters are:
         'post_URL': URL to post the data to.
         'reading_converter': function or callable to convert the format
@@ -38,16 +67,43 @@ class HttpPoster:
         'post_thread_count': number of post worker threads to start up.
         'post_time_file': name of the file to store the last time that
             a successful post occurred. (Unix timestamp).
+        'batch_max_readings': if greater than 0, queued items that are
+            dictionaries with a 'readings' list are merged into one post,
+            up to this number of readings.  Items are only merged if their
+            other keys and values (e.g. 'storeKey') are the same.  If 0,
+            each queued item is posted separately.
+        'batch_max_bytes': maximum size of the JSON encoded items merged
+            into one post.
+        'post_q_wal': if True, the queue database uses SQLite's write-ahead
+            log journal mode, which is faster.
+        'post_q_compact': if True, items with a list of (timestamp, name, value)
+            readings are stored in the queue in a compact binary format instead
+            of being pickled.  See sqlite_queue.
+        'gzip_level': if 1 - 9, the body of each post is gzip compressed at
+            this compression level and sent with a 'Content-Encoding: gzip'
+            header.  The server must accept compressed requests.  If 0, posts
+            are not compressed.
+        'name': the name of this poster in the runtime metrics.  Defaults to the
+            name of the queue file without its extension.
         """
         
         self.reading_converter = reading_converter
 
         # create the queue used to store the readings.
-        self.post_Q = sqlite_queue.SqliteReliableQueue(post_q_filename)
+        self.post_Q = sqlite_queue.SqliteReliableQueue(post_q_filename, wal=post_q_wal,
+                                                        compact=post_q_compact)
+
+        # report the size and age of the queue in the runtime metrics
+        if name is None:
+            name = os.path.splitext(os.path.basename(post_q_filename))[0]
+        self.name = name
+        queue_depth_metric.set_function(lambda: self.post_Q.unfinished_stats()[0], poster=name)
+        queue_age_metric.set_function(lambda: self.post_Q.unfinished_stats()[1], poster=name)
         
         # start the posting worker threads
         for i in range(post_thread_count):
-            PostWorker(self.post_Q, post_URL, post_time_file).start()
+            PostWorker(self.post_Q, post_URL, post_time_file,
+                       batch_max_readings, batch_max_bytes, gzip_level, name).start()
             
     def add_readings(self, reading_data):
         """Adds a set of readings to the posting queue.  The 'reading_data' 
@@ -60,6 +116,20 @@ class HttpPoster:
         else:
             self.post_Q.append(reading_data)
 
+    def add_readings_many(self, reading_data_list):
+        """Adds each set of readings in the list 'reading_data_list' to the posting
+        queue, in one transaction.  See add_readings().
+        """
+        if self.reading_converter:
+            reading_data_list = [self.reading_converter(rd) for rd in reading_data_list]
+        self.post_Q.append_many(reading_data_list)
+
+    def unposted(self):
+        """Returns the number of sets of readings in the posting queue that have
+        not been posted.
+        """
+        return self.post_Q.unfinished_stats()[0]
+
 
 class PostWorker(threading.Thread):
     """
@@ -69,12 +139,19 @@ class PostWorker(threading.Thread):
     Otherwise, this object will continue to try to repost the bad readings.
     """
 
-    def __init__ (self, source_Q, post_URL, post_time_file):
+    def __init__ (self, source_Q, post_URL, post_time_file,
+                  batch_max_readings=0, batch_max_bytes=1000000, gzip_level=0,
+                  name=''):
         """ Create the posting worker in its own thread.
         'sourceQ': the ReadingQueue to get postings from.
         'postURL': the URL to post to, w/o any parameters
         'post_time_file': the name of a file to record the time of 
              a successful post.
+        'batch_max_readings', 'batch_max_bytes': limits for merging
+             queued items into one post; see HttpPoster.
+        'gzip_level': compression level for the post body, 0 for no
+             compression; see HttpPoster.
+        'name': the name of the poster, used to label the runtime metrics.
         """  
         # run constructor of base class
         threading.Thread.__init__(self)
@@ -84,20 +161,89 @@ class PostWorker(threading.Thread):
         self.source_Q = source_Q
         self.post_URL = post_URL
         self.post_time_file = post_time_file
-       
-        
+        self.batch_max_readings = batch_max_readings
+        self.batch_max_bytes = batch_max_bytes
+        self.gzip_level = gzip_level
+        # not 'name', which is the name of the thread
+        self.poster_name = name
+
+        # the HTTP session used for all posts by this worker, created when the
+        # thread starts.  The session keeps connections to the server open between
+        # posts, avoiding a new TCP connection and TLS handshake for each post.
+        self.session = None
+
+        # items popped from the queue but not yet posted, as (q_id, item) tuples.
+        self.held_items = collections.deque()
+
+    def next_post(self):
+        """Pops the next item from the queue and, if batching is enabled, merges
+        following queued items into it.  Returns a list of the queue ids included
+        and the item to post.
+        """
+        if self.held_items:
+            q_id, item = self.held_items.popleft()
+        else:
+            q_id, item = self.source_Q.popleft()
+        q_ids = [q_id]
+
+        if self.batch_max_readings <= 0 or not mergeable(item):
+            return q_ids, item
+
+        n_readings = len(item['readings'])
+        n_bytes = len(json.dumps(item))
+        merged = None
+        while n_readings < self.batch_max_readings and n_bytes < self.batch_max_bytes:
+            if not self.held_items:
+                # pop a group of items in one transaction
+                self.held_items.extend(self.source_Q.pop_many(POP_GROUP_SIZE, sleep_wait=False))
+                if not self.held_items:
+                    break
+            next_id, next_item = self.held_items[0]
+            next_bytes = len(json.dumps(next_item))
+            if (not mergeable(next_item) or
+                    not same_except_readings(item, next_item) or
+                    n_readings + len(next_item['readings']) > self.batch_max_readings or
+                    n_bytes + next_bytes > self.batch_max_bytes):
+                # post this item next time
+                break
+            self.held_items.popleft()
+            if merged is None:
+                # copy so the original item is not altered
+                merged = dict(item, readings=list(item['readings']))
+            merged['readings'].extend(next_item['readings'])
+            q_ids.append(next_id)
+            n_readings += len(next_item['readings'])
+            n_bytes += next_bytes
+
+        return q_ids, merged or item
+
+    def compress(self, json_data):
+        """Returns the body and headers of the post for the JSON encoded bytes
+        'json_data'.  The body is gzip compressed if enabled.
+        """
+        if self.gzip_level:
+            return (gzip.compress(json_data, compresslevel=self.gzip_level),
+                    {'Content-Encoding': 'gzip'})
+        return json_data, {}
+
     def run(self):
-        
+
+        self.session = requests.Session()
+        # need to *not* verify SSL requests as Python 2.7.3 has an issue with
+        # requests SSL verification causing to fail when cert is actually OK.
+        self.session.verify = False
+
         while True:
 
             try:
-                # get the next list of readings to post.  the 'q_id' identifies
-                # this set of readings so it can be dropped from queue when 
-                # finished.
-                q_id, readings = self.source_Q.popleft()
+                # get the next list of readings to post.  the 'q_ids' identify
+                # the queue items in this set of readings so they can be dropped
+                # from queue when finished.
+                q_ids, readings = self.next_post()
                 
                 # encode these as json to put into the post
-                post_data = json.dumps(readings)
+                json_data = json.dumps(readings).encode('utf-8')
+                post_data, headers = self.compress(json_data)
             except:
                 logging.exception('Error popping or JSON Encoding readings to post.')
                 time.sleep(5)   # to limit rapid fire errors
@@ -106,17 +252,23 @@ class PostWorker(threading.Thread):
             retry_delay = 15  # start with a 15 second delay before retrying a post
             while True:
                 try:
-                    # need to *not* verify SSL requests as Python 2.7.3 has an issue with
-                    # requests SSL verification causing to fail when cert is actually OK.
-                    req = requests.post(self.post_URL, data=post_data, timeout=15, verify=False)
+                    start = time.time()
+                    req = self.session.post(self.post_URL, data=post_data, headers=headers, timeout=15)
+                    elapsed = time.time() - start
                     if req.status_code == 200:
+                        post_latency_metric.observe(elapsed, poster=self.poster_name)
+                        post_bytes_metric.observe(len(post_data), poster=self.poster_name)
+                        posts_metric.inc(poster=self.poster_name)
+                        if mergeable(readings):
+                            readings_posted_metric.inc(len(readings['readings']), poster=self.poster_name)
                         if logging.root.level == logging.DEBUG:
                             logging.debug('posted: %s, %s' % (readings, req.text))
                         else:
-                            logging.info('posted %d bytes' % len(post_data))
+                            logging.info('posted %d bytes (%d uncompressed) in %.3f s' %
+                                         (len(post_data), len(json_data), elapsed))
                         
-                        # tell the queue that this item is complete
-                        self.source_Q.finished(q_id)
+                        # tell the queue that these items are complete
+                        self.source_Q.finished_many(q_ids)
                         
                         # record the time of the post in the file ignoring
                         # errors (which might be caused by another worker writing
@@ -134,11 +286,51 @@ class PostWorker(threading.Thread):
                         raise Exception('Bad Post Status Code: %s' % req.status_code)
                         
                 except:
-                    logging.exception("Error posting: %s" % readings)
+                    # the readings of a merged post can be too large to log each retry
+                    logging.exception("Error posting %s" % post_summary(q_ids, readings))
+                    if logging.root.level == logging.DEBUG:
+                        logging.debug('readings not posted: %s' % readings)
+                    post_retries_metric.inc(poster=self.poster_name)
                     time.sleep(retry_delay)   # try again later
+                    backoff_metric.inc(retry_delay, poster=self.poster_name)
                     if retry_delay < 8 * 60:
                         retry_delay *= 2
 
+def mergeable(item):
+    """Returns True if the queue item 'item' is a dictionary with a 'readings'
+    list that can be merged with other items.
+    """
+    return isinstance(item, dict) and isinstance(item.get('readings'), list)
+
+
+def post_summary(q_ids, item):
+    """Returns a short description, for log messages, of the post of the queue
+    items with the ids 'q_ids', merged into 'item': the queue ids and, for items
+    with a 'readings' list, the number of readings and their range of timestamps.
+    """
+    if len(q_ids) > 1:
+        text = 'queue ids %s - %s (%d items)' % (q_ids[0], q_ids[-1], len(q_ids))
+    else:
+        text = 'queue id %s' % q_ids[0]
+    if mergeable(item):
+        readings = item['readings']
+        text += ', %d readings' % len(readings)
+        try:
+            timestamps = [reading[0] for reading in readings]
+            text += ', timestamps %s to %s' % (min(timestamps), max(timestamps))
+        except (TypeError, KeyError, IndexError, ValueError):
+            pass
+    return text
+
+
+def same_except_readings(item1, item2):
+    """Returns True if the dictionaries 'item1' and 'item2' have the same keys
+    and values, other than the 'readings' key.
+    """
+    return (item1.keys() == item2.keys() and
+            all(item1[k] == item2[k] for k in item1 if k != 'readings'))
+
+
 class BMSreadConverter:
     """Used to create the needed data structure for posting to the BMS application
     server.  Adds the 'storeKey' to a set of readings.
@@ -6,10 +6,24 @@ again.  'persistent' means saved to disk so items persist between runs of the
 process.
 Modified from the code presented at (reliability added):  
     http://flask.pocoo.org/snippets/88/
+
+The queue can optionally use SQLite's write-ahead log (WAL) journal mode, which
+lets readers and writers work concurrently and needs fewer disk syncs per
+transaction.  The append_many() and pop_many() methods add or remove many items in
+one transaction.  Threads waiting in popleft() or pop_many() for an item are woken
+as soon as an item is appended by another thread of the same process.
+
+Items are normally stored in pickle format.  Optionally, items holding a list of
+(timestamp, sensor name, value) readings, as queued by the BMON poster, are stored
+in a compact binary format: each sensor name is stored once in a 'names' table
+and referred to by its id, and the timestamps, name ids and values are stored as
+packed arrays.  Pickled items can always be read, so the compact format can be
+turned on for a queue that already holds items.
 """
-import os, sqlite3
+import os, sqlite3, struct, sys, threading, time
+from array import array
+from itertools import chain, groupby, repeat
 from pickle import loads, dumps
-from time import sleep
 try:
     from _thread import get_ident
 except ImportError:
@@ -23,59 +37,116 @@ class SqliteReliableQueue(object):
             'CREATE TABLE IF NOT EXISTS queue ' 
             '('
             '  id INTEGER PRIMARY KEY AUTOINCREMENT,'
-            '  item BLOB'
+            '  item BLOB,'
+            '  added REAL'
             ')'
             )
     _create_processing = (
             'CREATE TABLE IF NOT EXISTS processing ' 
             '('
             '  id INTEGER PRIMARY KEY,'
-            '  item BLOB'
+            '  item BLOB,'
+            '  added REAL'
             ')'
             )
     _count = 'SELECT COUNT(*) FROM queue'
     _iterate = 'SELECT id, item FROM queue'
-    _append = 'INSERT INTO queue (item) VALUES (?)'
+    _append = 'INSERT INTO queue (item, added) VALUES (?, ?)'
+    _restore = 'INSERT INTO queue (id, item, added) VALUES (?, ?, ?)'
     _write_lock = 'BEGIN IMMEDIATE'
-    _popleft_get = (
-            'SELECT id, item FROM queue '
-            'ORDER BY id LIMIT 1'
+    _pop_many_get = (
+            'SELECT id, item, added FROM queue '
+            'ORDER BY id LIMIT ?'
             )
-    _popleft_del = 'DELETE FROM queue WHERE id = ?'
+    _pop_many_del = 'DELETE FROM queue WHERE id <= ?'
     _peek = (
             'SELECT item FROM queue '
             'ORDER BY id LIMIT 1'
             )
-    _processing_append = 'INSERT INTO processing (id, item) VALUES (?, ?)'
+    _processing_append = 'INSERT INTO processing (id, item, added) VALUES (?, ?, ?)'
     _processing_del = 'DELETE FROM processing WHERE id = ?'
     _processing_clear = 'DELETE FROM processing'
     _processing_iterate = 'SELECT id, item FROM processing'
+    _processing_restore = 'SELECT id, item, added FROM processing'
+    _unfinished = (
+            'SELECT COUNT(*), MIN(added) FROM ('
+            '  SELECT added FROM queue UNION ALL SELECT added FROM processing'
+            ')'
+            )
+    _create_names = (
+            'CREATE TABLE IF NOT EXISTS names '
+            '('
+            '  id INTEGER PRIMARY KEY,'
+            '  name TEXT UNIQUE'
+            ')'
+            )
+    _names_iterate = 'SELECT id, name FROM names'
+    _names_add = 'INSERT OR IGNORE INTO names (name) VALUES (?)'
+    _names_get = 'SELECT id FROM names WHERE name = ?'
 
-    def __init__(self, path):
+    # Start of an item in the compact format.  Pickled items start with the
+    # pickle protocol marker, b'\x80'.
+    _compact_magic = b'CQ\x01'
+    # number of readings, number of timestamp runs, and length of the pickled
+    # item without its readings
+    _compact_header = struct.Struct('<III')
+
+    def __init__(self, path, wal=False, compact=False):
+        """'path' is the path to the SQLite database file holding the queue.  If
+        'wal' is True, the database uses the write-ahead log journal mode.  If
+        'compact' is True, items with a list of readings are stored in the compact
+        format described above; other items are pickled.
+        """
         self.path = os.path.abspath(path)
+        self.compact = compact
         self._connection_cache = {}
+
+        # maps sensor names to their ids in the 'names' table and back again.
+        self._name_ids = {}
+        self._names = {}
+        self._names_lock = threading.Lock()
+
+        # Used to wake threads waiting for an item.  '_append_count' is incremented
+        # each time items are appended, so a waiting thread can tell whether an
+        # item arrived after it last looked at the queue.
+        self._item_added = threading.Condition()
+        self._append_count = 0
+
+        if wal:
+            self._get_conn().execute('PRAGMA journal_mode=WAL')
+
         with self._get_conn() as conn:
             # if queue and processing tables do not exist, create them
             conn.execute(self._create_queue)
             conn.execute(self._create_processing)
+            conn.execute(self._create_names)
+
+            # queues made by earlier versions do not record when items were added.
+            for table in ('queue', 'processing'):
+                cols = [row[1] for row in conn.execute('PRAGMA table_info(%s)' % table)]
+                if 'added' not in cols:
+                    conn.execute('ALTER TABLE %s ADD COLUMN added REAL' % table)
 
             # transfer any entries from the processing list back into the
-            # queue and clear the processing list.
-            for id, obj_buffer in conn.execute(self._processing_iterate):
+            # queue and clear the processing list.  The entries keep their
+            # original ids, which are lower than the ids of the items still in
+            # the queue, so they are at the front of the queue in their original
+            # order.
+            for row in conn.execute(self._processing_restore).fetchall():
                 # append method does not work here, perhaps due to running
                 # a second 'with' statement.  Use direct SQL statemen instead.
-                conn.execute(self._append, (obj_buffer,))
+                conn.execute(self._restore, row)
             conn.execute(self._processing_clear)
 
     def __len__(self):
         with self._get_conn() as conn:
-            l = conn.execute(self._count).next()[0]
+            l = next(conn.execute(self._count))[0]
         return l
 
     def __iter__(self):
         with self._get_conn() as conn:
             for id, obj_buffer in conn.execute(self._iterate):
-                yield loads(obj_buffer)
+                yield self._decode(obj_buffer)
 
     def __str__(self):
         res = 'Queue:\n'
@@ -95,42 +166,186 @@ class SqliteReliableQueue(object):
             self._connection_cache[id] = sqlite3.Connection(self.path, 
                     timeout=60)
         return self._connection_cache[id]
-    
+
+    def _encode(self, obj):
+        """Returns the item 'obj' encoded for storage in the queue.  If compact
+        storage is enabled and 'obj' is a dictionary with a 'readings' list of
+        (int timestamp, str name, float value) readings, the compact format is used;
+        otherwise 'obj' is pickled.  Numbers other than floats among the values
+        after the first record are stored, and decoded, as floats.
+        """
+        if self.compact and isinstance(obj, dict) and isinstance(obj.get('readings'), list):
+            readings = obj['readings']
+            try:
+                ts, names, vals = zip(*readings) if readings else ((), (), ())
+                # Readings are made a record at a time, so timestamps come in
+                # runs of the same value.  Store each run's timestamp and length.
+                run_ts = []
+                run_lens = []
+                for t, run in groupby(ts):
+                    run_ts.append(t)
+                    run_lens.append(len(list(run)))
+                # The types are not checked reading by reading, which is slow.  The
+                # 'q' and 'd' arrays reject timestamps that are not integers and
+                # values that are not numbers, and _intern() rejects names that are
+                # not strings.  Only the values of the first record are checked for
+                # floats, so items of integer values stay pickled.
+                n_first = run_lens[0] if run_lens else 0
+                if set(map(type, vals[:n_first])) <= {float}:
+                    # The records usually have the same names, in the same order, so
+                    # the names of the first record are looked up and repeated.
+                    first = names[:n_first]
+                    if names == first * len(run_lens):
+                        name_ids = self._intern(first) * len(run_lens)
+                    else:
+                        name_ids = self._intern(names)
+                    arrays = (array('q', run_ts), array('I', run_lens), name_ids,
+                              array('d', vals))
+                    if sys.byteorder == 'big':
+                        for arr in arrays:
+                            arr.byteswap()
+                    rest = dumps(dict((k, v) for k, v in obj.items() if k != 'readings'), 2)
+                    return b''.join((self._compact_magic,
+                                     self._compact_header.pack(len(vals), len(run_ts), len(rest)),
+                                     rest) + tuple(arr.tobytes() for arr in arrays))
+            except (ValueError, TypeError, OverflowError):
+                # readings are not all 3 element sequences, or a timestamp does not
+                # fit in 64 bits.
+                pass
+        return dumps(obj, 2)
+
+    def _decode(self, obj_buffer):
+        """Returns the item stored as 'obj_buffer', which is either pickled or in
+        the compact format.
+        """
+        obj_buffer = bytes(obj_buffer)
+        if not obj_buffer.startswith(self._compact_magic):
+            return loads(obj_buffer)
+
+        pos = len(self._compact_magic)
+        n, n_runs, rest_len = self._compact_header.unpack_from(obj_buffer, pos)
+        pos += self._compact_header.size
+        obj = loads(obj_buffer[pos:pos + rest_len])
+        pos += rest_len
+        arrays = []
+        for typecode, length in (('q', n_runs), ('I', n_runs), ('I', n), ('d', n)):
+            arr = array(typecode)
+            end = pos + length * arr.itemsize
+            arr.frombytes(obj_buffer[pos:end])
+            if sys.byteorder == 'big':
+                arr.byteswap()
+            arrays.append(arr)
+            pos = end
+        run_ts, run_lens, name_ids, vals = arrays
+        names = self._names
+        if not names.keys() >= set(name_ids):
+            # names added by another process
+            names = self._load_names()
+        ts = chain.from_iterable(map(repeat, run_ts, run_lens))
+        obj['readings'] = list(zip(ts, map(names.__getitem__, name_ids), vals.tolist()))
+        return obj
+
+    def _intern(self, names):
+        """Returns an array of the ids in the 'names' table of the sensor names in
+        'names', adding names not yet in the table.  Raises TypeError if a name
+        that is not in the table is not a string.
+        """
+        name_ids = self._name_ids
+        try:
+            return array('I', map(name_ids.__getitem__, names))
+        except KeyError:
+            pass
+        with self._names_lock:
+            with self._get_conn() as conn:
+                new_names = set(names).difference(name_ids)
+                if not all(isinstance(nm, str) for nm in new_names):
+                    raise TypeError('Sensor names must be strings.')
+                for nm in new_names:
+                    conn.execute(self._names_add, (nm,))
+                    id = next(conn.execute(self._names_get, (nm,)))[0]
+                    self._name_ids[nm] = id
+                    self._names[id] = nm
+        return array('I', map(name_ids.__getitem__, names))
+
+    def _load_names(self):
+        """Reads the 'names' table into the name caches and returns the mapping
+        of ids to names.
+        """
+        with self._names_lock:
+            for id, nm in self._get_conn().execute(self._names_iterate):
+                self._name_ids[nm] = id
+                self._names[id] = nm
+        return self._names
+
     def append(self, obj):
         """Adds an item to the queue.
         """
-        obj_pkl = dumps(obj, 2)
+        obj_pkl = self._encode(obj)
         with self._get_conn() as conn:
-            conn.execute(self._append, (obj_pkl,))
+            conn.execute(self._append, (obj_pkl, time.time()))
             # the 'with' statement commits the insert.
+        self._notify()
+
+    def append_many(self, objs):
+        """Adds each item in the iterable 'objs' to the queue, in one transaction.
+        """
+        now = time.time()
+        obj_pkls = [(self._encode(obj), now) for obj in objs]
+        with self._get_conn() as conn:
+            conn.executemany(self._append, obj_pkls)
+        self._notify()
+
+    def _notify(self):
+        """Wakes the threads waiting for an item to be added to the queue.
+        """
+        with self._item_added:
+            self._append_count += 1
+            self._item_added.notify_all()
 
     def popleft(self, sleep_wait=True):
-        keep_pooling = True
+        """Removes the next item from the queue and returns an (id, item) tuple.
+        The item is held in the 'processing' list until finished() is called with
+        the 'id'.  If the queue is empty and 'sleep_wait' is True, waits for an item;
+        otherwise (None, None) is returned.
+        """
+        items = self.pop_many(1, sleep_wait)
+        if items:
+            return items[0]
+        return None, None
+
+    def pop_many(self, max_items, sleep_wait=True):
+        """Removes up to 'max_items' items from the front of the queue in one
+        transaction, and returns a list of (id, item) tuples.  The items are held in
+        the 'processing' list until finished() or finished_many() is called.  If the
+        queue is empty and 'sleep_wait' is True, waits for an item to be added;
+        otherwise an empty list is returned.
+        """
         wait = 0.5       # initial wait time for new queue items
         max_wait = 5.0   # seconds of maximum wait for item in queue
         tries = 0
         with self._get_conn() as conn:
-            id = None
-            while keep_pooling:
+            while True:
+                seen_count = self._append_count
                 # need to make sure another thread does not pop the same item.
                 conn.execute(self._write_lock)
-                cursor = conn.execute(self._popleft_get)
-                try:
-                    id, obj_buffer = next(cursor)
-                    keep_pooling = False
-                except StopIteration:
-                    conn.commit() # unlock the database
-                    if not sleep_wait:
-                        keep_pooling = False
-                        continue
-                    tries += 1
-                    sleep(wait)
-                    wait = min(max_wait, tries/2.0 + wait)
-            if id:
-                conn.execute(self._popleft_del, (id,))
-                conn.execute(self._processing_append, (id, obj_buffer))
-                return id, loads(obj_buffer)
-        return None, None
+                rows = conn.execute(self._pop_many_get, (max_items,)).fetchall()
+                if rows:
+                    break
+                conn.commit() # unlock the database
+                if not sleep_wait:
+                    return []
+                # wait for an item to be appended by this process or, as another
+                # process may append items, until the wait time expires.
+                tries += 1
+                with self._item_added:
+                    if self._append_count == seen_count:
+                        self._item_added.wait(wait)
+                wait = min(max_wait, tries/2.0 + wait)
+
+            # the rows are the lowest ids in the queue.
+            conn.execute(self._pop_many_del, (rows[-1][0],))
+            conn.executemany(self._processing_append, rows)
+            return [(id, self._decode(obj_buffer)) for id, obj_buffer, added in rows]
 
     def peek(self):
         """Returns next item in queue but does not remove if from the queue.
@@ -138,7 +353,7 @@ class SqliteReliableQueue(object):
         with self._get_conn() as conn:
             cursor = conn.execute(self._peek)
             try:
-                return loads(cursor.next()[0])
+                return self._decode(next(cursor)[0])
             except StopIteration:
                 return None
                 
@@ -149,10 +364,43 @@ class SqliteReliableQueue(object):
         with self._get_conn() as conn:
             conn.execute(self._processing_del, (id,))
             
+    def finished_many(self, ids):
+        """Call when finished processing a number of items.  Deletes the items
+        with the id #'s in the iterable 'ids' from the 'processing' list in one
+        transaction.
+        """
+        with self._get_conn() as conn:
+            conn.executemany(self._processing_del, [(id,) for id in ids])
+
+    def unfinished_stats(self):
+        """Returns the number of items that are not finished, whether in the queue
+        or in the 'processing' list, and the age in seconds of the oldest of them.
+        The age is 0 if there are no unfinished items.  A separate connection to
+        the database is used, so this can be called from any thread.
+        """
+        conn = sqlite3.Connection(self.path, timeout=60)
+        try:
+            count, oldest = next(conn.execute(self._unfinished))
+        finally:
+            conn.close()
+        age = time.time() - oldest if oldest is not None else 0.0
+        return count, age
+
+    def used_bytes(self):
+        """Returns the number of bytes of the database file in use, not counting
+        free pages left by items that were removed.  The file does not shrink when
+        items are removed, so this measures the size of the queue's contents.
+        """
+        conn = self._get_conn()
+        page_count = next(conn.execute('PRAGMA page_count'))[0]
+        free_count = next(conn.execute('PRAGMA freelist_count'))[0]
+        page_size = next(conn.execute('PRAGMA page_size'))[0]
+        return (page_count - free_count) * page_size
+
     def iter_processing(self):
         """Iterator returning items from the processing list.
         """
         with self._get_conn() as conn:
             for id, obj_buffer in conn.execute(self._processing_iterate):
-                yield loads(obj_buffer)
+                yield self._decode(obj_buffer)
         
\ No newline at end of file
@@ -5,25 +5,34 @@ package (see https://github.com/alanmitchell/bmon).
 
 Usage:
 
-    csv_transfer.py CONFIG_FILE
+    csv_transfer.py CONFIG_FILE [--backfill]
 
 where CONFIG_FILE is the full path name of the script's configuration file,
-See README.md for more details.
+See README.md for more details.  With --backfill, the files are read once in a
+mode tuned for loading a large archive of historical files, and the script exits
+once the records have been posted.
 """
 
+import fnmatch
 import glob
+import importlib
+import inspect
 import logging
 import logging.handlers
 import os
-import pickle
-
+import signal
 import sys
+import threading
 import time
 import yaml
 
-import consumers.bmon_poster
-import readers.generic
-import readers.siemens
+import consumers.dispatch
+import metrics
+import readers.chunk
+import readers.reader_util
+import stages.cov
+import stages.resample
+import state_store
 
 # The full directory path to this script file
 APP_PATH = os.path.realpath(os.path.dirname(__file__))
@@ -55,6 +64,17 @@ logging.root.addHandler(console_h)
 
 # -------------------
 
+
+def load_object(name):
+    """Returns the object with the full dotted name 'name', such as
+    'readers.generic.generic_reader', importing its module if it has not been
+    imported.  The readers and consumers are loaded this way, so that only those
+    used by the configuration file are imported, which shortens startup.
+    """
+    module_name, _, attr = name.rpartition('.')
+    return getattr(importlib.import_module(module_name), attr)
+
+
 try:
     # configuration file name, 1st command line argument
     config_fn = sys.argv[1]
@@ -64,6 +84,9 @@ try:
 
     config = yaml.load(open(config_fn), yaml.Loader)
 
+    # True to load the files once in backfill mode; see run_backfill().
+    backfill = '--backfill' in sys.argv[2:]
+
 except:
     logging.exception('Error in Reading Configuration File.')
     sys.exit()
@@ -74,28 +97,131 @@ try:
     # defaults to INFO if a bad entry in the config file.
     logging.root.setLevel(getattr(logging, config['logging_level'].upper(), 20))
 
-    # load the times of the last record loaded for each file
-    # The keys of the dictionary are file names and the values
-    # are the Unix timestamp of the last record loaded.
-    # This is file is in Python pickle format, and it is named
-    # the same as the config file, except with a 'last_ts' extension.
-    last_ts_fn = '%s.last_ts' % config_fn
-    if os.path.exists(last_ts_fn):
-        last_ts_map = pickle.load(open(last_ts_fn, 'rb'))
-    else:
-        last_ts_map = {}
+    # Open the store holding the state of each file: the Unix timestamp of the
+    # last record loaded, the resume point that allows the file readers to skip
+    # directly to data appended since the last pass, and the modification time,
+    # size and inode of the file when it was last read.  The store is a SQLite
+    # database named the same as the config file, except with a 'state' extension.
+    state = state_store.StateStore('%s.state' % config_fn)
+    # import the state saved by earlier versions in Python pickle format, in
+    # files with 'last_ts' and 'resume' extensions, unless that was already done.
+    n = state.import_pickles('%s.last_ts' % config_fn, '%s.resume' % config_fn)
+    if n:
+        logging.info('Imported the state of %d files from the last_ts file.' % n)
+
+    # If requested, start a pool of processes to read files in parallel.  This
+    # must be done before the consumers start any threads.
+    reader_pool = None
+    if config.get('reader_processes', 0) > 1 and not backfill:
+        try:
+            import readers.pool
+            reader_pool = readers.pool.ReaderPool(config['reader_processes'],
+                                                  config.get('reader_queue_chunks', 100))
+        except:
+            logging.exception('Error starting the reader process pool; files will be read serially.')
+
+    # If requested, start the worker processes that parse byte ranges of large
+    # files with the 'split' file type.  This must also be done before the
+    # consumers start any threads.
+    if config.get('split_processes', 0) > 1:
+        try:
+            import readers.split
+            readers.split.start_workers(config['split_processes'])
+        except:
+            logging.exception('Error starting the split reader processes; files will be read serially.')
+
+    # If requested, serve the runtime metrics in the Prometheus text format
+    # and periodically write them to a stats file.
+    if config.get('metrics_port'):
+        try:
+            metrics.MetricsServer(config['metrics_port'], config.get('metrics_host', '127.0.0.1'))
+        except:
+            logging.exception('Error starting the metrics server.')
+    if config.get('stats_file'):
+        metrics.StatsFileWriter(config['stats_file'], config.get('stats_interval', 60)).start()
+
+    # If requested, watch the directories holding the CSV files so that changed
+    # files are processed as soon as they are written.
+    watcher = None
+    if config.get('watch', False) and not backfill:
+        try:
+            import file_watcher
+            watcher = file_watcher.DirWatcher()
+        except:
+            logging.exception('Unable to watch directories; polling every check_interval instead.')
+
+    # The stages that records pass through, in order, before they are delivered
+    # to the consumers, such as filters that drop unchanged readings.  This
+    # dictionary maps 'stage_type' to the class that implements the stage.
+    stage_type_to_class = {'cov': stages.cov.CovFilter}
+    record_stages = []
+    for i, stage in enumerate(config.get('stages', [])):
+
+        try:
+            stage = stage.copy()
+            stage_type = stage.pop('type')
+            stage_obj = stage_type_to_class[stage_type](**stage)
+            # restore the state of the stage saved in the state store
+            stage_obj.state_key = 'stage-%d-%s' % (i, stage_type)
+            if hasattr(stage_obj, 'set_state'):
+                saved = state.get_blob(stage_obj.state_key)
+                if saved is not None:
+                    stage_obj.set_state(saved)
+            record_stages.append(stage_obj)
+
+        except:
+            logging.exception('Error starting the Stage %s' % stage)
+
+    # Stages that apply to the records of one file spec, which run before the
+    # stages above.  This dictionary maps the 'file_glob' of the spec to the
+    # list of its stages.
+    spec_stages = {}
+    for spec in config['csv_files']:
+
+        try:
+            if 'resample' in spec:
+                stage_obj = stages.resample.Resampler(**spec['resample'])
+                stage_obj.state_key = 'resample-%s' % spec['file_glob']
+                saved = state.get_blob(stage_obj.state_key)
+                if saved is not None:
+                    stage_obj.set_state(saved)
+                spec_stages[spec['file_glob']] = [stage_obj]
+
+        except:
+            logging.exception('Error starting the resample stage of file spec %s' % spec)
 
     targets = []
-    # This dictionary maps 'consumer_type' to the class that implements
-    # the consumer.
-    consumer_type_to_class = {'bmon': consumers.bmon_poster.BMONposter}
+    # This dictionary maps 'consumer_type' to the full name of the class that
+    # implements the consumer.  The module is imported when the consumer is used.
+    consumer_type_to_class = {'bmon': 'consumers.bmon_poster.BMONposter',
+                              'archive': 'consumers.archive.ArchiveWriter'}
 
     for consumer in config['consumers']:
 
         try:
             consumer_type = consumer.pop('type', 'bmon')
-            consumer_class = consumer_type_to_class[consumer_type]
-            targets.append(consumer_class(**consumer))
+            buffer_readings = consumer.pop('buffer_readings', 0)
+            if backfill and consumer_type == 'bmon':
+                # Post in large batches, with up to 'backfill_posts' posts in
+                # progress at once, each from its own lane.  The poster changes
+                # its number of lanes only once its queues are empty, so the
+                # readings of each sensor are still posted in order.  Pause
+                # reading files when the posting queues reach 'backfill_queue_mb'.
+                lanes = max(consumer.get('lanes', 1), config.get('backfill_posts', 4))
+                if lanes != consumer.get('lanes', 1):
+                    logging.info('Backfill posts with %d lanes, instead of %d, for the poster %s.' %
+                                 (lanes, consumer.get('lanes', 1), consumer.get('poster_id')))
+                consumer['lanes'] = lanes
+                consumer['batch_max_readings'] = (consumer.get('batch_max_readings') or
+                                                  config.get('backfill_batch_readings', 10000))
+                consumer['max_queue_mb'] = (consumer.get('max_queue_mb') or
+                                            config.get('backfill_queue_mb', 200))
+            consumer_class = load_object(consumer_type_to_class[consumer_type])
+            target = consumer_class(**consumer)
+            if buffer_readings:
+                # run the consumer in its own thread, behind a bounded buffer
+                target = consumers.dispatch.Dispatcher(target, buffer_readings, consumer_type)
+            targets.append(target)
 
         except:
             logging.exception('Error starting the Consumer %s' % consumer)
@@ -104,72 +230,541 @@ except:
     logging.exception('Error in Script Initialization.')
     sys.exit()
 
-# This dictionary maps 'file_type' to a generator function that is used
-# to read the file.
-file_type_to_func = {'generic': readers.generic.generic_reader,
-                       'siemens': readers.siemens.siemens_reader}
+# This dictionary maps 'file_type' to the full name of the generator function
+# that is used to read the file.  The module is imported when the file type is used.
+file_type_to_func = {'generic': 'readers.generic.generic_reader',
+                     'siemens': 'readers.siemens.siemens_reader',
+                     'columnar': 'readers.columnar.columnar_reader',
+                     'split': 'readers.split.split_reader'}
+
+# Runtime metrics for the files read, labeled by the 'file_glob' of the file spec.
+rows_read_metric = metrics.counter('csv_transfer_rows_read_total', 'Data rows read from files.')
+rows_dropped_metric = metrics.counter('csv_transfer_rows_dropped_total',
+                                      'Data rows that did not produce a record.')
+parse_errors_metric = metrics.counter('csv_transfer_parse_errors_total',
+                                      'Errors processing rows, or files that could not be read.')
+bytes_read_metric = metrics.counter('csv_transfer_bytes_read_total', 'Bytes read from files.')
+records_metric = metrics.counter('csv_transfer_records_delivered_total',
+                                 'Records delivered to the consumers.')
+files_read_metric = metrics.counter('csv_transfer_files_read_total', 'Files read.')
+read_time_metric = metrics.histogram('csv_transfer_file_read_seconds',
+                                     'Time spent by the reader on each file read, '
+                                     'not including delivering the records.',
+                                     [0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300])
+
+
+# The 'file_glob' of the file specs with a 'time_ordered' setting that their file type
+# does not support, so the warning is logged once.
+time_ordered_warned = set()
+
+
+def file_jobs(changed=None):
+    """Generator that yields a (filename, reader_func, spec, min_ts, file_pattern, st)
+    tuple for each file that may have new records.  'reader_func' is the file reader
+    function, 'spec' holds the keyword arguments for the reader, 'min_ts' is the
+    timestamp that records must be newer than, 'file_pattern' is the 'file_glob'
+    of the file spec, and 'st' is the os.stat() result for the file, or for the zip
+    archive holding it.  Files that have not changed since they were last read are
+    skipped without opening them.  If 'changed' is a set of file paths, only those
+    files are considered, instead of all the files matching each 'file_glob'.
+    """
+    # Loop through each file spec
+    for spec_orig in config['csv_files']:
+
+        # make a copy of the spec so it can be modified without
+        # affecting the original
+        spec = spec_orig.copy()
+
+        try:
+            # get and remove key items from the file spec
+            file_pattern = spec.pop('file_glob')
+            file_type = spec.pop('file_type', 'generic')
+            spec.pop('resample', None)
+            # for files in time order, the reader skips the rows that are not new
+            # with a binary search when there is no resume point.
+            time_ordered = spec.pop('time_ordered', False)
+            reader_func = load_object(file_type_to_func[file_type])
+            if time_ordered and 'skip_to_ts' not in inspect.signature(reader_func).parameters:
+                if file_pattern not in time_ordered_warned:
+                    logging.warning("The '%s' file type does not support 'time_ordered'; it is "
+                                    "ignored for the files %s." % (file_type, file_pattern))
+                    time_ordered_warned.add(file_pattern)
+                time_ordered = False
+            # a 'file_glob' of the form "archives*.zip::member_glob" reads the
+            # members of zip archives.
+            archive_pattern, _, member_pattern = file_pattern.partition(readers.reader_util.ARCHIVE_SEP)
+            if changed is None:
+                paths = glob.glob(archive_pattern)
+            else:
+                paths = [fn for fn in changed if glob_match(fn, archive_pattern)]
+            for path in paths:
+
+                try:
+                    st = os.stat(path)
+                    if member_pattern:
+                        # the archive's state applies to each of its members
+                        file_names = readers.reader_util.archive_members(path, member_pattern)
+                    else:
+                        file_names = [path]
+                except:
+                    logging.exception('Error processing file: %s' % path)
+                    parse_errors_metric.inc(spec=file_pattern)
+                    continue
+
+                for fn in file_names:
+
+                    # Files and records must be newer than this timestamp
+                    min_ts = state.last_ts(fn)
+
+                    # don't process the file if its modification time, size and
+                    # inode are the same as when it was last read.  This also keeps
+                    # compressed files and archives from being decompressed again.
+                    if state.unchanged(fn, st):
+                        continue
+
+                    # get the Unix timestamp indicating when file was last modified,
+                    # and don't process if this file was modified prior to last record
+                    # stored.
+                    mod_time = st.st_mtime
+                    if mod_time <= min_ts:
+                        continue
+
+                    if time_ordered:
+                        yield fn, reader_func, dict(spec, skip_to_ts=min_ts), min_ts, file_pattern, st
+                    else:
+                        yield fn, reader_func, spec, min_ts, file_pattern, st
+
+        except Exception:
+            # not a bare except, which would catch the GeneratorExit raised at the
+            # yield above when a pass through the files stops early.
+            logging.exception('Error processing file spec %s' % spec)
+
+
+def glob_match(fn, file_pattern):
+    """Returns True if the path 'fn' would be returned by glob.glob(file_pattern).
+    'fn' must be in a directory matching the directory portion of 'file_pattern'.
+    """
+    name = os.path.basename(fn)
+    if name.startswith('.') and not os.path.basename(file_pattern).startswith('.'):
+        # glob does not match hidden files with wildcards
+        return False
+    return fnmatch.fnmatchcase(fn, file_pattern)
+
+
+def watched_dirs():
+    """Returns the set of directories holding the files matched by each 'file_glob'.
+    """
+    dirs = set()
+    for spec in config['csv_files']:
+        archive_pattern = spec['file_glob'].partition(readers.reader_util.ARCHIVE_SEP)[0]
+        dir_pattern = os.path.dirname(archive_pattern)
+        if dir_pattern:
+            dirs.update(d for d in glob.glob(dir_pattern) if os.path.isdir(d))
+        else:
+            dirs.add('')
+    return dirs
+
+
+def record_file_stats(file_pattern, stats):
+    """Adds the statistics of one read of a file, from the file spec with the
+    'file_glob' of 'file_pattern', to the runtime metrics.  'stats' is the
+    dictionary of statistics collected by the reader, plus 'read_seconds', the
+    time spent reading, and 'error', True if the read stopped because of an error.
+    """
+    rows_read_metric.inc(stats.get('rows_read', 0), spec=file_pattern)
+    rows_dropped_metric.inc(stats.get('rows_dropped', 0), spec=file_pattern)
+    parse_errors_metric.inc(stats.get('parse_errors', 0) + stats.get('error', 0), spec=file_pattern)
+    bytes_read_metric.inc(stats.get('bytes_read', 0), spec=file_pattern)
+    files_read_metric.inc(spec=file_pattern)
+    read_time_metric.observe(stats.get('read_seconds', 0.0), spec=file_pattern)
+
+
+def deliver(recs, min_ts, chunk_stages):
+    """Passes the records 'recs' newer than 'min_ts' through the stages in the list
+    'chunk_stages' and delivers them to the consumers.  Returns the number of
+    records delivered.
+    """
+    if isinstance(recs, readers.chunk.RecordChunk):
+        # A compact chunk.  Filter down to just records past min_ts, and pass
+        # them through the stages.  Consumers that don't accept compact chunks
+        # are passed a list of records.
+        chunk = recs.after(min_ts)
+        for stage in chunk_stages:
+            chunk = stage(chunk)
+        recs_filtered = None
+        # the stages may have removed all of the records
+        for consumer in targets if len(chunk) else []:
+            if getattr(consumer, 'accepts_chunks', False):
+                consumer(chunk)
+            else:
+                if recs_filtered is None:
+                    recs_filtered = chunk.records()
+                consumer(recs_filtered)
+        n_recs = len(chunk)
+
+    else:
+        # readers yield a lone record if the chunk size is 1
+        if isinstance(recs, dict):
+            recs = [recs]
+
+        # filter down to just records past min_ts
+        recs_filtered = [rec for rec in recs if rec['ts'] > min_ts]
+        for stage in chunk_stages:
+            recs_filtered = stage(recs_filtered)
+        for consumer in targets if recs_filtered else []:
+            consumer(recs_filtered)
+        n_recs = len(recs_filtered)
+
+    return n_recs
+
+
+def handle_chunk(fn, recs, last_ts, resume, min_ts, file_pattern):
+    """Delivers a chunk of records read from the file 'fn' to the consumers and
+    then records the progress through the file.  'last_ts' is the timestamp of the
+    last record in the chunk, 'resume' is the resume point after the chunk, and
+    only records newer than 'min_ts' are delivered.  The records pass through the
+    stages of the file spec with the 'file_glob' of 'file_pattern', and then the
+    stages that apply to all records.  Returns the number of records delivered.
+    Raises consumers.dispatch.ConsumerFull, without delivering the records or
+    recording progress, if a consumer can't accept more records.
+    """
+    chunk_stages = spec_stages.get(file_pattern, []) + record_stages
+
+    # Don't deliver records if a consumer can't accept them.  The records will
+    # be read again once the consumer has caught up.
+    for consumer in targets:
+        if hasattr(consumer, 'full') and consumer.full():
+            raise consumers.dispatch.ConsumerFull('A Consumer is full; reading of files is paused.')
+
+    if last_ts <= min_ts:
+        state.update(fn, resume=resume)
+        return 0
+
+    # The stages change their state as records pass through them, so undo the
+    # changes if the records aren't delivered, as they will be read again.
+    try:
+        n_recs = deliver(recs, min_ts, chunk_stages)
+    except:
+        for stage in chunk_stages:
+            if hasattr(stage, 'rollback'):
+                stage.rollback()
+        raise
+    for stage in chunk_stages:
+        if hasattr(stage, 'commit'):
+            stage.commit()
+
+    state.update(fn, last_ts=last_ts, resume=resume)
+    return n_recs
+
+
+def process_files_serially(changed=None, spec_override=None, progress_seconds=0, stop=None):
+    """Reads each file with new records and delivers the records, one file at a time.
+    'changed' is described in file_jobs().  The items of the dictionary
+    'spec_override' replace those of each file spec.  If 'progress_seconds' is
+    greater than 0, the progress through each file is logged, and the state of the
+    files is saved, this often and when the file is finished.  If the
+    threading.Event 'stop' is set, KeyboardInterrupt is raised once the chunk of
+    records being delivered has been handed off.  Returns True if reading stopped
+    because a consumer can't accept more records.
+    """
+    for fn, reader_func, spec, min_ts, file_pattern, st in file_jobs(changed):
+        if spec_override:
+            spec = dict(spec, **spec_override)
+        stats = {'error': False}
+        start = time.perf_counter()
+        next_progress = start + progress_seconds
+        deliver_time = 0.0      # time spent delivering records, not reading
+        recs_processed = 0
+        try:
+            # the reader updates this copy of the resume point as it reads,
+            # and it is saved once the records read have been handed off.
+            resume = state.resume(fn)
+
+            for recs, last_ts in reader_func(fn, resume=resume, stats=stats, **spec):
+                deliver_start = time.perf_counter()
+                recs_processed += handle_chunk(fn, recs, last_ts, resume.copy(), min_ts,
+                                               file_pattern)
+                if stop is not None and stop.is_set():
+                    raise KeyboardInterrupt
+                if progress_seconds and deliver_start >= next_progress:
+                    log_progress(fn, stats, recs_processed, deliver_start - start, st.st_size)
+                    if not save_state():
+                        # the progress was returned to where it was last saved, so
+                        # stop here and read the rest of the file on a later pass.
+                        raise RuntimeError('Stopped reading after records were not delivered.')
+                    next_progress = time.perf_counter() + progress_seconds
+                deliver_time += time.perf_counter() - deliver_start
+            if recs_processed:
+                logging.info('%s records processed for file %s' % (recs_processed, fn))
+
+            # the whole file was read, so it can be skipped until it changes.
+            state.update(fn, st=st)
+
+        except consumers.dispatch.ConsumerFull as e:
+            # stop this pass through the files; the rest of this file and the
+            # other files are read on a later pass.
+            logging.warning('%s  Stopped reading at file %s.' % (e, fn))
+            stats['error'] = True
+            paused = True
+
+        except Exception:
+            # KeyboardInterrupt is left to stop a backfill; see run_backfill().
+            logging.exception('Error processing file: %s' % fn)
+            stats['error'] = True
+            paused = False
+
+        else:
+            paused = False
+
+        if progress_seconds:
+            log_progress(fn, stats, recs_processed, time.perf_counter() - start, st.st_size,
+                         finished=not paused)
+            save_state()
+        stats['read_seconds'] = time.perf_counter() - start - deliver_time
+        record_file_stats(file_pattern, stats)
+        records_metric.inc(recs_processed, spec=file_pattern)
+        if paused:
+            return True
+
+    return False
+
+
+def log_progress(fn, stats, n_recs, elapsed, size, finished=False):
+    """Logs the progress through the file 'fn', of 'size' bytes, after 'elapsed'
+    seconds.  'stats' holds the reader statistics, and 'n_recs' is the number of
+    records delivered.  'finished' is True if the file has been read.
+    """
+    rows = stats.get('rows_read', 0)
+    mb = stats.get('bytes_read', 0) / 1e6
+    elapsed = max(elapsed, 1e-6)
+    logging.info('%s %s: %d records delivered, %d rows and %.1f MB read (file is %.1f MB), '
+                 '%.0f rows/s, %.2f MB/s' %
+                 ('Finished' if finished else 'Reading', fn, n_recs, rows, mb, size / 1e6,
+                  rows / elapsed, mb / elapsed))
+
+
+def process_files_in_pool(changed=None):
+    """Reads the files with new records in the reader process pool, delivering
+    the records as they arrive.  'changed' is described in file_jobs().
+    """
+    jobs = list(file_jobs(changed))
+    pool_jobs = [(reader_func, fn, spec, min_ts, state.resume(fn))
+                 for fn, reader_func, spec, min_ts, file_pattern, st in jobs]
+    recs_processed = [0] * len(jobs)
+    failed = set()      # jobs where delivering records failed
+    results = reader_pool.read_files(pool_jobs)
+    for job_ix, recs, last_ts, resume in results:
+        fn, _, _, min_ts, file_pattern, st = jobs[job_ix]
+        if recs is None:
+            # the file is finished; 'resume' holds the reader statistics.
+            if recs_processed[job_ix]:
+                logging.info('%s records processed for file %s' % (recs_processed[job_ix], fn))
+            resume['error'] = resume['error'] or job_ix in failed
+            if not resume['error']:
+                # the whole file was read, so it can be skipped until it changes.
+                state.update(fn, st=st)
+            record_file_stats(file_pattern, resume)
+            records_metric.inc(recs_processed[job_ix], spec=file_pattern)
+            continue
+        if job_ix in failed:
+            # skip the rest of the file, as happens when files are read serially
+            continue
+        try:
+            recs_processed[job_ix] += handle_chunk(fn, recs, last_ts, resume, min_ts,
+                                                    file_pattern)
+        except consumers.dispatch.ConsumerFull as e:
+            # Stop the workers reading the rest of the files.  The progress through
+            # the files is kept, and they are read from there on a later pass.
+            logging.warning('%s  Stopped reading at file %s.' % (e, fn))
+            results.close()
+            break
+        except:
+            logging.exception('Error processing file: %s' % fn)
+            failed.add(job_ix)
+
+
+def process_files(changed=None):
+    """Reads the files with new records, delivers the records to the consumers
+    and saves the progress through each file.  'changed' is described in file_jobs().
+    """
+    if reader_pool:
+        process_files_in_pool(changed)
+    else:
+        process_files_serially(changed)
+
+    save_state()
+
+
+def save_state():
+    """Saves the progress through the files and the state of the stages.  If a
+    consumer failed to take some of the records delivered since the last save, the
+    progress and the state of the stages are instead returned to those last saved, so
+    the records are read again.  Returns True if the state was saved.
+    """
+    # Wait for consumers running in their own threads to take the records
+    # delivered, and have consumers write the records they hold in memory, so the
+    # saved progress only covers records the consumers have.
+    saved = True
+    for consumer in targets:
+        try:
+            if hasattr(consumer, 'flush'):
+                consumer.flush()
+            elif hasattr(consumer, 'drain'):
+                consumer.drain()
+        except Exception as e:
+            # the consumer's thread has already logged the traceback
+            logging.error('Error delivering records to the Consumer %s: %s' % (consumer, e))
+            saved = False
+
+    all_stages = sum(spec_stages.values(), []) + record_stages
+    if not saved:
+        logging.error('The progress through the files was not saved; the records '
+                      'delivered since it was last saved will be read again.')
+        state.rollback()
+        for stage in all_stages:
+            if hasattr(stage, 'set_state'):
+                stage.set_state(state.get_blob(stage.state_key))
+        return False
+
+    # save the changes to the state of the files and of the stages, in one transaction
+    for stage in all_stages:
+        if hasattr(stage, 'get_state'):
+            stage_state = stage.get_state()
+            if stage_state is not None:
+                state.set_blob(stage.state_key, stage_state)
+    state.commit()
+    return True
+
+
+def unposted_count():
+    """Returns the number of sets of readings that the consumers have queued, such
+    as in the BMON posting queues, and not yet posted.
+    """
+    return sum(consumer.unposted() for consumer in targets if hasattr(consumer, 'unposted'))
+
+
+def wait_for_posts(timeout):
+    """Waits until the consumers have posted the readings in their queues, or for
+    'timeout' seconds, whichever comes first.  Returns the number of sets of readings
+    still waiting to be posted.
+    """
+    end = time.time() + timeout
+    unposted = unposted_count()
+    while unposted and time.time() < end:
+        time.sleep(0.05)
+        unposted = unposted_count()
+    if unposted:
+        logging.warning('%d queued sets of readings were not posted within %s seconds; '
+                        'they will be posted by the next run.' % (unposted, timeout))
+    return unposted
+
+
+def run_backfill():
+    """Loads the files once, in a mode tuned for loading a large archive of
+    historical files.  The files are read one at a time in large compact chunks, the
+    progress through each file is logged and saved every 'backfill_progress_seconds',
+    and reading pauses while the consumers' posting queues are full.  Once all of the
+    files are read, waits for the consumers to post the queued readings.  If the
+    backfill is interrupted, the progress is saved, and the next backfill or normal
+    run continues from there.
+    """
+    # Stop at the end of the chunk being delivered when interrupted, so no records
+    # are queued without their progress being saved.  A second interrupt stops now.
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        if stop.is_set():
+            raise KeyboardInterrupt
+        logging.warning('Backfill stopping after the chunk of records being delivered.')
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    progress_seconds = config.get('backfill_progress_seconds', 10)
+    spec_override = {'chunk_size': config.get('backfill_chunk_size', 20000), 'compact': True}
+    start = time.time()
+    try:
+        while process_files_serially(spec_override=spec_override,
+                                     progress_seconds=progress_seconds, stop=stop):
+            # wait for the consumers to catch up before reading more
+            while any(hasattr(consumer, 'full') and consumer.full() for consumer in targets):
+                if stop.is_set():
+                    raise KeyboardInterrupt
+                time.sleep(1)
+        logging.info('Backfill read the files in %.0f s.' % (time.time() - start))
+
+        # wait for the readings to be posted
+        start = time.time()
+        next_progress = start
+        unposted = first_unposted = None
+        while unposted != 0:
+            unposted = unposted_count()
+            if first_unposted is None:
+                first_unposted = unposted
+            if unposted and time.time() >= next_progress:
+                elapsed = max(time.time() - start, 1e-6)
+                logging.info('Backfill waiting for %d queued posts, %.1f posts/s.' %
+                             (unposted, (first_unposted - unposted) / elapsed))
+                next_progress += progress_seconds
+            if stop.is_set():
+                raise KeyboardInterrupt
+            if unposted:
+                time.sleep(1)
+        logging.info('Backfill finished.')
+
+    except KeyboardInterrupt:
+        save_state()
+        logging.warning('Backfill interrupted.  Its progress is saved, and records that '
+                        'were queued are posted by the next run.')
+        sys.exit(1)
+
 
 while True:
 
     try:
-        # Loop through each file spec
-        for spec_orig in config['csv_files']:
-
-            # make a copy of the spec so it can be modified without
-            # affecting the original
-            spec = spec_orig.copy()
-
-            try:
-                # get and remove key items from the file spec
-                file_pattern = spec.pop('file_glob')
-                file_type = spec.pop('file_type', 'generic')
-                reader_func = file_type_to_func[file_type]
-                for fn in glob.glob(file_pattern):
-
-                    try:
-                        # Files and records must be newer than this timestamp
-                        min_ts = last_ts_map.get(fn, 0)
-
-                        # get the Unix timestamp indicating when file was last modified,
-                        # and don't process if this file was modified prior to last record
-                        # stored.
-                        mod_time = os.stat(fn).st_mtime
-                        if mod_time <= min_ts:
-                            continue
-
-                        recs_processed = 0
-                        for recs, last_ts in reader_func(fn, **spec):
-                            if last_ts <= min_ts:
-                                continue
-                            else:
-                                # filter down to just records past min_ts
-                                recs_filtered = [rec for rec in recs if rec['ts'] > min_ts]
-                                recs_processed += len(recs_filtered)
-                                for consumer in targets:
-                                    consumer(recs_filtered)
-                                last_ts_map[fn] = last_ts
-                        if recs_processed:
-                            logging.info('%s records processed for file %s' % (recs_processed, fn))
-
-                    except:
-                        logging.exception('Error processing file: %s' % fn)
-
-            except:
-                logging.exception('Error processing file spec %s' % spec)
-
-        # update the file holding the last processed timestamps by file
-        pickle.dump(last_ts_map, open(last_ts_fn, 'wb'))
+        if backfill:
+            run_backfill()
+            sys.exit(0)
+
+        # check all of the files
+        process_files()
 
         if config.get('run_once', False):
-            print("Waiting before exit...")
-            time.sleep(config.get('run_once_wait_before_stop', 15))
+            # Wait for the readings queued by this run to be posted, for no more than
+            # 'run_once_wait_before_stop' seconds.
+            wait_for_posts(config.get('run_once_wait_before_stop', 15))
             sys.exit(0)
 
-        # wait before checking again
-        time.sleep(config.get('check_interval', 30))
+        if watcher:
+            # Process files as they change until it is time to check all of the
+            # files again, which catches changes that inotify can't report.
+            watcher.watch_dirs(watched_dirs())
+            next_check = time.time() + config.get('check_interval', 30)
+            while time.time() < next_check:
+                changed = watcher.wait(next_check - time.time())
+                if changed is None:
+                    # changes were lost, so check all of the files now.
+                    break
+                if changed:
+                    process_files(changed)
+        else:
+            # wait before checking again
+            time.sleep(config.get('check_interval', 30))
 
     except SystemExit as e:
         # catch a system exit and exit after proper cleanup
+        for consumer in targets:
+            # write records that consumers are holding in memory
+            if hasattr(consumer, 'flush'):
+                try:
+                    consumer.flush()
+                except:
+                    logging.exception('Error flushing the Consumer %s' % consumer)
+        if reader_pool:
+            reader_pool.close()
+        if 'readers.split' in sys.modules:
+            readers.split.stop_workers()
         os._exit(e.code)
 
     except:
@@ -0,0 +1,135 @@
+"""Class to watch directories for files that are written, created or moved
+into place, using the Linux inotify API.  Used by csv_transfer.py to process
+new data as soon as it is written, instead of waiting for the next scan of all
+of the files.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+# inotify constants, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# the events that indicate a file may have new data
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+# the fixed size portion of an inotify event: wd, mask, cookie, len
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class DirWatcher:
+    """Watches a set of directories and reports the files in them that have
+    changed.  Raises OSError if inotify is not available on this system.
+
+    Parameters
+    ----------
+    settle_time:  After the first change is detected, the number of seconds to
+        continue collecting changes before reporting them, so that a burst of
+        writes to a file results in one report.
+    """
+
+    def __init__(self, settle_time=0.5):
+        self.settle_time = settle_time
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        # maps watch descriptor to directory, and directory to watch descriptor.
+        # Directories are stored as they were given to watch_dirs(), as that is
+        # the form of the file paths reported.
+        self._wd_to_dir = {}
+        self._dir_to_wd = {}
+
+    def watch_dirs(self, dirs):
+        """Watches the directories in the iterable 'dirs', and stops watching any
+        directories not in 'dirs'.  An empty string means the current directory.
+        Directories that can't be watched are logged and skipped; changes in those
+        directories are only found by polling.
+        """
+        dirs = set(dirs)
+        for d in set(self._dir_to_wd) - dirs:
+            wd = self._dir_to_wd.pop(d)
+            self._wd_to_dir.pop(wd, None)
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+        for d in dirs - set(self._dir_to_wd):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(d or '.'), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                logging.warning('Unable to watch directory "%s": %s' % (d, os.strerror(err)))
+                continue
+            self._dir_to_wd[d] = wd
+            self._wd_to_dir[wd] = d
+
+    def wait(self, timeout):
+        """Waits up to 'timeout' seconds for files in the watched directories to
+        change.  Returns the set of paths of changed files, which is empty if no files
+        changed.  Returns None if changes were lost because the kernel's event queue
+        overflowed, in which case all files should be checked.
+        """
+        changed = set()
+        deadline = None
+        while True:
+            if deadline is None:
+                wait_time = max(0.0, timeout)
+            else:
+                wait_time = max(0.0, deadline - time.time())
+            ready, _, _ = select.select([self._fd], [], [], wait_time)
+            if not ready:
+                return changed
+            if not self._read_events(changed):
+                return None
+            if deadline is None:
+                # collect the rest of a burst of changes before reporting
+                deadline = time.time() + self.settle_time
+
+    def _read_events(self, changed):
+        """Reads the available events, adding the paths of changed files to the
+        set 'changed'.  Returns False if the event queue overflowed.
+        """
+        try:
+            buf = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return True
+
+        pos = 0
+        ok = True
+        while pos + EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(buf, pos)
+            pos += EVENT_HEADER.size
+            name = buf[pos:pos + name_len].rstrip(b'\0')
+            pos += name_len
+
+            if mask & IN_Q_OVERFLOW:
+                ok = False
+            elif mask & IN_IGNORED:
+                # the directory was removed
+                d = self._wd_to_dir.pop(wd, None)
+                if d is not None:
+                    self._dir_to_wd.pop(d, None)
+            elif name and wd in self._wd_to_dir:
+                changed.add(os.path.join(self._wd_to_dir[wd], os.fsdecode(name)))
+        return ok
+
+    def close(self):
+        """Stops watching and releases the inotify file descriptor.
+        """
+        os.close(self._fd)
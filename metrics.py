@@ -0,0 +1,233 @@
+"""Runtime metrics for csv_transfer: counters, gauges and histograms that are
+updated as files are read and records are posted.  The metrics can be served in
+the Prometheus text format by a small local HTTP server, and can be written
+periodically to a stats file in JSON format.
+
+Metrics are created once, at module level, by the code that updates them:
+
+    rows_read = metrics.counter('csv_transfer_rows_read_total', 'Data rows read.')
+    ...
+    rows_read.inc(n, spec='*.csv')
+
+The keyword arguments of inc(), set() and observe() are the labels of the value.
+"""
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+
+# the metrics, by name, in the order they were created
+_metrics = {}
+_lock = threading.Lock()
+
+
+class Metric:
+    """A metric with a value for each combination of label values.  Use the
+    counter(), gauge() and histogram() functions to create metrics.
+
+    Parameters
+    ----------
+    name:  Name of the metric, following the Prometheus naming conventions.
+    kind:  'counter', 'gauge' or 'histogram'.
+    help:  Description of the metric.
+    buckets:  For histograms, the sorted list of bucket upper bounds.
+    """
+
+    def __init__(self, name, kind, help, buckets=None):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.buckets = buckets
+        # maps a tuple of (label, value) pairs to the value of the metric.  For
+        # histograms, the value is a list of the bucket counts, followed by the
+        # sum and count of the observations.
+        self.values = {}
+        # maps a tuple of (label, value) pairs to a function returning the value
+        self.functions = {}
+
+    def inc(self, amount=1, **labels):
+        """Adds 'amount' to the value of a counter or gauge.
+        """
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """Sets the value of a gauge.
+        """
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = value
+
+    def set_function(self, func, **labels):
+        """Sets a function that is called to get the value of a gauge whenever
+        the metrics are reported.
+        """
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.functions[key] = func
+
+    def observe(self, value, **labels):
+        """Adds the observation 'value' to a histogram.
+        """
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def current_values(self):
+        """Returns a list of (labels, value) tuples of the current values, where
+        'labels' is a tuple of (label, value) pairs.  Values from functions that
+        raise an exception are skipped.
+        """
+        with _lock:
+            values = [(key, list(val) if self.kind == 'histogram' else val)
+                      for key, val in self.values.items()]
+            functions = list(self.functions.items())
+        for key, func in functions:
+            try:
+                values.append((key, func()))
+            except:
+                logging.exception('Error getting the value of metric %s' % self.name)
+        return values
+
+
+def _make(name, kind, help, buckets=None):
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = Metric(name, kind, help, buckets)
+        return _metrics[name]
+
+
+def counter(name, help):
+    """Returns the counter metric 'name', creating it if needed.
+    """
+    return _make(name, 'counter', help)
+
+
+def gauge(name, help):
+    """Returns the gauge metric 'name', creating it if needed.
+    """
+    return _make(name, 'gauge', help)
+
+
+def histogram(name, help, buckets):
+    """Returns the histogram metric 'name', creating it if needed.  'buckets' is
+    the sorted list of the upper bounds of the histogram buckets.
+    """
+    return _make(name, 'histogram', help, sorted(buckets))
+
+
+def _label_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in pairs)
+
+
+def render_prometheus():
+    """Returns the current value of all metrics in the Prometheus text format.
+    """
+    lines = []
+    for m in list(_metrics.values()):
+        lines.append('# HELP %s %s' % (m.name, m.help))
+        lines.append('# TYPE %s %s' % (m.name, m.kind))
+        for labels, val in m.current_values():
+            if m.kind == 'histogram':
+                for bound, count in zip(m.buckets, val):
+                    lines.append('%s_bucket%s %s' % (m.name, _label_text(labels, [('le', repr(float(bound)))]),
+                                                     count))
+                lines.append('%s_bucket%s %s' % (m.name, _label_text(labels, [('le', '+Inf')]), val[-1]))
+                lines.append('%s_sum%s %r' % (m.name, _label_text(labels), float(val[-2])))
+                lines.append('%s_count%s %s' % (m.name, _label_text(labels), val[-1]))
+            else:
+                lines.append('%s%s %r' % (m.name, _label_text(labels), float(val)))
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot():
+    """Returns the current value of all metrics as a dictionary that can be encoded
+    as JSON.  Each metric maps to a list of dictionaries, each holding the labels
+    and the value, or for histograms the bucket counts, sum and count.
+    """
+    result = {'time': time.time()}
+    for m in list(_metrics.values()):
+        entries = []
+        for labels, val in m.current_values():
+            entry = {'labels': dict(labels)}
+            if m.kind == 'histogram':
+                entry['buckets'] = dict(('%g' % bound, count) for bound, count in zip(m.buckets, val))
+                entry['sum'] = val[-2]
+                entry['count'] = val[-1]
+            else:
+                entry['value'] = val
+            entries.append(entry)
+        result[m.name] = entries
+    return result
+
+
+class MetricsServer:
+    """Serves the metrics in the Prometheus text format from a background thread,
+    at any path on http://host:port/.
+
+    Parameters
+    ----------
+    port:  TCP port to listen on.
+    host:  Address to listen on.  The default only accepts local connections.
+    """
+
+    def __init__(self, port, host='127.0.0.1'):
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+
+class StatsFileWriter(threading.Thread):
+    """Thread that writes snapshot() to a JSON file every 'interval' seconds.  The
+    file is replaced atomically, so readers of the file never see a partial file.
+    """
+
+    def __init__(self, path, interval=60):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+
+    def write(self):
+        """Writes the stats file now.
+        """
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot(), f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except:
+                logging.exception('Error writing stats file %s' % self.path)
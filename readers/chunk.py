@@ -0,0 +1,217 @@
+"""A compact representation of a chunk of records, used in place of a list of
+record dictionaries.  The field names are stored once per chunk, and the
+timestamps, values and a validity mask are stored in flat arrays.  This uses a
+fraction of the memory of record dictionaries and avoids building a dictionary
+for every row.  Readers produce these chunks when passed 'compact=True'.
+
+Consumers that understand RecordChunk objects have an 'accepts_chunks'
+attribute set to True.  Other consumers are passed the list of record
+dictionaries from RecordChunk.records().
+"""
+from array import array
+
+
+def _as_list(seq):
+    """Returns the sequence 'seq', which may be an array.array, a NumPy array, a
+    bytearray or a list, as a list of Python objects.
+    """
+    if hasattr(seq, 'tolist'):
+        return seq.tolist()
+    return list(seq)
+
+
+class RecordChunk:
+    """A chunk of records from a file, all having the same fields.
+
+    Parameters
+    ----------
+    names:  List of the value field names, not including the timestamp.
+    ts:  Sequence of the Unix timestamps of the records.
+    values:  Sequence of the values of the records, row by row, so the value of
+        field j of record i is values[i * len(names) + j].
+    valid:  Sequence, in the same layout as 'values', that is true where a value
+        is present in the record.
+    """
+
+    def __init__(self, names, ts, values, valid):
+        self.names = names
+        self.ts = ts
+        self.values = values
+        self.valid = valid
+
+    def __len__(self):
+        return len(self.ts)
+
+    def n_readings(self):
+        """Returns the number of values present in the chunk.
+        """
+        valid = self.valid
+        return int(valid.sum()) if hasattr(valid, 'sum') else sum(valid)
+
+    @property
+    def last_ts(self):
+        """The timestamp of the last record in the chunk.
+        """
+        return float(self.ts[-1])
+
+    def _rows(self):
+        """Generator yielding a (ts, values, valid) tuple for each record, where
+        'values' and 'valid' are lists.
+        """
+        n = len(self.names)
+        values = _as_list(self.values)
+        valid = _as_list(self.valid)
+        for i, ts in enumerate(_as_list(self.ts)):
+            yield ts, values[i * n:(i + 1) * n], valid[i * n:(i + 1) * n]
+
+    def records(self):
+        """Returns the chunk as a list of record dictionaries, as the readers return
+        when not in compact mode.  Each record has a 'ts' key and a key for each field
+        with a value in that record.
+        """
+        names = self.names
+        recs = []
+        for ts, vals, ok in self._rows():
+            rec = {'ts': float(ts)}
+            if all(ok):
+                rec.update(zip(names, vals))
+            else:
+                rec.update((nm, v) for nm, v, good in zip(names, vals, ok) if good)
+            recs.append(rec)
+        return recs
+
+    def readings(self):
+        """Returns a list of (ts, name, value) readings, with integer timestamps,
+        for each value in the chunk, in record order.
+        """
+        names = self.names
+        readings = []
+        for ts, vals, ok in self._rows():
+            ts = int(ts)
+            if all(ok):
+                readings.extend(zip([ts] * len(names), names, vals))
+            else:
+                readings.extend((ts, nm, v) for nm, v, good in zip(names, vals, ok) if good)
+        return readings
+
+    def after(self, min_ts):
+        """Returns a RecordChunk holding only the records with a timestamp greater than
+        'min_ts'.  Returns this chunk if all records qualify.
+        """
+        ts = _as_list(self.ts)
+        keep = [i for i, t in enumerate(ts) if t > min_ts]
+        if len(keep) == len(ts):
+            return self
+        n = len(self.names)
+        values = _as_list(self.values)
+        valid = _as_list(self.valid)
+        new_values = array('d')
+        new_valid = bytearray()
+        for i in keep:
+            new_values.extend(values[i * n:(i + 1) * n])
+            new_valid.extend(bytes(bool(v) for v in valid[i * n:(i + 1) * n]))
+        return RecordChunk(self.names, array('d', [ts[i] for i in keep]), new_values, new_valid)
+
+
+class ChunkBuilder:
+    """Builds RecordChunk objects from the text rows of a CSV file.  The plan of
+    which columns hold each field is made once, from the field names of the columns.
+
+    Parameters
+    ----------
+    col_names:  List of the field names of the columns of a row, as used by the
+        reader.  When a name is repeated, the value comes from the last of its
+        columns present in the row, as happens when a dictionary is made from the row.
+    exclude_fields:  Names of fields to leave out of the records.
+    skip_names:  Names of columns that are not value fields, such as the timestamp.
+    special_values:  Dictionary mapping lower case, stripped strings that are not
+        numbers to the value to use for them, e.g. {'on': 1.0}.  Other strings that
+        are not numbers are missing values.
+    """
+
+    def __init__(self, col_names, exclude_fields=(), skip_names=('ts',), special_values={}):
+        plan = {}
+        for col, nm in enumerate(col_names):
+            plan.setdefault(nm, []).append(col)
+        for nm in list(exclude_fields) + list(skip_names):
+            plan.pop(nm, None)
+        self.names = list(plan.keys())
+        self.col_lists = list(plan.values())
+        self.cols = [cols[-1] for cols in self.col_lists]
+        self.n_cols = len(col_names)
+        self.special_values = special_values
+        # strings that are not numbers, mapped to their value or None if missing.
+        # These are usually repeated, e.g. "No Data".
+        self._not_nums = {}
+        self._reset()
+
+    def _reset(self):
+        self._ts = array('d')
+        self._values = array('d')
+        self._valid = bytearray()
+
+    def __len__(self):
+        return len(self._ts)
+
+    def add_row(self, ts, row):
+        """Adds a record with the Unix timestamp 'ts' and the values in the list of
+        strings 'row', which is a complete row of the file.
+        """
+        if len(row) >= self.n_cols:
+            cols = self.cols
+        else:
+            # a short row; use the last column present for each field.
+            n = len(row)
+            cols = []
+            for col_list in self.col_lists:
+                present = [c for c in col_list if c < n]
+                cols.append(present[-1] if present else None)
+
+        values = []
+        valid = []
+        not_nums = self._not_nums
+        for col in cols:
+            if col is None:
+                values.append(0.0)
+                valid.append(0)
+                continue
+            s = row[col]
+            try:
+                v = float(s)
+                if v != v:
+                    # do not include NaN values
+                    values.append(0.0)
+                    valid.append(0)
+                else:
+                    values.append(v)
+                    valid.append(1)
+                continue
+            except ValueError:
+                pass
+            if s not in not_nums:
+                not_nums[s] = self.special_values.get(s.lower().strip())
+            v = not_nums[s]
+            values.append(0.0 if v is None else v)
+            valid.append(0 if v is None else 1)
+
+        self._ts.append(ts)
+        self._values.extend(values)
+        self._valid.extend(valid)
+
+    def add_values(self, ts, values, valid):
+        """Adds a record with the Unix timestamp 'ts' and the values already
+        converted by the reader.  'values' is a list of the float value of each field,
+        with 0.0 for missing values, and 'valid' is a list holding 1 for each field
+        present and 0 for each missing one.
+        """
+        self._ts.append(ts)
+        self._values.extend(values)
+        self._valid.extend(valid)
+
+    def take(self):
+        """Returns a RecordChunk of the records added since the last call, and starts
+        a new chunk.
+        """
+        chunk = RecordChunk(self.names, self._ts, self._values, self._valid)
+        self._reset()
+        return chunk
@@ -0,0 +1,392 @@
+"""Function to read CSV files in large blocks of rows, converting each block
+into NumPy columns.  This produces the same records as the 'generic' reader, but
+the timestamp and value conversions are done a block and a column at a time instead
+of a record at a time.  This is faster for large files such as historical backfills,
+particularly when the values in the file are all numbers or "NAN".  Code that can
+use the NumPy columns directly should use read_blocks() and avoid building records.
+
+NumPy is only required if this reader is used.
+"""
+import csv
+import logging
+from itertools import compress
+from . import chunk
+from . import reader_util
+from . import timestamps
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# the error logger to use for this module
+logger = logging.getLogger(__name__)
+
+
+def columnar_reader(filename, chunk_size=1, ts_field=None, ts_tz='UTC',
+                    field_names=[], header_rows=1, name_row=1,
+                    field_map={}, exclude_fields=[], block_rows=50000, resume=None,
+                    stats=None, compact=False, use_mmap=False, skip_to_ts=None,
+                    **csv_params):
+    """This generator function reads CSV files and returns chunks of records from
+    those files, exactly as readers.generic.generic_reader() does, and it accepts
+    the same parameters.  See that function for their documentation.  Internally,
+    the file is read in blocks of rows, and each block is converted into NumPy
+    columns by read_blocks() before the records are built.  With 'compact' set to
+    True, the readers.chunk.RecordChunk objects are made directly from the NumPy
+    columns, without building records.
+
+    Additional Parameters
+    ---------------------
+    block_rows: The maximum number of rows read from the file and converted at one
+        time.  Larger blocks convert faster but use more memory.  Default is 50,000.
+    """
+
+    if compact:
+        yield from _compact_chunks(filename, chunk_size, ts_field, ts_tz, field_names,
+                                   header_rows, name_row, field_map, exclude_fields,
+                                   block_rows, resume, stats, use_mmap, skip_to_ts,
+                                   **csv_params)
+        return
+
+    recs = []
+    last_ts = 0
+    csvfile, compressed = reader_util.open_input(filename)
+    if compressed:
+        # compressed files are read from the start, without a resume point
+        resume = None
+    with csvfile:
+
+        for blk in read_blocks(csvfile, ts_field, ts_tz, field_names, header_rows, name_row,
+                               field_map, exclude_fields, block_rows, resume, stats,
+                               use_mmap and not compressed,
+                               None if compressed else skip_to_ts, **csv_params):
+
+            # convert the block to Python objects once, then build a record for each
+            # row from the valid values in that row.
+            names = blk['names']
+            ts_list = blk['ts'].tolist()
+            offsets = blk['offsets']
+            valid = blk['valid'].tolist()
+            all_valid = blk['valid'].all(axis=1).tolist()
+            for i, vals in enumerate(blk['values'].tolist()):
+                if all_valid[i]:
+                    rec = dict(zip(names, vals))
+                else:
+                    rec = dict(compress(zip(names, vals), valid[i]))
+                last_ts = ts_list[i]
+                rec['ts'] = float(last_ts)
+                recs.append(rec)
+
+                # if we have accumulated the desired number of records, release them
+                if len(recs) == chunk_size:
+                    if resume is not None:
+                        reader_util.mark_resume_point(blk['lines'], resume, offsets[i])
+                    if chunk_size != 1:
+                        yield recs, last_ts
+                    else:
+                        # yield the individual record, not a 1-element list
+                        yield recs[0], last_ts
+                    recs = []
+
+        # there may be a partial chunk to yield.
+        if len(recs):
+            if resume is not None:
+                reader_util.mark_resume_point(blk['lines'], resume, offsets[-1])
+            yield recs, last_ts
+
+
+def _compact_chunks(filename, chunk_size, ts_field, ts_tz, field_names, header_rows,
+                    name_row, field_map, exclude_fields, block_rows, resume, stats,
+                    use_mmap, skip_to_ts, **csv_params):
+    """Generator that does the work of columnar_reader() when 'compact' is True,
+    yielding readers.chunk.RecordChunk objects made directly from the NumPy columns.
+    """
+    pending = []        # slices of blocks not yet yielded
+    n_pending = 0
+    last_ts = 0
+    csvfile, compressed = reader_util.open_input(filename)
+    if compressed:
+        # compressed files are read from the start, without a resume point
+        resume = None
+    with csvfile:
+
+        for blk in read_blocks(csvfile, ts_field, ts_tz, field_names, header_rows, name_row,
+                               field_map, exclude_fields, block_rows, resume, stats,
+                               use_mmap and not compressed,
+                               None if compressed else skip_to_ts, **csv_params):
+            n = len(blk['ts'])
+            start = 0
+            while start < n:
+                end = start + min(chunk_size - n_pending, n - start)
+                pending.append((blk['ts'][start:end], blk['values'][start:end],
+                                blk['valid'][start:end]))
+                n_pending += end - start
+                start = end
+                last_ts = blk['ts'][end - 1].item()
+                if n_pending == chunk_size:
+                    if resume is not None:
+                        reader_util.mark_resume_point(blk['lines'], resume, blk['offsets'][end - 1])
+                    yield _make_chunk(blk['names'], pending), last_ts
+                    pending = []
+                    n_pending = 0
+
+        # there may be a partial chunk to yield.
+        if pending:
+            if resume is not None:
+                reader_util.mark_resume_point(blk['lines'], resume, blk['offsets'][-1])
+            yield _make_chunk(blk['names'], pending), last_ts
+
+
+def _make_chunk(names, pieces):
+    """Returns a readers.chunk.RecordChunk of the list of (ts, values, valid) block
+    slices 'pieces'.
+    """
+    ts = np.concatenate([p[0] for p in pieces]).astype(np.float64)
+    values = np.concatenate([p[1] for p in pieces])
+    valid = np.concatenate([p[2] for p in pieces])
+    return chunk.RecordChunk(names, ts, values.ravel(), valid.ravel())
+
+
+def read_blocks(csvfile, ts_field=None, ts_tz='UTC', field_names=[], header_rows=1,
+                name_row=1, field_map={}, exclude_fields=[], block_rows=50000,
+                resume=None, stats=None, use_mmap=False, skip_to_ts=None, **csv_params):
+    """Generator that reads the CSV file object 'csvfile', opened in binary mode,
+    in blocks of up to 'block_rows' rows and yields each block as a dictionary of
+    NumPy columns:
+
+        'names': list of the value field names, in column order of 'values'.
+        'ts': array of Unix timestamps for each row; int64 if the timestamps are
+            date/time strings, float64 if the file holds Unix timestamps.
+        'values': 2-D float64 array of values, one row per record and one column
+            per field in 'names'.
+        'valid': 2-D boolean array, False where a value is not a number or is NaN.
+        'offsets': list giving the byte offset just past each row in the file.
+        'lines': the reader_util.OffsetLineReader used to read the file.  If
+            'use_mmap' is True, this is a reader_util.MappedLineReader, whose memory
+            map is released once the reader is no longer referenced.
+
+    Rows with a timestamp that can't be converted are logged and dropped.  Parameters
+    are described in columnar_reader() and readers.generic.generic_reader();
+    'use_mmap' and 'skip_to_ts' must not be used if 'csvfile' is decompressed as it
+    is read.
+    """
+    if np is None:
+        raise ImportError('The columnar reader requires the NumPy package.')
+
+    stats = reader_util.init_stats(stats)
+
+    # used in log messages; decompressing file objects may not have a name
+    filename = getattr(csvfile, 'name', csvfile)
+    ts_parser = timestamps.TimestampParser(ts_tz)
+    lines = reader_util.line_reader(csvfile, use_mmap, resume is not None)
+
+    # read the header rows into a list
+    reader = csv.reader(lines, **csv_params)
+    headers = [next(reader) for i in range(header_rows)]
+
+    # determine the field names, with the timestamp field named 'ts'
+    names = reader_util.header_field_names(headers, field_names, name_row,
+                                           field_map, ts_field)
+
+    # Make the plan of which columns hold each field.  When a name is repeated,
+    # the value comes from the last of its columns present in the row, as happens
+    # when a dictionary is made from the row.
+    plan = {}
+    for col, nm in enumerate(names):
+        plan.setdefault(nm, []).append(col)
+    for fld in exclude_fields:
+        plan.pop(fld, None)
+    ts_col = plan.pop('ts')[-1]
+    val_names = list(plan.keys())
+    val_cols = list(plan.values())
+    n_cols = len(names)
+
+    # The fast path parses a block of lines with NumPy's CSV parser, which only
+    # supports the delimiter and quote character csv.reader() parameters.
+    delimiter = csv_params.get('delimiter', ',')
+    quotechar = csv_params.get('quotechar', '"')
+    fast_ok = set(csv_params) <= {'delimiter', 'quotechar'}
+    use_cols = [cols[-1] for cols in val_cols]
+
+    # skip the rows read on a prior pass, if the file has only been appended to.
+    resumed = False
+    if resume is not None:
+        resumed = reader_util.seek_resume_point(lines, resume)
+
+    # otherwise, skip the old rows of a time-ordered file
+    if skip_to_ts and not resumed:
+        row_ts = reader_util.row_ts_func(names, timestamps.TimestampParser(ts_tz), csv_params)
+        reader_util.seek_time(lines, skip_to_ts, row_ts, resume)
+
+    while True:
+        # Read a block of lines.  Don't end the block inside a quoted field that
+        # contains a newline.  'single_line' indicates whether each line is a row.
+        block = []
+        line_offsets = []
+        open_quote = False
+        single_line = True
+        for line in lines:
+            block.append(line)
+            line_offsets.append(lines.offset)
+            if line.count(quotechar) % 2:
+                open_quote = not open_quote
+                single_line = False
+            if len(block) >= block_rows and not open_quote:
+                break
+
+        if not block:
+            break
+
+        rows = None
+        if fast_ok and single_line:
+            # drop blank lines, which are not rows.
+            keep = [ln.strip('\r\n') != '' for ln in block]
+            text_rows = list(compress(block, keep))
+            offsets = list(compress(line_offsets, keep))
+            try:
+                values = np.loadtxt(text_rows, delimiter=delimiter, quotechar=quotechar,
+                                    comments=None, usecols=use_cols, ndmin=2, dtype=np.float64)
+                ts_col_vals = np.loadtxt(text_rows, delimiter=delimiter, quotechar=quotechar,
+                                         comments=None, usecols=[ts_col], ndmin=2, dtype=str)[:, 0].tolist()
+                bad_rows = text_rows
+            except ValueError:
+                # a value that is not a number or a row with the wrong number of fields
+                single_line = False
+
+        if not (fast_ok and single_line):
+            rows, offsets = _parse_rows(block, line_offsets, csv_params)
+            if rows:
+                values = _convert_rows(rows, val_cols, n_cols)
+                ts_col_vals = [row[ts_col] if len(row) > ts_col else '' for row in rows]
+            bad_rows = rows
+
+        stats['bytes_read'] = lines.bytes_read
+        if offsets:
+            stats['rows_read'] += len(offsets)
+            ts, good = _convert_timestamps(ts_col_vals, ts_parser, filename, bad_rows)
+            valid = ~np.isnan(values)
+            if good is not None:
+                n_bad = len(good) - int(good.sum())
+                stats['rows_dropped'] += n_bad
+                stats['parse_errors'] += n_bad
+                values = values[good]
+                valid = valid[good]
+                offsets = list(compress(offsets, good))
+
+            if len(ts):
+                yield {'names': val_names, 'ts': ts, 'values': values, 'valid': valid,
+                       'offsets': offsets, 'lines': lines}
+
+        if len(block) < block_rows:
+            break
+
+
+def _parse_rows(block, line_offsets, csv_params):
+    """Parses the list of text lines 'block' with csv.reader().  Returns the list
+    of non-blank rows and a list of the byte offsets just past each row, determined
+    from 'line_offsets', the offsets just past each line.
+    """
+    consumed = [0]      # number of lines consumed by the csv.reader
+
+    def line_iter():
+        for line in block:
+            consumed[0] += 1
+            yield line
+
+    rows = []
+    offsets = []
+    for row in csv.reader(line_iter(), **csv_params):
+        # skip blank rows
+        if not len(row):
+            continue
+        rows.append(row)
+        offsets.append(line_offsets[consumed[0] - 1])
+    return rows, offsets
+
+
+def _convert_rows(rows, val_cols, n_cols):
+    """Returns a 2-D float64 array of the values in the list of CSV 'rows', one
+    column for each list of file columns in 'val_cols'.  Values that are not numbers
+    are NaN.  When a field has several columns, the value is taken from the last of
+    those columns present in the row.  'n_cols' is the number of field names.
+    """
+    # make every row the same length.  Missing values are not numbers.
+    lengths = np.array([len(row) for row in rows])
+    rows = [row if len(row) == n_cols else (row + [''] * n_cols)[:n_cols] for row in rows]
+    columns = list(zip(*rows))
+
+    values = np.empty((len(rows), len(val_cols)), dtype=np.float64)
+    for j, cols in enumerate(val_cols):
+        values[:, j] = _convert_values(columns[cols[0]])
+        for col in cols[1:]:
+            present = lengths > col
+            values[present, j] = _convert_values(columns[col])[present]
+    return values
+
+
+def _convert_values(col):
+    """Returns a float64 array of the values in the sequence of strings 'col'.
+    Values that are not numbers are returned as NaN.
+    """
+    try:
+        return np.array(col, dtype=np.float64)
+    except ValueError:
+        pass
+
+    # At least one value is not a number, so convert one by one.  Remember the
+    # strings that are not numbers, as they are usually repeated, e.g. "No Data".
+    vals = np.empty(len(col), dtype=np.float64)
+    not_nums = set()
+    for i, v in enumerate(col):
+        if v in not_nums:
+            vals[i] = np.nan
+            continue
+        try:
+            vals[i] = float(v)
+        except ValueError:
+            not_nums.add(v)
+            vals[i] = np.nan
+    return vals
+
+
+def _convert_timestamps(col, ts_parser, filename, rows):
+    """Converts the timestamp strings in 'col' to Unix timestamps using the
+    timestamps.TimestampParser 'ts_parser'.  Returns the array of timestamps and a
+    boolean array indicating the rows that have a valid timestamp, or None instead of
+    the boolean array if all are valid.  'filename' and 'rows' are used for logging
+    rows with bad timestamps.
+    """
+    try:
+        # file may hold Unix timestamps
+        ts = np.array(col, dtype=np.float64)
+        good = ~np.isnan(ts)
+        for i in np.flatnonzero(~good):
+            logger.error('Error processing record from file %s: %s\nTimestamp cannot be NaN.' %
+                         (filename, rows[i]))
+    except ValueError:
+        ts_vals = []
+        good = np.ones(len(col), dtype=bool)
+        for i, v in enumerate(col):
+            try:
+                ts_vals.append(ts_parser(v))
+            except:
+                logger.exception('Error processing record from file %s: %s' % (filename, rows[i]))
+                good[i] = False
+                continue
+            if ts_vals[-1] != ts_vals[-1]:
+                # NaN timestamp
+                logger.error('Error processing record from file %s: %s\nTimestamp cannot be NaN.' %
+                             (filename, rows[i]))
+                ts_vals.pop()
+                good[i] = False
+        if all(type(t) is int for t in ts_vals):
+            ts = np.array(ts_vals, dtype=np.int64)
+        else:
+            ts = np.array(ts_vals, dtype=np.float64)
+        good = None if good.all() else good
+        return ts, good
+
+    if good.all():
+        return ts, None
+    return ts[good], good
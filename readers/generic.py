@@ -1,12 +1,11 @@
 """Class to read CSV files and create timestamped records.
 """
 import csv
-import calendar
 import logging
 import math
-import pytz
-from dateutil import parser
+from . import chunk
 from . import reader_util
+from . import timestamps
 
 # the error logger to use for this module
 logger = logging.getLogger(__name__)
@@ -14,8 +13,8 @@ logger = logging.getLogger(__name__)
 
 def generic_reader(filename, chunk_size=1, ts_field=None, ts_tz='UTC',
                  field_names=[], header_rows=1, name_row=1,
-                 field_map={}, exclude_fields=[],
-                 **csv_params):
+                 field_map={}, exclude_fields=[], resume=None, stats=None,
+                 compact=False, use_mmap=False, skip_to_ts=None, **csv_params):
     """This generator function is used to read CSV files and return chunks of records
     from those files. A chunk of records is a list of dictionaries, each dictionary being
     one record. One of the fields (columns) in the file must be a timestamp column, and that
@@ -36,7 +35,10 @@ def generic_reader(filename, chunk_size=1, ts_field=None, ts_tz='UTC',
 
     Parameters
     ----------
-    filename:  Required.  The full path to the CSV file to be read.
+    filename:  Required.  The full path to the CSV file to be read.  The file may be
+        compressed with gzip, bz2, xz or zstd, or be a member of a zip archive given as
+        "archive.zip::member"; see reader_util.open_input().  Compressed files are
+        always read from the start.
     chunk_size: The number of records to return with each iteration.  Default is 1.
         If more than one record is returned, the return value from the iterator is a list
         of records.
@@ -68,51 +70,104 @@ def generic_reader(filename, chunk_size=1, ts_field=None, ts_tz='UTC',
     exclude_fields:  A list of field names to exclude from the final records returned.
         These field names must be written in their final form, i.e. as one of the
         'field_names' items, or after translation by the 'field_map' parameter.
+    resume:  A dictionary holding the resume point from a prior read of this file,
+        or None (the default) to always read the whole file.  The dictionary is
+        updated in place before each chunk is yielded, and can be saved and passed
+        back in on the next read so that only rows appended to the file since the
+        last read are parsed.  If the file was rewritten or truncated, the whole file
+        is read.  See reader_util.seek_resume_point().  With a resume point, a final
+        line with no newline, which may still be being written, is not read until a
+        later read finds it complete.
+    stats:  An optional dictionary that collects statistics about the read, such as
+        the number of rows read and dropped.  It is updated in place before each chunk
+        is yielded and when the file is finished.  See reader_util.init_stats().
+    compact:  If True, each chunk of records is returned as a readers.chunk.RecordChunk
+        object, even if 'chunk_size' is 1, instead of as record dictionaries.  This
+        uses much less memory and time for files with many columns.  Default is False.
+    use_mmap:  If True, the file is read through a memory map, so the ends of lines
+        and the resume point are found in the mapped file, and only the lines read are
+        copied and decoded; see reader_util.MappedLineReader.  Only use this for files
+        that are appended to, never truncated or rewritten in place, as reading a
+        mapped file that has been truncated ends the process.  Compressed files are
+        read as usual.  Default is False.
+    skip_to_ts:  For a file whose rows are in time order, the Unix timestamp that the
+        records needed are newer than, or None (the default).  If reading does not
+        continue from the 'resume' point and the file is not compressed, the rows at
+        or before this time are skipped with a binary search of the file instead of
+        being parsed; see reader_util.seek_time().  A few rows at or before this time
+        may still be returned.
     **csv_params:  Any other keyword arguments found are passed along to the csv.Reader
         initialization function and can be used to correctly specify delimiters and
         quoting formats found in the CSV file.
     """
 
-    recs = []
-    tstz = pytz.timezone(ts_tz)
-    with open(filename) as csvfile:
+    stats = reader_util.init_stats(stats)
+    csvfile, compressed = reader_util.open_input(filename)
+    if compressed:
+        # compressed files are read from the start, without a resume point
+        resume = None
+    with csvfile, reader_util.line_reader(csvfile, use_mmap and not compressed,
+                                          resume is not None) as lines:
 
-        reader = csv.reader(csvfile, **csv_params)
+        reader = csv.reader(lines, **csv_params)
 
         # read the header rows into a list
         headers = [next(reader) for i in range(header_rows)]
 
-        # if field names are specified, use those.  If not, use the proper
-        # header row and apply the field_map to possibly change names.
-        # Strip white space from names.
-        if len(field_names):
-            names = [fld.strip() for fld in field_names]
-        else:
-            names = headers[name_row - 1]    # name_row is 1-based
-            names = [fld.strip() for fld in names]
-
-            # Convert the field names with the field_map.
-            names = reader_util.apply_field_map(field_map, names)
-
-        # Change the timestamp field name to 'ts'
-        if not ts_field:
-            # if no timestamp field is given, use the first column for the timestamp
-            names[0] = 'ts'
-        else:
-            # find the requested field and set its name to 'ts'
-            try:
-                names[names.index(ts_field)] = 'ts'
-            except ValueError:
-                raise ValueError('The requested timestamp field, %s, is not present.' % ts_field)
-
-        last_ts = 0
-        for row in reader:
-
-            # skip blank rows
-            if not len(row):
-                continue
-
-            try:
+        # determine the field names, with the timestamp field named 'ts'
+        names = reader_util.header_field_names(headers, field_names, name_row,
+                                               field_map, ts_field)
+
+        # skip the rows read on a prior pass, if the file has only been appended to.
+        resumed = False
+        if resume is not None:
+            resumed = reader_util.seek_resume_point(lines, resume)
+
+        # otherwise, skip the old rows of a time-ordered file
+        if skip_to_ts and not resumed and not compressed:
+            row_ts = reader_util.row_ts_func(names, timestamps.TimestampParser(ts_tz), csv_params)
+            reader_util.seek_time(lines, skip_to_ts, row_ts, resume)
+
+        yield from read_records(reader, lines, names, chunk_size, ts_tz, exclude_fields,
+                                resume, stats, compact, filename)
+
+
+def read_records(reader, lines, names, chunk_size=1, ts_tz='UTC', exclude_fields=[],
+                 resume=None, stats=None, compact=False, filename=''):
+    """Generator that does the work of generic_reader() once the header rows have
+    been read, converting the rows from the csv.reader 'reader' into records and
+    yielding them in chunks.  'lines' is the reader_util.OffsetLineReader that
+    'reader' reads from, and 'names' is the list of field names of the columns, with
+    the timestamp field named 'ts'.  'filename' is used in log messages.  The other
+    parameters are described in generic_reader().
+    """
+    stats = reader_util.init_stats(stats)
+    recs = []
+    # converts timestamps found in the file into Unix timestamps
+    ts_parser = timestamps.TimestampParser(ts_tz)
+
+    if compact:
+        # build compact chunks, using a plan of the columns made once
+        recs = chunk.ChunkBuilder(names, exclude_fields)
+        ts_col = len(names) - 1 - names[::-1].index('ts')
+
+    last_ts = 0
+    for row in reader:
+
+        # skip blank rows
+        if not len(row):
+            continue
+        stats['rows_read'] += 1
+
+        try:
+            if compact:
+                ts = ts_parser(row[ts_col])
+                if math.isnan(ts):
+                    raise ValueError('Timestamp cannot be NaN.')
+                recs.add_row(ts, row)
+                last_ts = ts
+
+            else:
                 # make a dictionary from the values, with keys as the field names
                 rec = dict(list(zip(names, row)))
 
@@ -121,14 +176,7 @@ def generic_reader(filename, chunk_size=1, ts_field=None, ts_tz='UTC',
                     rec.pop(fld, None)
 
                 # make timestamp a Unix epoch timestamp
-                try:
-                    # assume field is already Unix epoch timestamp
-                    rec['ts'] = float(rec['ts'])
-                except:
-                    # treat this as a string date
-                    dt = parser.parse(rec['ts'])
-                    dt = tstz.localize(dt)
-                    rec['ts'] = calendar.timegm(dt.utctimetuple())
+                rec['ts'] = ts_parser(rec['ts'])
 
                 if math.isnan(rec['ts']):
                     raise ValueError('Timestamp cannot be NaN.')
@@ -149,17 +197,30 @@ def generic_reader(filename, chunk_size=1, ts_field=None, ts_tz='UTC',
 
                 recs.append(rec)
 
-                # if we have accumulated the desired number of records, release them
-                if len(recs) == chunk_size:
-                    if chunk_size != 1:
-                        yield recs, last_ts
-                    else:
-                        # yield the individual record, not a 1-element list
-                        yield recs[0], last_ts
+            # if we have accumulated the desired number of records, release them
+            if len(recs) == chunk_size:
+                stats['bytes_read'] = lines.bytes_read
+                if resume is not None:
+                    reader_util.mark_resume_point(lines, resume)
+                if compact:
+                    yield recs.take(), last_ts
+                elif chunk_size != 1:
+                    yield recs, last_ts
+                else:
+                    # yield the individual record, not a 1-element list
+                    yield recs[0], last_ts
+                if not compact:
                     recs = []
-            except:
-                logger.exception('Error processing record from file %s: %s' % (filename, row))
-
-        # there may be a partial chunk to yield.
-        if len(recs):
-            yield recs, last_ts
+        except Exception:
+            # not a bare except, which would catch the GeneratorExit raised at
+            # the yield above when the generator is closed early.
+            logger.exception('Error processing record from file %s: %s' % (filename, row))
+            stats['rows_dropped'] += 1
+            stats['parse_errors'] += 1
+
+    # there may be a partial chunk to yield.
+    stats['bytes_read'] = lines.bytes_read
+    if len(recs):
+        if resume is not None:
+            reader_util.mark_resume_point(lines, resume)
+        yield (recs.take() if compact else recs), last_ts
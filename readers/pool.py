@@ -0,0 +1,110 @@
+"""Class to read CSV files in a pool of worker processes, so that a pass
+through many files is not limited to one CPU core.  The chunks of records read
+by the workers are streamed back to the parent process through a bounded queue.
+"""
+import logging
+import multiprocessing
+import time
+
+# the queue that a worker process puts its results on, and the event that is set
+# to stop the reading of files.  Set when the worker process starts.
+_results_q = None
+_cancel = None
+
+
+def _init_worker(results_q, cancel):
+    """Initializes a worker process of the pool.
+    """
+    global _results_q, _cancel
+    _results_q = results_q
+    _cancel = cancel
+
+
+def _read_file(job_id, reader_func, filename, spec, min_ts, resume):
+    """Reads the file 'filename' with the file reader function 'reader_func', which
+    is passed the 'spec' keyword arguments and the 'resume' dictionary.  Each chunk is
+    put on the results queue as a (job_id, recs, last_ts, resume) tuple.  Chunks with
+    no records newer than 'min_ts' are sent with an empty record list, as only their
+    resume point is needed.  A final (job_id, None, None, stats) tuple indicates the
+    file is finished, where 'stats' is the dictionary of reader statistics described in
+    reader_util.init_stats(), plus 'read_seconds', the time spent reading the file, and
+    'error', True if reading the file stopped because of an error.  Reading stops,
+    with 'error' True, when the pool's cancel event is set.
+    """
+    stats = {'read_seconds': 0.0, 'error': False}
+    start = time.perf_counter()
+    try:
+        for recs, last_ts in reader_func(filename, resume=resume, stats=stats, **spec):
+            if _cancel.is_set():
+                stats['error'] = True
+                break
+            if last_ts <= min_ts:
+                recs = []
+            # don't count the time waiting for room on the results queue
+            stats['read_seconds'] += time.perf_counter() - start
+            _results_q.put((job_id, recs, last_ts, resume.copy()))
+            start = time.perf_counter()
+    except:
+        logging.exception('Error processing file: %s' % filename)
+        stats['error'] = True
+    finally:
+        stats['read_seconds'] += time.perf_counter() - start
+        _results_q.put((job_id, None, None, stats))
+
+
+class ReaderPool:
+    """A pool of worker processes that read CSV files.
+
+    The pool uses the 'fork' start method so that the main script is not
+    re-imported by each worker.  Create the pool before starting any threads,
+    such as those of the consumers.
+
+    Parameters
+    ----------
+    processes:  The number of worker processes.
+    max_chunks:  The maximum number of chunks of records that can be waiting to be
+        delivered to the parent process.  Workers wait when this limit is reached,
+        which limits memory use.
+    """
+
+    def __init__(self, processes, max_chunks=100):
+        ctx = multiprocessing.get_context('fork')
+        self.results_q = ctx.Queue(max_chunks)
+        self.cancel = ctx.Event()
+        self.pool = ctx.Pool(processes, _init_worker, (self.results_q, self.cancel))
+
+    def read_files(self, jobs):
+        """Generator that reads files in the worker processes.  'jobs' is a list
+        of (reader_func, filename, spec, min_ts, resume) tuples: see _read_file() for
+        a description.  Yields (job_index, recs, last_ts, resume) tuples as chunks
+        arrive, where 'job_index' is the index of the job in 'jobs'.  Chunks from
+        different files are interleaved, but the chunks of one file are yielded in
+        the order they were read.  When a file is finished, a tuple with None for
+        'recs' and 'last_ts', and the reader statistics in place of 'resume', is
+        yielded.  Closing the generator before all of the files are finished stops
+        the workers reading them.
+        """
+        for job_id, job in enumerate(jobs):
+            self.pool.apply_async(_read_file, (job_id,) + tuple(job))
+
+        unfinished = len(jobs)
+        try:
+            while unfinished:
+                result = self.results_q.get()
+                if result[1] is None:
+                    unfinished -= 1
+                yield result
+        finally:
+            if unfinished:
+                # Stop the workers after the chunk each is reading, and discard the
+                # chunks already sent, so the queue is empty for the next call.
+                self.cancel.set()
+                while unfinished:
+                    if self.results_q.get()[1] is None:
+                        unfinished -= 1
+                self.cancel.clear()
+
+    def close(self):
+        """Stops the worker processes.
+        """
+        self.pool.terminate()
@@ -1,5 +1,47 @@
 """Utility functions useful for reading CSV files.
 """
+import bz2
+import csv
+import fnmatch
+import gzip
+import hashlib
+import io
+import locale
+import lzma
+import mmap
+import os
+import zipfile
+
+try:
+    # the standard library module, Python 3.14 and later
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+# Number of bytes immediately preceding a resume offset that are fingerprinted.
+# If these bytes change, the file was rewritten, not appended to.
+TAIL_BYTES = 64
+
+# When searching a time-ordered file for the first new row, the search stops once
+# the part of the file holding that row is this many bytes or less.
+BISECT_BYTES = 65536
+
+# Separates the path of a zip archive from the name of a member of the archive,
+# e.g. "/data/logs-2017.zip::logs/hourly.csv".
+ARCHIVE_SEP = '::'
+
+# The magic bytes at the start of compressed files, and the function that opens
+# each type of file for reading.
+COMPRESSED_MAGIC = (
+    (b'\x1f\x8b', gzip.open),
+    (b'BZh', bz2.open),
+    (b'\xfd7zXZ\x00', lzma.open),
+    (b'\x28\xb5\x2f\xfd', None),       # zstd, opened by _open_zstd()
+    )
+
 
 def apply_field_map(field_map, names):
     """Returns an altered a list of field names, 'names'
@@ -37,3 +79,362 @@ def apply_field_map(field_map, names):
             raise ValueError('The field_map function "%s" is not valid.' % field_map)
 
     return new_names
+
+
+def header_field_names(headers, field_names, name_row, field_map, ts_field):
+    """Returns the list of field names for the columns of a CSV file, with the
+    timestamp column named 'ts'.  'headers' is the list of header rows read from
+    the file.  The other parameters are described in readers.generic.generic_reader().
+    Raises a ValueError if the 'ts_field' is not present.
+    """
+    # if field names are specified, use those.  If not, use the proper
+    # header row and apply the field_map to possibly change names.
+    # Strip white space from names.
+    if len(field_names):
+        names = [fld.strip() for fld in field_names]
+    else:
+        names = headers[name_row - 1]    # name_row is 1-based
+        names = [fld.strip() for fld in names]
+
+        # Convert the field names with the field_map.
+        names = apply_field_map(field_map, names)
+
+    # Change the timestamp field name to 'ts'
+    if not ts_field:
+        # if no timestamp field is given, use the first column for the timestamp
+        names[0] = 'ts'
+    else:
+        # find the requested field and set its name to 'ts'
+        try:
+            names[names.index(ts_field)] = 'ts'
+        except ValueError:
+            raise ValueError('The requested timestamp field, %s, is not present.' % ts_field)
+
+    return names
+
+
+class OffsetLineReader:
+    """Iterator that returns the decoded lines of a file opened in binary mode,
+    suitable for passing to csv.reader().  The 'offset' attribute holds the byte
+    offset just past the last *complete* (newline terminated) line returned, so
+    a partially written final line is never counted as read.  The 'bytes_read'
+    attribute holds the total number of bytes read through this object.
+
+    Parameters
+    ----------
+    fileobj: A file object opened in binary mode.
+    encoding: The text encoding of the file.  Defaults to the locale's preferred
+        encoding, which is what open() uses for text files.
+    complete_only: If True, iteration stops at a final line with no newline,
+        instead of returning it.  The line may be one that a data logger is still
+        writing, which would be parsed into a bad row; it is read on a later pass,
+        once it is complete.
+    """
+
+    def __init__(self, fileobj, encoding=None, complete_only=False):
+        self.fileobj = fileobj
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self.complete_only = complete_only
+        self.offset = fileobj.tell()
+        self.bytes_read = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.fileobj.readline()
+        if not line:
+            raise StopIteration
+        if line.endswith(b'\n'):
+            self.offset += len(line)
+        elif self.complete_only:
+            raise StopIteration
+        self.bytes_read += len(line)
+        return line.decode(self.encoding)
+
+    def seek(self, offset):
+        """Positions the reader at byte 'offset' of the file.
+        """
+        self.fileobj.seek(offset)
+        self.offset = offset
+
+    def hash_range(self, start, end):
+        """Returns the MD5 hex digest of bytes 'start' up to 'end' of the file.
+        """
+        return hash_range(self.fileobj, start, end)
+
+    def close(self):
+        """Releases the resources held by the reader.  The file object is closed by
+        the caller.
+        """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MappedLineReader(OffsetLineReader):
+    """An OffsetLineReader that reads the file through a read-only memory map
+    instead of reading it into buffers.  The ends of lines are found and the resume
+    point is checked directly in the mapped file, and only the lines returned are
+    copied out of the map and decoded.  Only the bytes in the file when it was
+    mapped are read.  The file should only be appended to while it is mapped; if it
+    is truncated, reading the lost bytes raises a SIGBUS signal that ends the
+    process.
+
+    Parameters
+    ----------
+    fileobj: A file object of a regular, non-empty file, opened in binary mode.
+    encoding: The text encoding of the file; see OffsetLineReader.
+    complete_only: If True, a final line with no newline is not returned; see
+        OffsetLineReader.
+    """
+
+    def __init__(self, fileobj, encoding=None, complete_only=False):
+        OffsetLineReader.__init__(self, fileobj, encoding, complete_only)
+        self.map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.map)
+        # the position of the next line to return
+        self.pos = self.offset
+
+    def __next__(self):
+        pos = self.pos
+        if pos >= self.size:
+            raise StopIteration
+        end = self.map.find(b'\n', pos) + 1
+        if end:
+            self.offset = end
+        elif self.complete_only:
+            raise StopIteration
+        else:
+            # a final line with no newline
+            end = self.size
+        self.pos = end
+        self.bytes_read += end - pos
+        return self.map[pos:end].decode(self.encoding)
+
+    def seek(self, offset):
+        self.pos = self.offset = offset
+
+    def hash_range(self, start, end):
+        return hashlib.md5(self.map[start:end]).hexdigest()
+
+    def close(self):
+        self.map.close()
+
+
+def line_reader(fileobj, use_mmap=False, complete_only=False):
+    """Returns the reader that file readers pass to csv.reader() to read the lines
+    of the binary file object 'fileobj'.  If 'use_mmap' is True and the file can be
+    memory mapped, a MappedLineReader is returned, otherwise an OffsetLineReader.
+    'use_mmap' must be False for files that are decompressed as they are read.  If
+    'complete_only' is True, a final line with no newline is not read; readers set it
+    when they have a resume point, so the line is read on the next pass.  The reader
+    can be used in a 'with' statement to release the memory map.
+    """
+    if use_mmap:
+        try:
+            return MappedLineReader(fileobj, complete_only=complete_only)
+        except (AttributeError, OSError, ValueError):
+            # not a regular file, or an empty file, which can't be mapped
+            pass
+    return OffsetLineReader(fileobj, complete_only=complete_only)
+
+
+def _open_zstd(filename):
+    """Returns a binary file object that reads the decompressed contents of the
+    zstd compressed file 'filename'.
+    """
+    if zstd is None:
+        raise ValueError('Reading the zstd compressed file %s requires the zstandard '
+                         'package (pip install zstandard).' % filename)
+    if hasattr(zstd, 'ZstdDecompressor') and hasattr(zstd.ZstdDecompressor, 'stream_reader'):
+        # the zstandard package
+        reader = zstd.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True)
+        return io.BufferedReader(reader)
+    return zstd.open(filename, 'rb')
+
+
+def open_input(filename):
+    """Opens the file 'filename' for reading in binary mode, decompressing it as it
+    is read if it is compressed with gzip, bz2, xz or zstd.  The type of compression
+    is found from the first bytes of the file, not from its name.  If 'filename' has
+    the form "archive.zip::member", the member of the zip archive is read.  Compressed
+    files are decompressed a buffer at a time, so memory use does not grow with the
+    size of the file.
+
+    Returns a (fileobj, compressed) tuple, where 'fileobj' is the binary file object
+    and 'compressed' is True if the file is decompressed as it is read.  Compressed
+    files can't be positioned at a byte offset efficiently, so readers read them from
+    the start and don't use a resume point.
+    """
+    if ARCHIVE_SEP in filename:
+        archive, member = filename.split(ARCHIVE_SEP, 1)
+        with zipfile.ZipFile(archive) as zf:
+            # the member stays open after the archive is closed
+            return zf.open(member), True
+
+    f = open(filename, 'rb')
+    try:
+        start = f.read(6)
+        f.seek(0)
+        for magic, open_func in COMPRESSED_MAGIC:
+            if start.startswith(magic):
+                f.close()
+                if open_func is None:
+                    return _open_zstd(filename), True
+                return open_func(filename, 'rb'), True
+    except:
+        f.close()
+        raise
+    return f, False
+
+
+def archive_members(archive, member_pattern):
+    """Returns the list of the names, in the form "archive::member", of the members
+    of the zip archive 'archive' that match the glob pattern 'member_pattern'.
+    Directories in the archive are not included.
+    """
+    with zipfile.ZipFile(archive) as zf:
+        return ['%s%s%s' % (archive, ARCHIVE_SEP, info.filename) for info in zf.infolist()
+                if not info.is_dir() and fnmatch.fnmatchcase(info.filename, member_pattern)]
+
+
+def init_stats(stats):
+    """Prepares the dictionary 'stats', passed to a reader to collect statistics
+    about the read of a file, by adding the statistics that are missing with a value
+    of 0.  If 'stats' is None, a new dictionary is returned.  The statistics are:
+
+        'rows_read': number of data rows read, not counting blank rows.
+        'rows_dropped': number of data rows that did not produce a record, because
+            of a bad timestamp or other error.
+        'parse_errors': number of exceptions raised while processing rows.
+        'bytes_read': number of bytes read from the file, after decompression.
+
+    Returns the dictionary.
+    """
+    if stats is None:
+        stats = {}
+    for key in ('rows_read', 'rows_dropped', 'parse_errors', 'bytes_read'):
+        stats.setdefault(key, 0)
+    return stats
+
+
+def hash_range(fileobj, start, end):
+    """Returns the MD5 hex digest of bytes 'start' up to 'end' of the binary
+    file object 'fileobj'.  The current file position is preserved.
+    """
+    pos = fileobj.tell()
+    fileobj.seek(start)
+    digest = hashlib.md5(fileobj.read(end - start)).hexdigest()
+    fileobj.seek(pos)
+    return digest
+
+
+def seek_resume_point(lines, resume):
+    """Called by a reader after it has read the header rows of a file through
+    the OffsetLineReader 'lines'.  'resume' is a dictionary describing where
+    reading stopped on a prior pass through the file; it is empty if there is
+    no prior pass.  If 'resume' refers to this same file (same device and inode),
+    the header is unchanged and the bytes just before the resume offset are
+    unchanged, 'lines' is positioned at the resume offset so only appended data
+    is read.  Otherwise, reading continues from the end of the header (a full scan).
+    'resume' is updated in place to describe the current file.
+
+    Returns True if reading was resumed, False if a full scan will occur.
+    """
+    f = lines.fileobj
+    header_end = lines.offset
+    st = os.fstat(f.fileno())
+    file_id = (st.st_dev, st.st_ino)
+    header_hash = lines.hash_range(0, header_end)
+    offset = resume.get('offset', 0)
+
+    resumed = (resume.get('file_id') == file_id and
+               resume.get('header_hash') == header_hash and
+               header_end < offset <= st.st_size and
+               resume.get('tail_hash') == lines.hash_range(max(header_end, offset - TAIL_BYTES), offset))
+
+    resume['file_id'] = file_id
+    resume['header_hash'] = header_hash
+    resume['header_end'] = header_end
+    if resumed:
+        lines.seek(offset)
+    else:
+        mark_resume_point(lines, resume)
+
+    return resumed
+
+
+def mark_resume_point(lines, resume, offset=None):
+    """Records in the 'resume' dictionary the position just past the last
+    complete line read through the OffsetLineReader 'lines'.  Readers call
+    this before yielding each chunk of records.  Readers that read ahead of the
+    records they yield pass the byte 'offset' just past the last record yielded.
+    """
+    if offset is None:
+        offset = lines.offset
+    resume['offset'] = offset
+    resume['tail_hash'] = lines.hash_range(max(resume['header_end'], offset - TAIL_BYTES),
+                                           offset)
+
+
+def row_ts_func(names, ts_parser, csv_params):
+    """Returns a function that converts a line of a CSV file into the Unix timestamp
+    of the row, for use with seek_time().  'names' is the list of field names, with
+    the timestamp field named 'ts', 'ts_parser' is the timestamps.TimestampParser of
+    the file, and 'csv_params' holds the csv.reader() parameters of the file.
+    """
+    ts_col = len(names) - 1 - names[::-1].index('ts')
+
+    def row_ts(line):
+        return ts_parser(next(csv.reader([line], **csv_params))[ts_col])
+
+    return row_ts
+
+
+def seek_time(lines, min_ts, row_ts, resume=None):
+    """Called by a reader, after it has read the header rows of a file whose rows are
+    in time order, to skip the rows with timestamps at or before 'min_ts' without
+    parsing them.  This is used when there is no resume point for the file, such as
+    the first time an existing file is read.  A binary search on byte position reads
+    the row starting just after the middle of the part of the file being searched,
+    and converts its line to a timestamp with the function 'row_ts', until the part of
+    the file holding the first row newer than 'min_ts' is BISECT_BYTES or less.  A line
+    that is incomplete or has no valid timestamp is treated as newer than 'min_ts'.
+
+    The OffsetLineReader 'lines' is positioned at the start of the last row found at
+    or before 'min_ts', or is left at the first data row, so a few rows that are not
+    new may still be read.  If 'resume' is not None, the position is recorded in it.
+    Returns the number of bytes skipped.  Files with quoted fields holding newlines
+    should not be searched, as a line in the middle of such a field can't be parsed.
+    """
+    f = lines.fileobj
+    start_offset = lo = lines.offset
+    hi = os.fstat(f.fileno()).st_size
+    while hi - lo > BISECT_BYTES:
+        mid = (lo + hi) // 2
+        # find the start of the first line at or after 'mid'
+        f.seek(mid - 1)
+        f.readline()
+        row_start = f.tell()
+        line = f.readline()
+        ts = None
+        if row_start < hi and line.endswith(b'\n'):
+            try:
+                ts = row_ts(line.decode(lines.encoding))
+            except Exception:
+                pass
+        # a NaN timestamp fails this test
+        if ts is not None and ts <= min_ts:
+            lo = row_start
+        else:
+            hi = mid
+
+    lines.seek(lo)
+    if resume is not None:
+        mark_resume_point(lines, resume)
+    return lo - start_offset
@@ -22,19 +22,37 @@ Here is a sample file that can be read:
 "6/5/2017","00:15:00","2480.7764","1062912","No Data","558.64","24.31","70.51","64.5"
 "6/5/2017","00:20:00","2480.7764","1062912","No Data","558.64","24.31","70.51","64.5"
 
+A file can hold more than one report block, each starting with its own list of
+Points and its own "<>Date" header row, as happens when reports are appended to
+one file.  The records of each block use the Point names of that block.
+
+Values are converted by a converter chosen for each column from the first value
+in the column: columns of numbers use float(), and other columns, such as those
+of on/off Points or those that are always "No Data", look their values up in a
+table, so a column that is never numeric does not raise an exception on every row.
 """
 import csv
-import calendar
 import logging
-import math
+import re
 import string
-import pytz
-from dateutil import parser
+from . import chunk
 from . import reader_util
+from . import timestamps
 
 # the error logger to use for this module
 logger = logging.getLogger(__name__)
 
+# translates whitespace and punctuation to underscores
+_CLEAN_TABLE = str.maketrans(string.whitespace + string.punctuation,
+                             '_' * len(string.whitespace + string.punctuation))
+
+# values of Points that are not numbers, after being made lower case and stripped
+SPECIAL_VALUES = {'on': 1.0, 'off': 0.0}
+
+# The maximum number of different strings that a column's lookup converter
+# remembers.  Strings beyond this are converted each time they occur.
+LOOKUP_SIZE = 100
+
 
 def clean_string(s):
     """Function that "cleans" a string by first stripping leading and trailing
@@ -46,21 +64,145 @@ def clean_string(s):
     -----------------
     s:  The string to clean.
     """
-    to_sub = string.whitespace + string.punctuation
-    trans_table = string.maketrans(to_sub, len(to_sub) * '_')
-    fixed = string.translate(s.strip(), trans_table)
+    return re.sub('_{2,}', '_', s.strip().translate(_CLEAN_TABLE))
+
+
+def convert_value(s):
+    """Returns the float value of the string 's' from a Siemens report, or None if
+    it is missing, such as "No Data" or "NaN".  "On" and "Off" are 1.0 and 0.0.
+    """
+    try:
+        v = float(s)
+        # do not include NaN values
+        return None if v != v else v
+    except ValueError:
+        return SPECIAL_VALUES.get(s.lower().strip())
+
+
+def to_float(s):
+    """The converter for numeric columns.  Returns the same value as convert_value().
+    """
+    try:
+        v = float(s)
+    except ValueError:
+        return SPECIAL_VALUES.get(s.lower().strip())
+    return None if v != v else v
+
+
+def make_converter(first):
+    """Returns the converter function for a column whose first value is the string
+    'first'.  A converter is passed a value string and returns the value as
+    convert_value() does.
+    """
+    if convert_value(first) is not None and first.lower().strip() not in SPECIAL_VALUES:
+        return to_float
+
+    # a column of on/off or missing values.  Remember the value of each string.
+    table = {}
+
+    def lookup(s):
+        try:
+            return table[s]
+        except KeyError:
+            v = convert_value(s)
+            if len(table) < LOOKUP_SIZE:
+                table[s] = v
+            return v
+
+    return lookup
+
+
+class _Block:
+    """The columns of one report block of a file.
+
+    Parameters
+    ----------
+    columns:  List of the cleaned Point names of the value columns of the block, in
+        column order.
+    field_names, field_map, exclude_fields:  See siemens_reader().
+    """
 
-    while True:
-        new_fixed = fixed.replace('_' * 2, '_')
-        if new_fixed == fixed:
-            break
-        fixed = new_fixed
+    def __init__(self, columns, field_names, field_map, exclude_fields):
+        self.columns = columns
+        if len(field_names):
+            names = [fld.strip() for fld in field_names]
+        else:
+            names = reader_util.apply_field_map(field_map, columns)
+
+        # the name used for each column of the row, after the date and time
+        # columns.  Names beyond the columns present are not used.
+        self.col_names = ['', ''] + names[:len(columns)]
+
+        # The name and row column of each field to include.  When a name is
+        # repeated, the value comes from its last column, as when a dictionary is
+        # made from the row.
+        plan = {}
+        for col, nm in enumerate(self.col_names[2:], 2):
+            plan[nm] = col
+        for nm in exclude_fields:
+            plan.pop(nm, None)
+        self.names = list(plan.keys())
+        self.cols = list(plan.values())
+        self.n_cols = max(self.cols) + 1 if self.cols else 0
+
+        # the converter of each field, learned from its first value
+        self.convs = [self._learner(i) for i in range(len(self.names))]
+
+    def _learner(self, i):
+        """Returns a converter for field 'i' that chooses the field's converter from
+        the first value it is passed.
+        """
+        def learn(s):
+            conv = self.convs[i] = make_converter(s)
+            return conv(s)
+        return learn
+
+    def record(self, row):
+        """Returns the record dictionary, without the timestamp, of the values in the
+        list of strings 'row'.
+        """
+        rec = {}
+        if len(row) >= self.n_cols:
+            for nm, col, conv in zip(self.names, self.cols, self.convs):
+                v = conv(row[col])
+                if v is not None:
+                    rec[nm] = v
+        else:
+            # a short row
+            for nm, col, conv in zip(self.names, self.cols, self.convs):
+                if col < len(row):
+                    v = conv(row[col])
+                    if v is not None:
+                        rec[nm] = v
+        return rec
+
+    def values(self, row):
+        """Returns the values of the list of strings 'row' as a (values, valid)
+        tuple of lists, for readers.chunk.ChunkBuilder.add_values().
+        """
+        if len(row) >= self.n_cols:
+            vals = [conv(row[col]) for col, conv in zip(self.cols, self.convs)]
+        else:
+            # a short row
+            n = len(row)
+            vals = [conv(row[col]) if col < n else None
+                    for col, conv in zip(self.cols, self.convs)]
+        return ([0.0 if v is None else v for v in vals],
+                [0 if v is None else 1 for v in vals])
 
-    return fixed
+
+def _block_columns(points, header):
+    """Returns the list of cleaned Point names of the value columns of a report
+    block.  'points' maps a Point key, such as "Point_1", to its cleaned Point name,
+    and 'header' is the "<>Date" header row of the block.  Columns without a Point
+    are named from the header.
+    """
+    return [points.get(key.strip(), clean_string(key)) for key in header[2:]]
 
 
 def siemens_reader(filename, chunk_size=1, ts_tz='UTC', field_names=[], field_map={},
-                   exclude_fields=[], **csv_params):
+                   exclude_fields=[], resume=None, stats=None, compact=False, use_mmap=False,
+                   **csv_params):
     """This generator function reads CSV report files from a Siemens
     building automation system running Insight (version 3.7.0, 2005) software.
     The function yields chunks of records from those files.
@@ -82,7 +224,10 @@ def siemens_reader(filename, chunk_size=1, ts_tz='UTC', field_names=[], field_ma
 
     Parameters
     ----------
-    filename:  Required.  The full path to the CSV file to be read.
+    filename:  Required.  The full path to the CSV file to be read.  The file may be
+        compressed with gzip, bz2, xz or zstd, or be a member of a zip archive given as
+        "archive.zip::member"; see reader_util.open_input().  Compressed files are
+        always read from the start.
     chunk_size: The number of records to return with each iteration.  Default is 1.
         If more than one record is returned, the return value from the iterator is a list
         of records.
@@ -109,91 +254,128 @@ def siemens_reader(filename, chunk_size=1, ts_tz='UTC', field_names=[], field_ma
         These field names must be written in their final form, i.e. as one of the
         'field_names' items, or as one of the translated Point names if field_names
         are not provided.
+    resume:  A dictionary holding the resume point from a prior read of this file,
+        or None (the default) to always read the whole file.  See the 'resume'
+        parameter of readers.generic.generic_reader().
+    stats:  An optional dictionary that collects statistics about the read.  See the
+        'stats' parameter of readers.generic.generic_reader().
+    compact:  If True, chunks of records are returned as readers.chunk.RecordChunk
+        objects.  See the 'compact' parameter of readers.generic.generic_reader().
+    use_mmap:  If True, the file is read through a memory map.  See the 'use_mmap'
+        parameter of readers.generic.generic_reader().
     **csv_params:  Any other keyword arguments found are passed along to the csv.Reader
         initialization function and can be used to correctly specify delimiters and
         quoting formats found in the CSV file.
     """
 
+    stats = reader_util.init_stats(stats)
     recs = []
-    tstz = pytz.timezone(ts_tz)
-    with open(filename) as csvfile:
+    # converts the date and time columns into Unix timestamps
+    ts_parser = timestamps.TimestampParser(ts_tz)
+    csvfile, compressed = reader_util.open_input(filename)
+    if compressed:
+        # compressed files are read from the start, without a resume point
+        resume = None
+    with csvfile, reader_util.line_reader(csvfile, use_mmap and not compressed,
+                                          resume is not None) as lines:
 
-        reader = csv.reader(csvfile, **csv_params)
+        reader = csv.reader(lines, **csv_params)
 
-        # read all lines through the header row, gathering up
-        # point names along the way.
-        names = []
+        # read all lines through the header row of the first report block,
+        # gathering up point names along the way.
+        points = {}
         ln = next(reader)
-        while ln[0] != '<>Date':
-            if ln[0].startswith('Point_'):
-                names.append(clean_string(ln[1]))
+        while not ln or ln[0] != '<>Date':
+            if ln and ln[0].startswith('Point_'):
+                points[ln[0].strip().rstrip(':')] = clean_string(ln[1])
             ln = next(reader)
+        block = _Block(_block_columns(points, ln), field_names, field_map, exclude_fields)
 
-        # if field names are specified, use those, removing leading and
-        # trailing whitespace.
-        if len(field_names):
-            names = [fld.strip() for fld in field_names]
-        else:
-            # Convert the field names with the field_map.
-            names = reader_util.apply_field_map(field_map, names)
+        # The Points of a following report block, while its header is being read.
+        points = None
+
+        # skip the rows read on a prior pass, if the file has only been appended to.
+        if resume is not None:
+            if reader_util.seek_resume_point(lines, resume) and 'columns' in resume:
+                # the columns of the report block holding the resume point
+                block = _Block(resume['columns'], field_names, field_map, exclude_fields)
+                points = resume.get('points')
+
+        def mark_resume_point():
+            # records the resume point, along with the report block it is in
+            if resume is not None:
+                reader_util.mark_resume_point(lines, resume)
+                resume['columns'] = block.columns
+                resume['points'] = points
+
+        if compact:
+            # build compact chunks of the values converted by the block's converters
+            recs = chunk.ChunkBuilder(block.names, skip_names=())
 
         last_ts = 0
         for row in reader:
 
+            # Data rows start with the date.  Other rows are part of the header of
+            # a report block.
+            if not row or not row[0][:1].isdigit():
+                if not row:
+                    continue
+                if row[0].startswith('Point_'):
+                    if points is None:
+                        points = {}
+                    points[row[0].strip().rstrip(':')] = clean_string(row[1])
+                elif row[0] == '<>Date':
+                    # a new report block starts
+                    block = _Block(_block_columns(points or {}, row), field_names,
+                                   field_map, exclude_fields)
+                    points = None
+                    if compact:
+                        # a compact chunk holds the fields of one block
+                        builder = recs
+                        recs = chunk.ChunkBuilder(block.names, skip_names=())
+                        if len(builder):
+                            stats['bytes_read'] = lines.bytes_read
+                            mark_resume_point()
+                            yield builder.take(), last_ts
+                continue
+
             # skip rows with less than 3 fields
             if len(row) < 3:
                 continue
+            stats['rows_read'] += 1
 
             try:
-
-                # make a dictionary from the values, with keys as the field names
-                # Values are found in the 3rd column onward.
-                rec = dict(list(zip(names, row[2:])))
-
-                # make the timestamp
-                dt_str = ' '.join(row[:2])
-                dt = parser.parse(dt_str)
-                dt = tstz.localize(dt)
-                rec['ts'] = calendar.timegm(dt.utctimetuple())
-
-                # remove fields to exclude
-                for fld in exclude_fields:
-                    rec.pop(fld, None)
-
-                # remember last timestamp.
-                last_ts = rec['ts']
-
-                # convert all fields to floats (redundant for 'ts' field)
-                for k, v in list(rec.items()):
-                    try:
-                        rec[k] = float(v)
-                        # do not include NaN values
-                        if math.isnan(rec[k]):
-                            del rec[k]
-                    except:
-                        # Look for some other valid strings
-                        lower_val = v.lower().strip()
-                        if lower_val=='on':
-                            rec[k] = 1.0
-                        elif lower_val=='off':
-                            rec[k] = 0.0
-                        else:
-                            # Value is not recognized, so drop this field in this record
-                            del rec[k]
-
-                recs.append(rec)
+                ts = ts_parser.parse_date(row[0] + ' ' + row[1])
+                if compact:
+                    recs.add_values(ts, *block.values(row))
+                else:
+                    rec = block.record(row)
+                    rec['ts'] = ts
+                    recs.append(rec)
+                last_ts = ts
 
                 # if we have accumulated the desired number of records, release them
                 if len(recs) == chunk_size:
-                    if chunk_size != 1:
+                    stats['bytes_read'] = lines.bytes_read
+                    mark_resume_point()
+                    if compact:
+                        yield recs.take(), last_ts
+                    elif chunk_size != 1:
                         yield recs, last_ts
                     else:
                         # yield the individual record, not a 1-element list
                         yield recs[0], last_ts
-                    recs = []
-            except:
+                    if not compact:
+                        recs = []
+            except Exception:
+                # not a bare except, which would catch the GeneratorExit raised at
+                # the yield above when the generator is closed early.
                 logger.exception('Error processing record from file %s: %s' % (filename, row))
+                stats['rows_dropped'] += 1
+                stats['parse_errors'] += 1
 
         # there may be a partial chunk to yield.
+        stats['bytes_read'] = lines.bytes_read
         if len(recs):
-            yield recs, last_ts
+            mark_resume_point()
+            yield (recs.take() if compact else recs), last_ts
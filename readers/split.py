@@ -0,0 +1,247 @@
+"""Function to read a single large CSV file on several CPU cores.  The data rows
+after the header are split into byte ranges that end at row boundaries, each range
+is parsed by a worker process, and the chunks of records are yielded in file order.
+This produces the same records as the 'generic' reader, for files, such as a
+multi-gigabyte export from one data logger, that reading in parallel across files
+can't speed up.
+
+The worker processes are started once by start_workers(), before the script starts
+any threads.  If they were not started, the file is read in this process.
+"""
+import collections
+import csv
+import io
+import multiprocessing
+import os
+from . import generic
+from . import reader_util
+from . import timestamps
+
+# the pool of worker processes that parse the byte ranges, the number of
+# processes, and the ID of the process that started the pool.
+_pool = None
+_processes = 0
+_pool_pid = None
+
+# the number of bytes read at a time when finding the ends of the ranges
+SCAN_BYTES = 1048576
+
+
+def start_workers(processes):
+    """Starts the pool of 'processes' worker processes that parse the byte ranges of
+    files read by split_reader().  The pool uses the 'fork' start method, so the main
+    script is not re-imported by each worker; call this before starting any threads.
+    """
+    global _pool, _processes, _pool_pid
+    ctx = multiprocessing.get_context('fork')
+    _pool = ctx.Pool(processes)
+    _processes = processes
+    _pool_pid = os.getpid()
+
+
+def stop_workers():
+    """Stops the worker processes, if they were started.
+    """
+    global _pool
+    if _pool is not None:
+        _pool.terminate()
+        _pool = None
+
+
+def split_reader(filename, chunk_size=1, ts_field=None, ts_tz='UTC',
+                 field_names=[], header_rows=1, name_row=1,
+                 field_map={}, exclude_fields=[], split_mb=16, resume=None, stats=None,
+                 compact=False, use_mmap=False, skip_to_ts=None, **csv_params):
+    """This generator function reads CSV files and returns chunks of records from
+    those files, as readers.generic.generic_reader() does, and it accepts the same
+    parameters.  See that function for their documentation.  The header rows are
+    read once, in this process, and the data rows after them, or after the resume
+    point, are split into byte ranges of about 'split_mb' megabytes.  Each range ends
+    at a newline that is not inside a quoted field, found by counting the quote
+    characters from the start of the data rows.  The ranges are parsed by the worker
+    processes, using the same field names, and the chunks of records are yielded in
+    the order of the rows in the file.  A chunk never holds rows from two ranges, so
+    the last chunk of each range may hold fewer than 'chunk_size' records.
+
+    The file is read in this process, as generic_reader() reads it, if the worker
+    processes were not started by start_workers(), if this is a worker of another
+    pool, if the file is compressed, if the data rows fit in one range, or if
+    'csv_params' has an 'escapechar' or 'dialect', with which quote characters can't
+    be counted to find the ends of rows.
+
+    Additional Parameters
+    ---------------------
+    split_mb: The size in megabytes of the byte ranges parsed by the worker
+        processes.  Larger ranges use more memory, as the records of a whole range
+        are sent back at once.  Default is 16.
+    """
+
+    stats = reader_util.init_stats(stats)
+    csvfile, compressed = reader_util.open_input(filename)
+    if compressed:
+        # compressed files are read from the start, without a resume point
+        resume = None
+    with csvfile, reader_util.line_reader(csvfile, use_mmap and not compressed,
+                                          resume is not None) as lines:
+
+        reader = csv.reader(lines, **csv_params)
+
+        # read the header rows into a list
+        headers = [next(reader) for i in range(header_rows)]
+
+        # determine the field names, with the timestamp field named 'ts'
+        names = reader_util.header_field_names(headers, field_names, name_row,
+                                               field_map, ts_field)
+
+        # skip the rows read on a prior pass, if the file has only been appended to.
+        resumed = False
+        if resume is not None:
+            resumed = reader_util.seek_resume_point(lines, resume)
+
+        # otherwise, skip the old rows of a time-ordered file
+        if skip_to_ts and not resumed and not compressed:
+            row_ts = reader_util.row_ts_func(names, timestamps.TimestampParser(ts_tz), csv_params)
+            reader_util.seek_time(lines, skip_to_ts, row_ts, resume)
+
+        split_bytes = int(split_mb * 1048576)
+        data_start = lines.offset
+        data_end = 0 if compressed else os.fstat(csvfile.fileno()).st_size
+        if resume is not None:
+            # as in the reader of this process, don't parse a final line with no
+            # newline, which may still be being written.
+            data_end = _complete_end(csvfile, data_start, data_end)
+            lines.seek(data_start)
+        if (_pool is None or _pool_pid != os.getpid() or compressed or
+                data_end - data_start <= split_bytes or
+                'escapechar' in csv_params or 'dialect' in csv_params):
+            yield from generic.read_records(reader, lines, names, chunk_size, ts_tz,
+                                            exclude_fields, resume, stats, compact, filename)
+            return
+
+        quotechar = None
+        if csv_params.get('quoting') != csv.QUOTE_NONE:
+            quotechar = csv_params.get('quotechar', '"').encode(lines.encoding)
+        ranges = _row_ranges(csvfile, data_start, data_end, split_bytes, quotechar)
+        params = (names, chunk_size, ts_tz, exclude_fields, compact, lines.encoding, csv_params)
+
+        # Keep the workers busy, but limit the number of ranges whose records are
+        # waiting to be yielded.  The results are taken in the order of the ranges.
+        pending = collections.deque()
+        bytes_read = lines.bytes_read
+        for start, end in ranges:
+            pending.append(_pool.apply_async(_parse_range, (filename, start, end) + params))
+            if len(pending) < 2 * _processes:
+                continue
+            bytes_read = yield from _range_results(pending.popleft().get(), lines, resume,
+                                                   stats, bytes_read)
+        while pending:
+            bytes_read = yield from _range_results(pending.popleft().get(), lines, resume,
+                                                   stats, bytes_read)
+
+
+def _range_results(result, lines, resume, stats, bytes_read):
+    """Generator that yields the chunks of records parsed from one byte range.
+    'result' is the value returned by _parse_range().  The statistics of the range
+    are added to 'stats', and 'resume' is updated before each chunk is yielded.
+    'lines' is the reader_util.OffsetLineReader of the file, and 'bytes_read' is the
+    number of bytes read from the file before this range.  Returns the number of
+    bytes read through the end of this range.
+    """
+    chunks, range_stats = result
+    for key in ('rows_read', 'rows_dropped', 'parse_errors'):
+        stats[key] += range_stats[key]
+    bytes_read += range_stats['bytes_read']
+    stats['bytes_read'] = bytes_read
+    for recs, last_ts, offset in chunks:
+        if resume is not None:
+            reader_util.mark_resume_point(lines, resume, offset)
+        yield recs, last_ts
+    return bytes_read
+
+
+def _complete_end(f, start, end):
+    """Returns the byte offset just past the last newline in bytes 'start' up to
+    'end' of the binary file object 'f', or 'start' if there is none.
+    """
+    pos = end
+    while pos > start:
+        n = min(SCAN_BYTES, pos - start)
+        f.seek(pos - n)
+        nl = f.read(n).rfind(b'\n')
+        if nl >= 0:
+            return pos - n + nl + 1
+        pos -= n
+    return start
+
+
+def _row_ranges(f, start, end, split_bytes, quotechar):
+    """Generator that splits bytes 'start' up to 'end' of the binary file object 'f'
+    into (start, end) ranges of about 'split_bytes' bytes.  Each range ends just past
+    a newline that is outside any quoted field, determined by counting the
+    'quotechar' bytes from 'start'; 'quotechar' is None if fields are not quoted.
+    """
+    pos = start
+    while end - pos > split_bytes:
+        # whether the position being scanned is inside a quoted field
+        in_quote = 0
+        scan = pos
+        if quotechar:
+            target = pos + split_bytes
+            f.seek(scan)
+            while scan < target:
+                buf = f.read(min(SCAN_BYTES, target - scan))
+                if not buf:
+                    break
+                in_quote ^= buf.count(quotechar) & 1
+                scan += len(buf)
+        else:
+            scan = pos + split_bytes
+
+        # find the first newline at or after 'scan' that ends a row
+        boundary = None
+        f.seek(scan)
+        while boundary is None and scan < end:
+            buf = f.read(min(65536, end - scan))
+            if not buf:
+                break
+            i = 0
+            while True:
+                nl = buf.find(b'\n', i)
+                if nl < 0:
+                    if quotechar:
+                        in_quote ^= buf.count(quotechar, i) & 1
+                    break
+                if quotechar:
+                    in_quote ^= buf.count(quotechar, i, nl) & 1
+                if not in_quote:
+                    boundary = scan + nl + 1
+                    break
+                i = nl + 1
+            scan += len(buf)
+
+        if boundary is None or boundary >= end:
+            break
+        yield pos, boundary
+        pos = boundary
+
+    yield pos, end
+
+
+def _parse_range(filename, start, end, names, chunk_size, ts_tz, exclude_fields, compact,
+                 encoding, csv_params):
+    """Runs in a worker process, parsing bytes 'start' up to 'end' of the file
+    'filename' into chunks of records with readers.generic.read_records().  Returns a
+    (chunks, stats) tuple, where 'chunks' is a list of (recs, last_ts, offset) tuples,
+    'offset' being the byte offset in the file just past the last row of the chunk,
+    and 'stats' holds the reader statistics of the range.
+    """
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    lines = reader_util.OffsetLineReader(io.BytesIO(data), encoding)
+    reader = csv.reader(lines, **csv_params)
+    stats = reader_util.init_stats(None)
+    chunks = [(recs, last_ts, start + lines.offset) for recs, last_ts in
+              generic.read_records(reader, lines, names, chunk_size, ts_tz, exclude_fields,
+                                   None, stats, compact, filename)]
+    return chunks, stats
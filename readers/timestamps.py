@@ -0,0 +1,240 @@
+"""Fast conversion of the date/time strings found in CSV files into Unix
+timestamps.
+
+Parsing every timestamp with dateutil.parser.parse() and localizing it with
+pytz is by far the largest per-row cost of reading a CSV file.  The
+TimestampParser class in this module infers the date/time format from the first
+timestamps in a file and then uses a compiled regular expression for each row.
+Conversion from local time to UTC uses a table of UTC offset transitions for the
+timezone that is built once.  Timestamps that don't match the inferred format, or
+that fall within an hour or so of a daylight savings transition, are processed
+exactly as before, with dateutil and pytz.
+"""
+import bisect
+import calendar
+import datetime
+import re
+import pytz
+
+# The Unix epoch and its proleptic Gregorian ordinal
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+def _time_re(sep):
+    """Returns the regular expression for the optional time portion of a timestamp,
+    e.g. "14:12", "14:12:00", "14:12:00.5" or "2:12:00 PM".  'sep' is the regular
+    expression for the separator between the date and the time.
+    """
+    return (r'(?:' + sep + r'(?P<hour>\d{1,2}):(?P<minute>\d{2})'
+            r'(?::(?P<second>\d{2})(?:\.\d+)?)?(?:\s*(?P<ampm>[AaPp][Mm]))?)?\s*$')
+
+
+# The date/time formats that have a fast path, in the order they are tried when
+# inferring the format of a file.  The date portions are interpreted the same
+# way dateutil.parser.parse() interprets them.
+FORMATS = [
+    # 12/22/2015 14:12, the format used by Campbell Scientific and Siemens Insight
+    re.compile(r'\s*(?P<date>(?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<year>\d{4}))' + _time_re(r'\s+')),
+    # 2015-12-22 14:12:00 or 2015-12-22T14:12:00
+    re.compile(r'\s*(?P<date>(?P<year>\d{4})-(?P<month>\d{1,2})-(?P<day>\d{1,2}))' + _time_re(r'(?:T|\s+)')),
+    # 2015/12/22 14:12:00
+    re.compile(r'\s*(?P<date>(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<day>\d{1,2}))' + _time_re(r'\s+')),
+]
+
+# Number of timestamps examined while trying to infer the format of a file
+# before giving up and using dateutil for all timestamps.
+INFER_TRIES = 10
+
+
+class TimestampParser:
+    """Callable object that converts timestamps from one CSV file into Unix
+    timestamps (seconds past the epoch).  Create one object per file read, as
+    the format of the timestamps is inferred from the first timestamps passed
+    to the object.
+
+    Results are identical to the original approach of parsing with
+    dateutil.parser.parse(), localizing with pytz (is_dst=False) and converting
+    with calendar.timegm().
+
+    Parameters
+    ----------
+    ts_tz:  The timezone from the Olson database of the timestamps found in the
+        CSV file, e.g. "America/Anchorage".  Defaults to "UTC".
+    """
+
+    def __init__(self, ts_tz='UTC'):
+        self.tstz = pytz.timezone(ts_tz)
+        self._build_offset_table()
+
+        # the regular expression matching this file's timestamps, once inferred.
+        self._format = None
+        self._tries = 0
+
+        # True if the file's timestamps are already Unix timestamps.
+        self._epoch = False
+
+        # maps the date portion of a timestamp to the Unix timestamp of midnight
+        # on that date (local time, as if it were UTC).
+        self._day_secs = {}
+
+        # the last segment of the offset table used: start and end of the segment
+        # in local seconds, and the UTC offset in seconds.
+        self._seg = (0, 0, 0)
+
+    def __call__(self, ts_val):
+        """Converts the timestamp string 'ts_val' into a Unix timestamp.  If the
+        string is a number, it is assumed to already be a Unix timestamp, and it
+        is returned as a float.  Otherwise, the string is treated as a date/time
+        in the 'ts_tz' timezone and an integer Unix timestamp is returned.
+        """
+        if self._epoch:
+            try:
+                return float(ts_val)
+            except ValueError:
+                pass
+        elif self._format is None and self._tries < INFER_TRIES:
+            self._infer(ts_val)
+
+        if self._format is not None:
+            ts = self._fast_parse(ts_val)
+            if ts is not None:
+                return ts
+
+        try:
+            # assume field is already Unix epoch timestamp
+            return float(ts_val)
+        except ValueError:
+            return self._slow_parse(ts_val)
+
+    def parse_date(self, ts_val):
+        """Converts the date/time string 'ts_val' into an integer Unix timestamp.
+        Unlike calling the object, a number is not accepted as a Unix timestamp.
+        """
+        if self._format is None and self._tries < INFER_TRIES:
+            self._infer(ts_val)
+
+        if self._format is not None:
+            ts = self._fast_parse(ts_val)
+            if ts is not None:
+                return ts
+
+        return self._slow_parse(ts_val)
+
+    def _infer(self, ts_val):
+        """Determines the format of the timestamps in this file from the timestamp
+        string 'ts_val'.
+        """
+        self._tries += 1
+        try:
+            float(ts_val)
+            self._epoch = True
+            return
+        except ValueError:
+            pass
+        for fmt in FORMATS:
+            if fmt.match(ts_val):
+                self._format = fmt
+                return
+
+    def _fast_parse(self, ts_val):
+        """Converts 'ts_val' with the inferred format.  Returns None if 'ts_val'
+        does not match the format, in which case the slow path must be used.
+        """
+        m = self._format.match(ts_val)
+        if m is None:
+            return None
+
+        # seconds from the epoch to midnight of the date, treating local time as UTC.
+        date_str = m.group('date')
+        day_secs = self._day_secs.get(date_str)
+        if day_secs is None:
+            try:
+                day = datetime.date(int(m.group('year')), int(m.group('month')), int(m.group('day')))
+            except ValueError:
+                return None
+            day_secs = (day.toordinal() - EPOCH_ORDINAL) * 86400
+            self._day_secs[date_str] = day_secs
+
+        hour = minute = second = 0
+        if m.group('hour') is not None:
+            hour = int(m.group('hour'))
+            minute = int(m.group('minute'))
+            if m.group('second') is not None:
+                second = int(m.group('second'))
+            ampm = m.group('ampm')
+            if ampm is not None:
+                if not 1 <= hour <= 12:
+                    return None
+                if ampm.lower() == 'am':
+                    if hour == 12:
+                        hour = 0
+                elif hour != 12:
+                    hour += 12
+            if hour > 23 or minute > 59 or second > 59:
+                return None
+
+        local_secs = day_secs + hour * 3600 + minute * 60 + second
+
+        seg_start, seg_end, offset = self._seg
+        if not seg_start <= local_secs < seg_end:
+            seg = self._find_segment(local_secs)
+            if seg is None:
+                # local time is ambiguous or non-existent due to a transition.
+                # Let pytz resolve it in the same manner as the slow path.
+                dt = EPOCH + datetime.timedelta(seconds=local_secs)
+                return calendar.timegm(self.tstz.localize(dt).utctimetuple())
+            self._seg = seg
+            offset = seg[2]
+
+        return local_secs - offset
+
+    def _slow_parse(self, ts_val):
+        """Converts the date/time string 'ts_val' using dateutil and pytz.
+        """
+        # imported here, as most files never need dateutil, and it is slow to import
+        from dateutil import parser
+        dt = parser.parse(ts_val)
+        dt = self.tstz.localize(dt)
+        return calendar.timegm(dt.utctimetuple())
+
+    def _build_offset_table(self):
+        """Builds a table of the UTC offsets in effect for the timezone, indexed
+        by local time.  '_bounds' is a sorted list of local times (seconds from the
+        epoch, treating local time as UTC).  Each pair of entries bounds a window
+        around a transition where local time is ambiguous or does not exist.
+        '_offsets' holds the UTC offset, in seconds, between consecutive windows.
+        """
+        tz = self.tstz
+        trans_times = getattr(tz, '_utc_transition_times', None)
+        trans_info = getattr(tz, '_transition_info', None)
+        if not trans_times:
+            # a timezone with a fixed UTC offset.
+            offset = tz.utcoffset(datetime.datetime(2000, 1, 1))
+            self._bounds = []
+            self._offsets = [int(offset.total_seconds())]
+            return
+
+        offsets = [int(info[0].total_seconds()) for info in trans_info]
+        bounds = []
+        # the first transition time is a placeholder for the beginning of time.
+        for i in range(1, len(trans_times)):
+            utc_secs = calendar.timegm(trans_times[i].timetuple())
+            before, after = offsets[i - 1], offsets[i]
+            bounds.append(utc_secs + min(before, after))
+            bounds.append(utc_secs + max(before, after))
+        self._bounds = bounds
+        self._offsets = offsets
+
+    def _find_segment(self, local_secs):
+        """Returns a (start, end, offset) tuple describing the segment of the offset
+        table containing the local time 'local_secs', or None if 'local_secs' falls
+        in a transition window.
+        """
+        bounds = self._bounds
+        ix = bisect.bisect_right(bounds, local_secs)
+        if ix % 2:
+            return None
+        start = bounds[ix - 1] if ix else -2**63
+        end = bounds[ix] if ix < len(bounds) else 2**63
+        return start, end, self._offsets[ix // 2]
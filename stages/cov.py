@@ -0,0 +1,146 @@
+"""Contains the CovFilter class, a stage that is placed between the file readers
+and the consumers to drop readings that have not changed, or have changed by less
+than a deadband, since the last reading of the sensor that was passed on.
+
+A stage is a callable that is passed a list of record dictionaries or a
+readers.chunk.RecordChunk, and returns the records to pass on, in the same form.
+A stage with state that must survive restarts of the script has a get_state()
+method, returning the state to save, or None if it hasn't changed since the last
+call, and a set_state() method that restores the saved state, or the initial state
+if passed None.  A stage can also have a commit() method, called once the records
+it returned have been delivered to the consumers, and a rollback() method, called
+instead if delivering them failed, which undoes the changes to its state made
+since the last commit, as the records will be read again.
+"""
+import fnmatch
+from array import array
+from readers.chunk import RecordChunk
+
+
+class CovFilter:
+    """Change of value filter.  A reading is passed on if its sensor has no prior
+    reading, if its value differs from the last value passed on by more than the
+    sensor's deadband, or if 'heartbeat_minutes' have passed since the last reading
+    passed on.  Readings older than the last reading passed on, such as those of a
+    file being read again, are always passed on.
+
+    Parameters
+    ----------
+    deadband:  The deadband of sensors not matched by 'deadbands'.  The default of 0
+        drops only readings with exactly the same value as the last one passed on.
+    deadbands:  A dictionary mapping sensor names, which may contain glob wildcards
+        such as "CCHRC.HRV1.*", to the deadband of the matching sensors.  The first
+        matching entry is used.
+    heartbeat_minutes:  A reading of each sensor is passed on at least this often,
+        even if its value has not changed.  0 turns off the heartbeat.  Default is 60.
+    """
+
+    def __init__(self, deadband=0.0, deadbands={}, heartbeat_minutes=60):
+        self.deadband = deadband
+        self.deadbands = deadbands
+        self.heartbeat = heartbeat_minutes * 60.0 if heartbeat_minutes else float('inf')
+        # maps sensor name to a (ts, value) tuple of the last reading passed on
+        self.last = {}
+        self.changed = False
+        # maps sensor name to its entry in 'last' before the changes since the last
+        # commit, or None if it had no entry
+        self._undo = {}
+        # maps sensor name to its deadband
+        self._bands = {}
+
+    def band(self, name):
+        """Returns the deadband of the sensor 'name'.
+        """
+        band = self._bands.get(name)
+        if band is None:
+            band = self.deadband
+            for pattern, pattern_band in self.deadbands.items():
+                if fnmatch.fnmatchcase(name, pattern):
+                    band = pattern_band
+                    break
+            self._bands[name] = band
+        return band
+
+    def keep(self, name, ts, val):
+        """Returns True if the reading 'val' at time 'ts' of the sensor 'name' should
+        be passed on, and if so, remembers it as the last reading passed on.
+        """
+        last = self.last.get(name)
+        if last is not None:
+            last_ts, last_val = last
+            if ts < last_ts:
+                return True
+            if ts - last_ts < self.heartbeat and abs(val - last_val) <= self.band(name):
+                return False
+        if name not in self._undo:
+            self._undo[name] = last
+        self.last[name] = (ts, val)
+        self.changed = True
+        return True
+
+    def __call__(self, recs):
+        if isinstance(recs, RecordChunk):
+            return self._filter_chunk(recs)
+
+        keep = self.keep
+        new_recs = []
+        for rec in recs:
+            ts = rec['ts']
+            new_rec = {'ts': ts}
+            for nm, val in rec.items():
+                if nm != 'ts' and keep(nm, ts, val):
+                    new_rec[nm] = val
+            if len(new_rec) > 1:
+                new_recs.append(new_rec)
+        return new_recs
+
+    def _filter_chunk(self, chunk):
+        """Returns a RecordChunk holding the readings of 'chunk' that are passed on.
+        Records with no readings passed on are left out.
+        """
+        keep = self.keep
+        names = chunk.names
+        kept_ts = array('d')
+        kept_values = array('d')
+        kept_valid = bytearray()
+        for ts, vals, ok in chunk._rows():
+            row_valid = bytes(1 if good and keep(nm, ts, v) else 0
+                              for nm, v, good in zip(names, vals, ok))
+            if any(row_valid):
+                kept_ts.append(ts)
+                kept_values.extend(vals)
+                kept_valid.extend(row_valid)
+        return RecordChunk(names, kept_ts, kept_values, kept_valid)
+
+    def get_state(self):
+        """Returns the last reading of each sensor that was passed on, or None if
+        that hasn't changed since the last call.
+        """
+        if not self.changed:
+            return None
+        self.changed = False
+        return self.last
+
+    def set_state(self, last):
+        """Restores the last readings passed on, as returned by get_state(), or
+        forgets them if 'last' is None.
+        """
+        self.last = last if last is not None else {}
+        self.changed = False
+        self._undo = {}
+
+    def commit(self):
+        """Keeps the changes to the last readings passed on, made since the last call.
+        """
+        self._undo = {}
+
+    def rollback(self):
+        """Undoes the changes to the last readings passed on, made since the last call
+        to commit().
+        """
+        for name, last in self._undo.items():
+            if last is None:
+                self.last.pop(name, None)
+            else:
+                self.last[name] = last
+        self._undo = {}
@@ -0,0 +1,180 @@
+"""Contains the Resampler class, a stage that aggregates the readings of each
+sensor over fixed time buckets, such as 15 minute averages of readings logged every
+minute.  See stages.cov for a description of stages.
+"""
+import fnmatch
+import math
+from array import array
+from readers.chunk import RecordChunk
+
+# the aggregation functions, applied to a bucket's [count, sum, min, max, last] list
+FUNCTIONS = {
+    'mean': lambda b: b[1] / b[0],
+    'min': lambda b: b[2],
+    'max': lambda b: b[3],
+    'last': lambda b: b[4],
+    'sum': lambda b: b[1],
+    }
+
+
+class Resampler:
+    """Aggregates the readings of each sensor over buckets of 'minutes' minutes,
+    aligned to the Unix epoch, so 15 minute buckets start on the hour and at 15, 30
+    and 45 minutes past.  Only the bucket currently being filled is held for each
+    sensor.  When a reading of a sensor falls in a later bucket, the aggregate value
+    of the sensor's prior bucket is passed on.  Readings that fall in a bucket
+    before the one being filled are dropped.  The partial buckets are saved with the
+    state of the files, so a bucket can be filled across passes through the files
+    and restarts of the script.
+
+    Parameters
+    ----------
+    minutes:  The length of the buckets in minutes.  Required.
+    function:  The aggregation function used for sensors not matched by 'functions':
+        'mean' (the default), 'min', 'max', 'last' or 'sum'.
+    functions:  A dictionary mapping sensor names, which may contain glob wildcards,
+        to the aggregation function of the matching sensors.  The first matching
+        entry is used.
+    label:  The time within the bucket used as the timestamp of the aggregate
+        value: 'start', 'center' (the default) or 'end'.
+    """
+
+    def __init__(self, minutes, function='mean', functions={}, label='center'):
+        self.interval = minutes * 60.0
+        for func in [function] + list(functions.values()):
+            if func not in FUNCTIONS:
+                raise ValueError('The resample function "%s" is not valid.' % func)
+        self.function = function
+        self.functions = functions
+        try:
+            self.offset = {'start': 0.0, 'center': 0.5, 'end': 1.0}[label] * self.interval
+        except KeyError:
+            raise ValueError('The resample label "%s" is not valid.' % label)
+        # maps sensor name to a [bucket, count, sum, min, max, last] list of the
+        # bucket being filled, where 'bucket' is the bucket's number from the epoch.
+        self.buckets = {}
+        self.changed = False
+        # maps sensor name to a copy of its bucket before the changes since the last
+        # commit, or None if it had no bucket
+        self._undo = {}
+        # maps sensor name to its aggregation function
+        self._funcs = {}
+
+    def func(self, name):
+        """Returns the aggregation function of the sensor 'name'.
+        """
+        func = self._funcs.get(name)
+        if func is None:
+            func_name = self.function
+            for pattern, pattern_func in self.functions.items():
+                if fnmatch.fnmatchcase(name, pattern):
+                    func_name = pattern_func
+                    break
+            func = self._funcs[name] = FUNCTIONS[func_name]
+        return func
+
+    def add(self, name, ts, val, out):
+        """Adds the reading 'val' at time 'ts' of the sensor 'name' to the sensor's
+        bucket.  If this completes the sensor's prior bucket, its aggregate value is
+        added to the dictionary 'out', which maps timestamp to a record.
+        """
+        bucket = math.floor(ts / self.interval)
+        b = self.buckets.get(name)
+        if name not in self._undo:
+            self._undo[name] = None if b is None else b[:]
+        if b is None or bucket > b[0]:
+            if b is not None:
+                ts_out = b[0] * self.interval + self.offset
+                rec = out.get(ts_out)
+                if rec is None:
+                    rec = out[ts_out] = {'ts': ts_out}
+                rec[name] = self.func(name)(b[1:])
+            self.buckets[name] = [bucket, 1, val, val, val, val]
+        elif bucket == b[0]:
+            b[1] += 1
+            b[2] += val
+            if val < b[3]:
+                b[3] = val
+            if val > b[4]:
+                b[4] = val
+            b[5] = val
+        else:
+            # the reading belongs to a bucket that was already passed on
+            return
+        self.changed = True
+
+    def __call__(self, recs):
+        out = {}
+        add = self.add
+        if isinstance(recs, RecordChunk):
+            names = recs.names
+            for ts, vals, ok in recs._rows():
+                for nm, v, good in zip(names, vals, ok):
+                    if good:
+                        add(nm, ts, v, out)
+        else:
+            for rec in recs:
+                ts = rec['ts']
+                for nm, v in rec.items():
+                    if nm != 'ts':
+                        add(nm, ts, v, out)
+
+        new_recs = [out[ts] for ts in sorted(out)]
+        if isinstance(recs, RecordChunk):
+            return _records_to_chunk(new_recs)
+        return new_recs
+
+    def get_state(self):
+        """Returns the partial bucket of each sensor, or None if the buckets haven't
+        changed since the last call.
+        """
+        if not self.changed:
+            return None
+        self.changed = False
+        return self.buckets
+
+    def set_state(self, buckets):
+        """Restores the partial buckets, as returned by get_state(), or forgets them
+        if 'buckets' is None.
+        """
+        self.buckets = buckets if buckets is not None else {}
+        self.changed = False
+        self._undo = {}
+
+    def commit(self):
+        """Keeps the changes to the partial buckets, made since the last call.
+        """
+        self._undo = {}
+
+    def rollback(self):
+        """Undoes the changes to the partial buckets, made since the last call to
+        commit().
+        """
+        for name, b in self._undo.items():
+            if b is None:
+                self.buckets.pop(name, None)
+            else:
+                self.buckets[name] = b
+        self._undo = {}
+
+
+def _records_to_chunk(recs):
+    """Returns a RecordChunk holding the list of record dictionaries 'recs'.
+    """
+    names = []
+    seen = set()
+    for rec in recs:
+        for nm in rec:
+            if nm != 'ts' and nm not in seen:
+                seen.add(nm)
+                names.append(nm)
+    ts = array('d')
+    values = array('d')
+    valid = bytearray()
+    for rec in recs:
+        ts.append(rec['ts'])
+        for nm in names:
+            v = rec.get(nm)
+            values.append(0.0 if v is None else v)
+            valid.append(v is not None)
+    return RecordChunk(names, ts, values, valid)
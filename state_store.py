@@ -0,0 +1,201 @@
+"""Class to store the state of each CSV file processed by csv_transfer.py in a
+SQLite database: the timestamp of the last record delivered, the resume point
+used by the file readers, and the modification time, size and inode of the file
+when it was last read completely.  Other state, such as that of the filtering
+stages, is stored as pickled objects under a key.  The state of all files is held in memory, and
+only the entries that changed are written to the database, in one transaction,
+when commit() is called.  A crash therefore loses at most the changes since the
+last commit, never the stored state.
+"""
+import os
+import pickle
+import sqlite3
+
+
+class StateStore:
+    """The stored state of the files.
+
+    Parameters
+    ----------
+    path:  Path to the SQLite database file.  It is created if it does not exist.
+    """
+
+    _create_files = (
+            'CREATE TABLE IF NOT EXISTS files '
+            '('
+            '  filename TEXT PRIMARY KEY,'
+            '  last_ts REAL,'
+            '  mtime_ns INTEGER,'
+            '  size INTEGER,'
+            '  inode INTEGER,'
+            '  resume BLOB'
+            ')'
+            )
+    _iterate_files = 'SELECT filename, last_ts, mtime_ns, size, inode, resume FROM files'
+    _get_file = 'SELECT last_ts, mtime_ns, size, inode, resume FROM files WHERE filename = ?'
+    _upsert_file = (
+            'INSERT OR REPLACE INTO files '
+            '(filename, last_ts, mtime_ns, size, inode, resume) '
+            'VALUES (?, ?, ?, ?, ?, ?)'
+            )
+
+    _create_blobs = (
+            'CREATE TABLE IF NOT EXISTS blobs '
+            '('
+            '  key TEXT PRIMARY KEY,'
+            '  value BLOB'
+            ')'
+            )
+    _get_blob = 'SELECT value FROM blobs WHERE key = ?'
+    _upsert_blob = 'INSERT OR REPLACE INTO blobs (key, value) VALUES (?, ?)'
+
+    # key of the blob marking that the pickled state of earlier versions was imported
+    _imported_key = 'imported-pickles'
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        with self._conn:
+            self._conn.execute(self._create_files)
+            self._conn.execute(self._create_blobs)
+
+        # maps key to the pickled objects set since the last commit
+        self._dirty_blobs = {}
+
+        # maps file name to a dictionary of its state, and the names of the files
+        # whose state has changed since the last commit.
+        self._files = {}
+        self._dirty = set()
+        for row in self._conn.execute(self._iterate_files):
+            self._files[row[0]] = _entry(*row[1:])
+
+    def __len__(self):
+        return len(self._files)
+
+    def last_ts(self, fn):
+        """Returns the timestamp of the last record delivered from the file 'fn', or
+        0 if no records have been delivered.
+        """
+        entry = self._files.get(fn)
+        return (entry['last_ts'] or 0) if entry else 0
+
+    def resume(self, fn):
+        """Returns a copy of the resume point dictionary for the file 'fn', which is
+        empty if there is none.
+        """
+        entry = self._files.get(fn)
+        return dict(entry['resume']) if entry else {}
+
+    def unchanged(self, fn, st):
+        """Returns True if the os.stat() result 'st' of the file 'fn' shows the file
+        has not changed since it was last read completely, judged by its modification
+        time, size and inode.
+        """
+        entry = self._files.get(fn)
+        return (entry is not None and entry['mtime_ns'] == st.st_mtime_ns and
+                entry['size'] == st.st_size and entry['inode'] == st.st_ino)
+
+    def update(self, fn, last_ts=None, resume=None, st=None):
+        """Updates the state of the file 'fn'.  Any of 'last_ts', the timestamp of the
+        last record delivered, 'resume', the resume point dictionary, and 'st', the
+        os.stat() result of the file when it was read completely, that are not None
+        are stored.  The change is written to the database by commit().
+        """
+        entry = self._files.get(fn)
+        if entry is None:
+            entry = self._files[fn] = {'last_ts': 0, 'mtime_ns': None, 'size': None,
+                                       'inode': None, 'resume': {}}
+        if last_ts is not None:
+            entry['last_ts'] = last_ts
+        if resume is not None:
+            entry['resume'] = resume
+        if st is not None:
+            entry['mtime_ns'] = st.st_mtime_ns
+            entry['size'] = st.st_size
+            entry['inode'] = st.st_ino
+        self._dirty.add(fn)
+
+    def get_blob(self, key):
+        """Returns the object stored under 'key', or None if there is none.
+        """
+        if key in self._dirty_blobs:
+            return pickle.loads(self._dirty_blobs[key])
+        row = self._conn.execute(self._get_blob, (key,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def set_blob(self, key, obj):
+        """Stores the object 'obj' under 'key'.  The object is pickled now, and
+        written to the database by commit().
+        """
+        self._dirty_blobs[key] = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    def commit(self):
+        """Writes the state of the files and the objects that changed since the last
+        commit to the database, in one transaction.
+        """
+        if not self._dirty and not self._dirty_blobs:
+            return
+        rows = []
+        for fn in self._dirty:
+            e = self._files[fn]
+            rows.append((fn, e['last_ts'], e['mtime_ns'], e['size'], e['inode'],
+                         pickle.dumps(e['resume'], 2) if e['resume'] else None))
+        with self._conn:
+            self._conn.executemany(self._upsert_file, rows)
+            self._conn.executemany(self._upsert_blob, list(self._dirty_blobs.items()))
+        self._dirty.clear()
+        self._dirty_blobs.clear()
+
+    def rollback(self):
+        """Discards the changes to the state of the files and the objects made since
+        the last commit, restoring the state stored in the database.
+        """
+        for fn in self._dirty:
+            row = self._conn.execute(self._get_file, (fn,)).fetchone()
+            if row is None:
+                self._files.pop(fn, None)
+            else:
+                self._files[fn] = _entry(*row)
+        self._dirty.clear()
+        self._dirty_blobs.clear()
+
+    def import_pickles(self, last_ts_fn, resume_fn=None):
+        """Imports the state stored by earlier versions of csv_transfer.py: the pickled
+        dictionaries of last timestamps, 'last_ts_fn', and of resume points,
+        'resume_fn', either of which may not exist.  The imported state is committed,
+        along with a marker that the import was done, so the pickles are imported only
+        once, even if an earlier attempt failed after the database was created.  A
+        store that already holds the state of files, from a version that did not
+        record the marker, is only marked.  Returns the number of files imported.
+        """
+        if self.get_blob(self._imported_key):
+            return 0
+        if self._files:
+            self.set_blob(self._imported_key, True)
+            self.commit()
+            return 0
+
+        last_ts_map = {}
+        resume_map = {}
+        if os.path.exists(last_ts_fn):
+            with open(last_ts_fn, 'rb') as f:
+                last_ts_map = pickle.load(f)
+        if resume_fn and os.path.exists(resume_fn):
+            with open(resume_fn, 'rb') as f:
+                resume_map = pickle.load(f)
+        for fn in set(last_ts_map) | set(resume_map):
+            self.update(fn, last_ts=last_ts_map.get(fn), resume=resume_map.get(fn))
+        self.set_blob(self._imported_key, True)
+        self.commit()
+        return len(set(last_ts_map) | set(resume_map))
+
+    def close(self):
+        self._conn.close()
+
+
+def _entry(last_ts, mtime_ns, size, inode, resume):
+    """Returns the dictionary holding the state of a file, from the columns of its
+    row in the 'files' table.
+    """
+    return {'last_ts': last_ts, 'mtime_ns': mtime_ns, 'size': size, 'inode': inode,
+            'resume': pickle.loads(resume) if resume else {}}